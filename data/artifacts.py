@@ -0,0 +1,112 @@
+# Build artifacts for csv2js.py
+#
+# csv2js.py writes the same bytes for the same sheet and settings. Before a build is
+# published, this finishes it off for serving:
+#
+#   - scripts are stripped: indentation, blank lines and comment lines are dropped,
+#     but line breaks are kept, so the meaning of the code cannot change (names and
+#     expressions are left as they are, as the generated code is mostly data)
+#   - data.js and style.js are also given names carrying a hash of their contents
+#     (data.<hash>.js), which manifest.js lists and loads. manifest.js is the only
+#     file the page loads by a fixed URL, so everything else can be cached for good
+#     (chunks are already in a folder named after the build)
+#   - the icon sprite style.js loads (see sprites.py) is already named after its
+#     contents (icons.<hash>.png), and is published before the scripts
+#   - every script and data file gets a gzip sibling (name.gz) and, if the brotli
+#     module is installed, a brotli one (name.br), for the web server to send as is.
+#     The siblings are published before the file itself, so a server that sends
+#     the sibling of a file it finds never sends one older than the file
+
+import gzip
+import hashlib
+import os
+import re
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+
+# Siblings written next to each file served
+COMPRESSED = [".gz", ".br"]
+
+# Name of an icon sprite
+SPRITE = r"icons\.[0-9a-f]{12}\.png"
+
+
+# Strip the indentation, blank lines and // comment lines from the script at 'path', in place
+def strip_script(path):
+  output = open(path + ".min", "w")
+  for line in open(path):
+    line = line.strip()
+    if line and not line.startswith("//"):
+      output.write(line + "\n")
+  output.close()
+  os.rename(path + ".min", path)
+
+# Write the gzip (and brotli) siblings of the file at 'path'
+def precompress(path):
+  data = open(path, "rb").read()
+  output = open(path + ".gz", "wb")
+  compressed = gzip.GzipFile("", "wb", 9, output, 0)
+  compressed.write(data)
+  compressed.close()
+  output.close()
+  if brotli is not None:
+    output = open(path + ".br", "wb")
+    output.write(brotli.compress(data))
+    output.close()
+
+# Name of the copy of 'name' carrying a hash of its contents ('data.js' becomes 'data.<hash>.js')
+def hashed_name(folder, name):
+  base, extension = os.path.splitext(name)
+  return "{0}.{1}{2}".format(base, hashlib.sha1(open(os.path.join(folder, name), "rb").read()).hexdigest()[:12], extension)
+
+# Name of the icon sprite the style.js at 'path' loads, or None if it loads none
+def style_sprite(path):
+  found = re.search(SPRITE, open(path).read())
+  return found.group(0) if found else None
+
+# Write manifest.js to 'folder', loading the 'scripts' (in order) from 'app_path'/data/
+def write_manifest(folder, app_path, scripts):
+  output = open(os.path.join(folder, "manifest.js"), "w")
+  output.write("var BuildManifest = {{{0}}};\n".format(",".join("\"{0}\":\"{1}\"".format(name, hashed) for name, hashed in scripts)))
+  for name, hashed in scripts:
+    output.write("document.write('<script src=\"{0}data/{1}\"></script>');\n".format(app_path, hashed))
+  output.close()
+
+# Finish off the build in 'folder' (its scripts, data.js and style.js, its icon sprite
+# and its chunks in 'folder'/chunks) as described above, loaded by the page from 'app_path'. Returns
+# the files to publish, in the order they should be published
+def prepare_artifacts(folder, app_path):
+  chunks = os.path.join(folder, "chunks")
+  scripts = [name for name in ["style.js", "data.js"] if os.path.exists(os.path.join(folder, name))]
+  for path in [os.path.join(folder, name) for name in scripts] + [os.path.join(chunks, name) for name in os.listdir(chunks) if name.endswith(".js")]:
+    strip_script(path)
+  hashed = []
+  for name in scripts:
+    hashed.append((name, hashed_name(folder, name)))
+    os.link(os.path.join(folder, name), os.path.join(folder, hashed[-1][1]))
+  write_manifest(folder, app_path, hashed)
+  # Hashed scripts are published first, as nothing refers to them until manifest.js is replaced
+  names = [hashed_script for name, hashed_script in hashed] + scripts + ["manifest.js"]
+  for path in [os.path.join(folder, name) for name in names] + [os.path.join(chunks, name) for name in os.listdir(chunks)]:
+    precompress(path)
+  # Sprites go before everything, and are not precompressed (PNGs are compressed already)
+  sprites = sorted(name for name in os.listdir(folder) if re.match("^" + SPRITE + "$", name))
+  return sprites + [name + suffix for name in names for suffix in COMPRESSED + [""]]
+
+# Remove hashed scripts and sprites from 'folder' other than those of the newest 'keep' builds
+# (pages holding an older manifest.js may still load them)
+def prune_artifacts(folder, keep):
+  builds = {}
+  for name in os.listdir(folder):
+    found = re.match(r"^(data|style|icons)\.([0-9a-f]{12})\.(js|png)(\.gz|\.br)?$", name)
+    if found:
+      builds.setdefault(found.group(1), {}).setdefault(found.group(2), []).append(name)
+  for script in builds.values():
+    newest = sorted(script, key=lambda digest: os.path.getmtime(os.path.join(folder, script[digest][0])), reverse=True)
+    for digest in newest[keep:]:
+      for name in script[digest]:
+        os.remove(os.path.join(folder, name))
@@ -0,0 +1,163 @@
+# Backup store for csv2js.py
+#
+# Every published build is kept in backups/, so the site can be rolled back to it.
+# Files are stored once each, gzipped, under the SHA-1 of their contents
+# (backups/objects/ab/cdef...gz). A build is a small JSON object listing the hash of
+# each of its files (data.js, style.js, its icon sprite and its data chunks), stored the same way, and
+# backups/index.json lists when each build was published. A build identical to an
+# earlier one adds nothing but its line in the index.
+#
+# Old builds are thinned out: the last few are kept, then the last build of each of
+# the most recent days and weeks. Files no kept build refers to are removed.
+
+import glob
+import gzip
+import hashlib
+import json
+import os
+import time
+
+from publish import write_file
+from artifacts import style_sprite
+
+
+# Format of the build times in the index
+TIME_FORMAT = "%Y-%m-%d@%H:%M:%S"
+
+
+# Path of the object with hash 'digest' in the store at 'store'
+def object_path(store, digest):
+  return os.path.join(store, "objects", digest[:2], digest[2:] + ".gz")
+
+# Store 'data' (if it is not stored already), returning its hash
+def store_object(store, data):
+  digest = hashlib.sha1(data).hexdigest()
+  path = object_path(store, digest)
+  if not os.path.exists(path):
+    if not os.path.exists(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    output = gzip.GzipFile(path + ".tmp", "wb", 9, None, 0)
+    output.write(data)
+    output.close()
+    os.rename(path + ".tmp", path)
+  return digest
+
+# Contents of the object with hash 'digest'
+def read_object(store, digest):
+  stored = gzip.GzipFile(object_path(store, digest), "rb")
+  data = stored.read()
+  stored.close()
+  return data
+
+# The store's index: a list of {"time", "build"}, oldest first
+def load_index(store):
+  if not os.path.exists(os.path.join(store, "index.json")):
+    return []
+  return json.load(open(os.path.join(store, "index.json")))
+
+def save_index(store, index):
+  write_file(os.path.join(store, "index.json"), json.dumps(index, indent=1))
+
+# The build with hash 'digest': {"release": chunk folder name, "files": {name: hash}}
+def read_build(store, digest):
+  return json.loads(read_object(store, digest))
+
+# Add the build published in 'folder' (data.js, style.js and the chunks of 'release',
+# if any) to the store as published at 'when', returning the build's hash
+def add_build(store, folder, release, when):
+  files = {}
+  for name in ["data.js", "style.js"]:
+    if os.path.exists(os.path.join(folder, name)):
+      files[name] = store_object(store, open(os.path.join(folder, name), "rb").read())
+  sprite = style_sprite(os.path.join(folder, "style.js")) if "style.js" in files else None
+  if sprite and os.path.exists(os.path.join(folder, sprite)):
+    files[sprite] = store_object(store, open(os.path.join(folder, sprite), "rb").read())
+  if release and os.path.exists(os.path.join(folder, "chunks", release)):
+    for name in sorted(os.listdir(os.path.join(folder, "chunks", release))):
+      # Compressed copies are left out, as they are made again on restoring
+      if name.endswith(".gz") or name.endswith(".br"):
+        continue
+      files["chunks/" + name] = store_object(store, open(os.path.join(folder, "chunks", release, name), "rb").read())
+  digest = store_object(store, json.dumps({"release": release, "files": files}, sort_keys=True))
+  record_build(store, digest, when)
+  return digest
+
+# Add a line to the index saying the build with hash 'digest' was published at 'when'
+def record_build(store, digest, when):
+  index = load_index(store)
+  index.append({"time": when, "build": digest})
+  save_index(store, index)
+
+# Bring any old-style timestamped copies of data.js (backups/data_<time>.js) into the
+# store, oldest first, removing the copies
+def import_copies(store):
+  index = load_index(store)
+  for path in sorted(glob.glob(os.path.join(store, "data_*.js"))):
+    files = {"data.js": store_object(store, open(path, "rb").read())}
+    digest = store_object(store, json.dumps({"release": None, "files": files}, sort_keys=True))
+    index.append({"time": os.path.basename(path)[5:-3], "build": digest})
+    os.remove(path)
+  index.sort(key=lambda entry: time.strptime(entry["time"], TIME_FORMAT))
+  save_index(store, index)
+
+# The entries of 'index' to keep: the last 'last', and the last of each of the most
+# recent 'days' days and 'weeks' weeks that have a build
+def thin(index, last, days, weeks):
+  keep = set(range(max(0, len(index) - last), len(index)))
+  for count, period in [(days, "%Y-%m-%d"), (weeks, "%Y-%W")]:
+    seen = []
+    for position in reversed(range(len(index))):
+      key = time.strftime(period, time.strptime(index[position]["time"], TIME_FORMAT))
+      if not key in seen:
+        if len(seen) == count:
+          break
+        seen.append(key)
+        keep.add(position)
+  return [entry for position, entry in enumerate(index) if position in keep]
+
+# Thin out the store's builds (see thin()) and remove the objects no kept build refers
+# to. Returns the number of bytes freed
+def prune(store, last, days, weeks):
+  index = thin(load_index(store), last, days, weeks)
+  save_index(store, index)
+  referenced = set()
+  for entry in index:
+    referenced.add(entry["build"])
+    referenced.update(read_build(store, entry["build"])["files"].values())
+  freed = 0
+  for path in glob.glob(os.path.join(store, "objects", "*", "*.gz")):
+    if not os.path.basename(os.path.dirname(path)) + os.path.basename(path)[:-3] in referenced:
+      freed += os.path.getsize(path)
+      os.remove(path)
+  return freed
+
+# Find the index entry 'when' names: a build time (or the start of one, matching the
+# latest such build) or the start of a build hash. Returns None if nothing matches
+def find_build(store, when):
+  for entry in reversed(load_index(store)):
+    if entry["time"].startswith(when) or entry["build"].startswith(when):
+      return entry
+  return None
+
+# Write out the files of the build with hash 'digest' to 'staging' (chunks in
+# 'staging'/chunks), returning the name of the build's chunk folder
+def restore_build(store, digest, staging):
+  build = read_build(store, digest)
+  for name, file_digest in build["files"].items():
+    output = open(os.path.join(staging, *name.split("/")), "wb")
+    output.write(read_object(store, file_digest))
+    output.close()
+  return build["release"]
+
+# Total stored size of the build with hash 'digest', and the part of it no build in
+# 'earlier' shares
+def build_size(store, digest, earlier):
+  shared = set()
+  for entry in earlier:
+    shared.update(read_build(store, entry["build"])["files"].values())
+  size = added = 0
+  for file_digest in set(read_build(store, digest)["files"].values()):
+    size += os.path.getsize(object_path(store, file_digest))
+    if not file_digest in shared:
+      added += os.path.getsize(object_path(store, file_digest))
+  return size, added
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+# Benchmark for csv2js.py
+#
+# Generates synthetic spreadsheets with the real column layout at several sizes,
+# builds each one from a local file (no network) in a scratch copy of this folder,
+# and records the wall time, peak memory and output size of every phase:
+#
+#   generate   writing the synthetic sheet
+#   build      a first build, with no build cache
+#   unchanged  building the same sheet again
+#   edited     building after one marker row has been edited
+#
+# Build phases also carry csv2js.py's own per-stage report (see report.py).
+#
+# Usage: python benchmark.py [--rows 1000,10000,100000,1000000] [--shape-share 0.05]
+#                            [--shape-vertices 200] [--output benchmark.json]
+
+import sys
+sys.dont_write_bytecode = True
+import argparse
+import csv
+import json
+import math
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+# ./artifacts.py, names of the files a build is published as
+from artifacts import COMPRESSED, style_sprite
+
+
+# Real subcategory names (matching the icons in ../images), by category
+CATEGORIES = {
+  "Diplomacy": ["Diplomatic Missions", "Foreign Treaties"],
+  "Trade": ["Foreign Exports", "Foreign Imports"],
+  "Military": ["Foreign Military Actions", "Overseas Marine Landings", "Overseas Navy Personnel"],
+  "Migration": ["Major Foreign Origins", "Minor Foreign Origins"],
+  "Religion": ["Mission Stations"],
+}
+
+COLUMNS = ["Type", "Category", "Sub Category", "Start Year", "End Year", "Date Range", "Title", "Description",
+  "Historic Location", "Present Location", "Historic Lat", "Historic Lon", "Present Lat", "Present Lon", "GeoJSON", "Source", "URL"]
+
+PLACES = ["Canton", "Smyrna", "Tripoli", "Valparaiso", "Honolulu", "Calcutta", "Batavia", "Zanzibar", "Montevideo", "Lisbon"]
+SOURCES = ["Foreign Relations of the United States", "Niles' Weekly Register", "Naval Chronicle", "Consular Despatches"]
+
+# Start and end of the timeline (timeline.js)
+FIRST_YEAR, LAST_YEAR = 1785, 1867
+
+
+# Build a closed polygon ring of 'vertices' points around lon/lat, as GeoJSON
+def synthetic_shape(rng, lon, lat, vertices):
+  radius = rng.uniform(1, 8)
+  ring = []
+  for i in range(vertices):
+    angle = 2 * math.pi * i / vertices
+    r = radius * rng.uniform(0.8, 1.2)
+    ring.append([round(lon + r * math.cos(angle), 6), round(max(-80, min(80, lat + r * math.sin(angle))), 6)])
+  ring.append(ring[0])
+  return json.dumps({"type": "Feature", "properties": {}, "geometry": {"type": "Polygon", "coordinates": [ring]}})
+
+# One synthetic spreadsheet row of the given Type
+def synthetic_row(rng, kind, number, shape_vertices):
+  category = rng.choice(sorted(CATEGORIES))
+  row = dict((column, "") for column in COLUMNS)
+  row["Type"] = kind
+  row["Category"] = category
+  row["Sub Category"] = rng.choice(CATEGORIES[category])
+  start = rng.randint(FIRST_YEAR, LAST_YEAR)
+  row["Start Year"] = str(start)
+  spread = rng.random()
+  if spread < 0.3:
+    row["End Year"] = str(start)
+  elif spread < 0.8:
+    row["End Year"] = str(rng.randint(start, LAST_YEAR))
+    if rng.random() < 0.1:
+      row["Date Range"] = "{0}-{1}".format(start, row["End Year"])
+  place = rng.choice(PLACES)
+  row["Title"] = "{0} {1} at {2}".format(row["Sub Category"], number, place)
+  row["Description"] = "Synthetic record {0} for benchmarking, {1} words of description".format(number, rng.randint(5, 80))
+  row["Historic Location"] = place
+  row["Present Location"] = place
+  row["Source"] = rng.choice(SOURCES)
+  if rng.random() < 0.5:
+    row["URL"] = "http://example.org/sources/{0}".format(number)
+  lon, lat = round(rng.uniform(-175, 185), 4), round(rng.uniform(-65, 78), 4)
+  row["Present Lat"], row["Present Lon"] = str(lat), str(lon)
+  if kind == "Marker" and rng.random() < 0.5:
+    row["Historic Lat"], row["Historic Lon"] = str(lat), str(lon)
+  if kind == "Shape":
+    row["GeoJSON"] = synthetic_shape(rng, lon, lat, shape_vertices)
+  return row
+
+# Write a synthetic sheet of 'rows' rows (a few Map rows, the rest markers and,
+# 'shape_share' of the time, shapes) to 'path'
+def write_sheet(path, rows, shape_share, shape_vertices, seed):
+  rng = random.Random(seed)
+  output = open(path, "wb")
+  writer = csv.DictWriter(output, COLUMNS)
+  writer.writerow(dict(zip(COLUMNS, COLUMNS)))
+  eras = [(1785, 1815), (1816, 1840), (1841, 1867)]
+  for number, (start, end) in enumerate(eras):
+    row = dict((column, "") for column in COLUMNS)
+    row.update({"Type": "Map", "Title": "Era {0}".format(number), "Start Year": str(start), "End Year": str(end),
+      "URL": "http://example.org/tiles/{0}/{{z}}/{{x}}/{{y}}.png".format(number)})
+    writer.writerow(row)
+  for number in range(len(eras), rows):
+    writer.writerow(synthetic_row(rng, "Shape" if rng.random() < shape_share else "Marker", number, shape_vertices))
+  output.close()
+
+# Total size in bytes of the files the published build in 'folder' is made of: the
+# scripts manifest.js loads, the icon sprite style.js loads and the chunks of the release
+# data.js fetches from. Older releases, kept for pages loaded before this build (see
+# settings.keep_releases), and the precompressed siblings of each file are left out
+def output_bytes(folder):
+  names = []
+  if os.path.exists(os.path.join(folder, "manifest.js")):
+    names.extend(re.findall(r"data/((?:data|style)\.[0-9a-f]{12}\.js)", open(os.path.join(folder, "manifest.js")).read()))
+  if os.path.exists(os.path.join(folder, "style.js")) and style_sprite(os.path.join(folder, "style.js")):
+    names.append(style_sprite(os.path.join(folder, "style.js")))
+  release = None
+  if os.path.exists(os.path.join(folder, "data.js")):
+    release = re.search(r"data/chunks/([0-9a-f]{12})/", open(os.path.join(folder, "data.js")).read())
+  if release and os.path.isdir(os.path.join(folder, "chunks", release.group(1))):
+    for root, folders, files in os.walk(os.path.join(folder, "chunks", release.group(1))):
+      names.extend(os.path.relpath(os.path.join(root, name), folder) for name in files if not os.path.splitext(name)[1] in COMPRESSED)
+  return sum(os.path.getsize(os.path.join(folder, name)) for name in names if os.path.exists(os.path.join(folder, name)))
+
+# Run csv2js.py in 'folder' against the local sheet at 'path', returning the phase's
+# wall time, peak resident memory of the build process and size of its output, along
+# with the build's own per-stage report (csv2js.py --report)
+def run_build(phase, folder, path):
+  log = open(os.path.join(folder, phase + ".log"), "w")
+  report_path = os.path.join(folder, phase + ".report.json")
+  started = time.time()
+  process = subprocess.Popen([sys.executable, "csv2js.py", path, "--report", report_path], cwd=folder, stdout=log, stderr=subprocess.STDOUT)
+  pid, status, usage = os.wait4(process.pid, 0)
+  seconds = time.time() - started
+  log.close()
+  # ru_maxrss is in kilobytes on Linux and bytes on OS X
+  peak = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+  result = {"phase": phase, "seconds": round(seconds, 3), "peak_memory_bytes": peak, "output_bytes": output_bytes(folder), "exit_status": os.WEXITSTATUS(status)}
+  if os.path.exists(report_path):
+    report = json.load(open(report_path))
+    result.update({"stages": report["stages"], "rows_by_type": report["rows"], "rows_skipped_by_type": report["rows_skipped"], "build_exit": report["exit"]})
+  return result
+
+# Edit the title of the first marker row in the sheet at 'path'
+def edit_sheet(path):
+  rows = list(csv.DictReader(open(path, "rb")))
+  for row in rows:
+    if row["Type"] == "Marker":
+      row["Title"] += " (edited)"
+      break
+  output = open(path, "wb")
+  writer = csv.DictWriter(output, COLUMNS)
+  writer.writerow(dict(zip(COLUMNS, COLUMNS)))
+  writer.writerows(rows)
+  output.close()
+
+# Benchmark every phase for a sheet of 'rows' rows
+def benchmark(rows, shape_share, shape_vertices, seed):
+  here = os.path.dirname(os.path.abspath(__file__))
+  scratch = tempfile.mkdtemp(prefix="csv2js-benchmark-")
+  try:
+    folder = os.path.join(scratch, "data")
+    os.mkdir(folder)
+    for name in os.listdir(here):
+      if name.endswith(".py"):
+        shutil.copy(os.path.join(here, name), folder)
+    shutil.copytree(os.path.join(here, "..", "images"), os.path.join(scratch, "images"))
+    path = os.path.join(scratch, "sheet.csv")
+
+    started = time.time()
+    write_sheet(path, rows, shape_share, shape_vertices, seed)
+    phases = [{"phase": "generate", "seconds": round(time.time() - started, 3), "peak_memory_bytes": None, "output_bytes": os.path.getsize(path), "exit_status": 0}]
+    phases.append(run_build("build", folder, path))
+    phases.append(run_build("unchanged", folder, path))
+    edit_sheet(path)
+    phases.append(run_build("edited", folder, path))
+    for phase in phases:
+      print "{0:>9} rows  {1:<9} {2:>9.2f}s {3:>12} bytes".format(rows, phase["phase"], phase["seconds"], phase["output_bytes"])
+    return {"rows": rows, "shape_share": shape_share, "shape_vertices": shape_vertices, "seed": seed, "phases": phases}
+  finally:
+    shutil.rmtree(scratch)
+
+# Commit the benchmarked code was at, if this is a git checkout
+def revision():
+  try:
+    return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, "w")).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark csv2js.py against synthetic spreadsheets.")
+  parser.add_argument("--rows", default="1000,10000,100000,1000000", help="comma-separated sheet sizes, in rows")
+  parser.add_argument("--shape-share", type=float, default=0.05, help="fraction of rows that are shapes")
+  parser.add_argument("--shape-vertices", type=int, default=200, help="vertices in each shape's polygon")
+  parser.add_argument("--seed", type=int, default=1785, help="random seed for the synthetic sheets")
+  parser.add_argument("--output", default="benchmark.json", help="file the JSON results are written to")
+  args = parser.parse_args()
+
+  results = {"revision": revision(), "python": platform.python_version(), "platform": platform.platform(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "runs": []}
+  for rows in [int(rows) for rows in args.rows.split(",")]:
+    results["runs"].append(benchmark(rows, args.shape_share, args.shape_vertices, args.seed))
+  json.dump(results, open(args.output, "w"), indent=2, sort_keys=True)
+  print "Results written to " + args.output
@@ -0,0 +1,71 @@
+# Marker clustering for csv2js.py
+#
+# Builds a hierarchical cluster index for a subcategory's markers, the way the
+# supercluster library does: starting from the individual markers, clusters from
+# one zoom level are greedily merged with their neighbours within 'radius' screen
+# pixels to form the clusters of the next zoom level down. Every marker belongs to
+# exactly one cluster at each zoom, so the front end only has to count how many
+# of a cluster's markers are visible in the current year instead of reclustering.
+
+import math
+
+
+# Project a longitude/latitude onto the unit Web Mercator square
+def mercator(lon, lat):
+  sin = math.sin(math.radians(max(-85.0511, min(85.0511, lat))))
+  return lon / 360.0 + 0.5, 0.5 - 0.25 * math.log((1 + sin) / (1 - sin)) / math.pi
+
+# Turn a unit Web Mercator position back into a longitude/latitude
+def unmercator(x, y):
+  return (x - 0.5) * 360.0, math.degrees(math.atan(math.sinh((0.5 - y) * 2 * math.pi)))
+
+# Cluster 'points' (a list of lon/lat pairs) for every zoom from max_zoom - 1 down
+# to min_zoom; markers are shown unclustered at max_zoom. Returns, for each zoom,
+# the centre of every cluster ("lon"/"lat") and the cluster each point belongs to
+# ("member", in the same order as 'points')
+def build_clusters(points, min_zoom, max_zoom, radius):
+  # Each cluster is [x, y, weight, point indices], its position the weighted centre of its points
+  clusters = []
+  for index, (lon, lat) in enumerate(points):
+    x, y = mercator(lon, lat)
+    clusters.append([x, y, 1, [index]])
+
+  levels = {}
+  for z in range(max_zoom - 1, min_zoom - 1, -1):
+    r = radius / (256.0 * 2 ** z)
+    grid = {}
+    for index, cluster in enumerate(clusters):
+      grid.setdefault((int(cluster[0] / r), int(cluster[1] / r)), []).append(index)
+
+    merged = [False] * len(clusters)
+    next_clusters = []
+    for index, cluster in enumerate(clusters):
+      if merged[index]:
+        continue
+      merged[index] = True
+      x, y, weight, members = cluster[0] * cluster[2], cluster[1] * cluster[2], cluster[2], list(cluster[3])
+      cell_x, cell_y = int(cluster[0] / r), int(cluster[1] / r)
+      for dx in [-1, 0, 1]:
+        for dy in [-1, 0, 1]:
+          for other in grid.get((cell_x + dx, cell_y + dy), []):
+            neighbour = clusters[other]
+            if merged[other] or math.hypot(neighbour[0] - cluster[0], neighbour[1] - cluster[1]) > r:
+              continue
+            merged[other] = True
+            x += neighbour[0] * neighbour[2]
+            y += neighbour[1] * neighbour[2]
+            weight += neighbour[2]
+            members.extend(neighbour[3])
+      next_clusters.append([x / weight, y / weight, weight, members])
+    clusters = next_clusters
+
+    level = {"lon": [], "lat": [], "member": [0] * len(points)}
+    for index, cluster in enumerate(clusters):
+      lon, lat = unmercator(cluster[0], cluster[1])
+      level["lon"].append(lon)
+      level["lat"].append(lat)
+      for member in cluster[3]:
+        level["member"][member] = index
+    levels[z] = level
+
+  return levels
@@ -0,0 +1,326 @@
+# Spreadsheet fetching for csv2js.py
+#
+# Downloads every source sheet concurrently over a shared pool of keep-alive
+# connections, with a timeout on each request and a bounded number of retries
+# (with exponential backoff) for connection errors and 5xx/429 responses.
+# Each source gets a status record saying how its download went. fetch_all()
+# returns as soon as every source has answered; the bodies go on downloading in
+# the background, into StreamBody spools (on disk once large, so big sheets are
+# not held in memory) that the parser reads as the rows arrive. A download that
+# breaks off part way through cannot be retried, as its rows have been read; the
+# body then raises IOError when read, and the source's status says "failed".
+# Local files (file: URLs) are read directly, so builds can run without a network,
+# and sources already in hand (an open file, or rows in memory) are spooled the same way.
+
+import csv
+import email.utils
+import hashlib
+import httplib
+import os
+import socket
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+import zlib
+
+
+# Where Google Docs exports a spreadsheet tab as CSV
+EXPORT_URL = "https://docs.google.com/feeds/download/spreadsheets/Export?key={0}&exportFormat=csv&gid={1}"
+
+# Bodies larger than this are spooled to disk
+SPOOL_SIZE = 8 * 1024 * 1024
+
+REDIRECTS = [301, 302, 303, 307, 308]
+
+
+# URL of a source: a (gdoc_id, gid) pair for a spreadsheet tab, a URL, or a local file path
+def source_url(source):
+  if isinstance(source, tuple):
+    return EXPORT_URL.format(*source)
+  if "://" in source or source.startswith("file:"):
+    return source
+  return "file:" + urllib.pathname2url(os.path.abspath(source))
+
+# A pool of idle keep-alive connections, shared by every download
+def new_pool():
+  return {"lock": threading.Lock(), "idle": {}}
+
+# Take an idle connection to 'key' (scheme, host) from the pool, or open a new one
+def take_connection(pool, key, timeout):
+  with pool["lock"]:
+    if pool["idle"].get(key):
+      return pool["idle"][key].pop()
+  if key[0] == "https":
+    return httplib.HTTPSConnection(key[1], timeout=timeout)
+  return httplib.HTTPConnection(key[1], timeout=timeout)
+
+# Put a connection back in the pool for the next request to the same host
+def give_connection(pool, key, connection):
+  with pool["lock"]:
+    pool["idle"].setdefault(key, []).append(connection)
+
+# Close every idle connection in the pool
+def close_pool(pool):
+  with pool["lock"]:
+    for connections in pool["idle"].values():
+      for connection in connections:
+        connection.close()
+    pool["idle"] = {}
+
+# A response body that is read (a line at a time, or with read()) while it is still
+# being written, by the thread downloading it. Reads wait for the data to arrive
+class StreamBody(object):
+  def __init__(self):
+    self.spool = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+    self.condition = threading.Condition()
+    self.written = 0
+    self.position = 0
+    self.done = False
+    self.error = None
+    self.closed = False
+
+  # Add a block to the end of the body (raises IOError once the reader has closed it)
+  def write(self, block):
+    with self.condition:
+      if self.closed:
+        raise IOError("body closed")
+      self.spool.seek(self.written)
+      self.spool.write(block)
+      self.written += len(block)
+      self.condition.notify_all()
+
+  # Mark the body complete, or broken off with the message 'error'
+  def finish(self, error=None):
+    with self.condition:
+      self.done, self.error = True, error
+      self.condition.notify_all()
+
+  # Read up to 'size' bytes (all of the rest if negative), waiting for at least one
+  # to arrive. Returns "" at the end of the body
+  def read(self, size=-1):
+    with self.condition:
+      while not self.done and (size < 0 or self.position == self.written):
+        self.condition.wait()
+      if self.error is not None:
+        raise IOError(self.error)
+      self.spool.seek(self.position)
+      block = self.spool.read(self.written - self.position if size < 0 else min(size, self.written - self.position))
+      self.position += len(block)
+      return block
+
+  def __iter__(self):
+    pending = ""
+    while True:
+      block = self.read(64 * 1024)
+      if not block:
+        break
+      lines = (pending + block).split("\n")
+      pending = lines.pop()
+      for line in lines:
+        yield line + "\n"
+    if pending:
+      yield pending
+
+  def close(self):
+    with self.condition:
+      self.closed = True
+      self.spool.close()
+
+# Download a response body into 'body' (a StreamBody) as it arrives, inflating it if gzipped
+def pump_body(response, body):
+  inflate = zlib.decompressobj(16 + zlib.MAX_WBITS) if response.getheader("Content-Encoding") == "gzip" else None
+  while True:
+    block = response.read(64 * 1024)
+    if not block:
+      break
+    body.write(inflate.decompress(block) if inflate else block)
+  # read() only stops short of the Content-Length quietly
+  if response.length:
+    raise httplib.IncompleteRead("", response.length)
+  if inflate:
+    body.write(inflate.flush())
+
+# Read a local file: source, honouring If-None-Match against a hash of its contents
+# (file times are only kept to the second, too coarse to tell edits apart)
+def read_file(url, headers):
+  path = urllib.url2pathname(urlparse.urlsplit(url).path)
+  data = open(path, "rb").read()
+  validators = {"ETag": '"{0}"'.format(hashlib.sha1(data).hexdigest()), "Last-Modified": email.utils.formatdate(os.path.getmtime(path), usegmt=True)}
+  if headers.get("If-None-Match") == validators["ETag"]:
+    return 304, validators, None
+  body = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+  body.write(data)
+  body.seek(0)
+  return 200, validators, body
+
+# Make one GET request over a pooled connection, following redirects. Returns the
+# status code, the response's validator headers and, for a 200, the body: a spooled
+# file for a local file, or for a download a function that downloads it into a
+# StreamBody (then gives the connection back to the pool) and the StreamBody itself
+def request(pool, url, headers, timeout):
+  for hop in range(len(REDIRECTS) + 1):
+    parts = urlparse.urlsplit(url)
+    if parts.scheme == "file":
+      return read_file(url, headers)
+    key = (parts.scheme, parts.netloc)
+    connection = take_connection(pool, key, timeout)
+    try:
+      connection.request("GET", (parts.path or "/") + ("?" + parts.query if parts.query else ""), headers=dict(headers, **{"Accept-Encoding": "gzip"}))
+      response = connection.getresponse()
+      if response.status != 200:
+        response.read()
+    except:
+      connection.close()
+      raise
+    validators = {"ETag": response.getheader("ETag"), "Last-Modified": response.getheader("Last-Modified")}
+    if response.status == 200:
+      return 200, validators, stream_response(pool, key, connection, response)
+    release_connection(pool, key, connection, response)
+    if response.status in REDIRECTS and response.getheader("Location"):
+      url = urlparse.urljoin(url, response.getheader("Location"))
+      continue
+    return response.status, validators, None
+  return 310, {}, None
+
+# Give a connection back to the pool once its response has been read, unless the
+# server is closing it
+def release_connection(pool, key, connection, response):
+  if response.getheader("Connection", "").lower() == "close" or response.version == 10:
+    connection.close()
+  else:
+    give_connection(pool, key, connection)
+
+# The StreamBody of a 200 response, and the function that downloads it (returning
+# None, or the error that broke the download off)
+def stream_response(pool, key, connection, response):
+  body = StreamBody()
+  def download():
+    try:
+      pump_body(response, body)
+    except (socket.error, httplib.HTTPException, IOError, zlib.error) as e:
+      connection.close()
+      return "{0}: {1}".format(e.__class__.__name__, e)
+    release_connection(pool, key, connection, response)
+    return None
+  return download, body
+
+# Fetch one source, retrying connection errors and 5xx/429 responses up to 'retries'
+# times, waiting backoff, 2 * backoff, 4 * backoff... seconds in between (a local file
+# that cannot be read is not retried). Returns its status record: "ok" (with "body"),
+# "not modified" or "failed" (with "error"), and for a download the function that
+# downloads its body (see stream_response()), or None
+def fetch(pool, url, headers, timeout, retries, backoff):
+  status = {"url": url, "attempts": 0, "code": None, "error": None, "etag": None, "last_modified": None, "bytes": 0}
+  started = time.time()
+  local = urlparse.urlsplit(url).scheme == "file"
+  download = None
+  while True:
+    status["attempts"] += 1
+    try:
+      code, validators, body = request(pool, url, headers, timeout)
+      status["code"] = code
+      status["error"] = None if code in [200, 304] else "HTTP {0}".format(code)
+    except (socket.error, httplib.HTTPException, IOError, OSError) as e:
+      code, validators, body = None, {}, None
+      status["error"] = "{0}: {1}".format(e.__class__.__name__, e)
+    if code == 200 or code == 304 or (code is not None and code < 500 and code != 429) or local or status["attempts"] > retries:
+      break
+    time.sleep(backoff * 2 ** (status["attempts"] - 1))
+  status["seconds"] = round(time.time() - started, 3)
+  status["etag"], status["last_modified"] = validators.get("ETag"), validators.get("Last-Modified")
+  if code == 200 and local:
+    status["state"] = "ok"
+    status["body"] = body
+    body.seek(0, os.SEEK_END)
+    status["bytes"] = body.tell()
+    body.seek(0)
+  elif code == 200:
+    status["state"] = "ok"
+    download, status["body"] = body
+
+    # The status is complete ("bytes" and "seconds" included) before the body is, so
+    # it is up to date by the time the reader reaches the end
+    def download_body():
+      error = download()
+      status["bytes"] = status["body"].written
+      status["seconds"] = round(time.time() - started, 3)
+      if error is not None:
+        status["state"], status["error"] = "failed", error
+      status["body"].finish(error)
+    return status, download_body
+  elif code == 304:
+    status["state"] = "not modified"
+  else:
+    status["state"] = "failed"
+  return status, download
+
+# Status record of a source already in hand, called 'name': an open file (such as
+# sys.stdin), read to the end, or rows in memory, written out as CSV. Rows are lists
+# (the first one the header) or dicts of column: value, with the columns in sorted order
+def local_status(name, source):
+  started = time.time()
+  body = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+  if hasattr(source, "read"):
+    while True:
+      block = source.read(64 * 1024)
+      if not block:
+        break
+      body.write(block)
+  else:
+    writer = csv.writer(body)
+    columns = None
+    for row in source:
+      if isinstance(row, dict):
+        if columns is None:
+          columns = sorted(row)
+          writer.writerow(columns)
+        row = [row.get(column, "") for column in columns]
+      writer.writerow([value.encode("utf-8") if isinstance(value, unicode) else value for value in row])
+  size = body.tell()
+  body.seek(0)
+  etag = '"{0}"'.format(hashlib.sha1(body.read()).hexdigest())
+  body.seek(0)
+  return {"url": name, "attempts": 1, "code": 200, "error": None, "etag": etag, "last_modified": None, "bytes": size,
+    "seconds": round(time.time() - started, 3), "state": "ok", "body": body}
+
+# Fetch every URL in 'urls' with up to 'workers' downloads at a time, each sent with
+# the headers 'headers_for(url)' returns. Returns the status records in the order of
+# 'urls' once every URL has answered; the bodies are still downloading (see StreamBody)
+def fetch_all(urls, headers_for, workers, timeout, retries, backoff):
+  pool = new_pool()
+  results = [None] * len(urls)
+  pending = list(enumerate(urls))
+  lock = threading.Lock()
+  answered = threading.Semaphore(0)
+
+  def work():
+    while True:
+      with lock:
+        if not pending:
+          return
+        position, url = pending.pop(0)
+      try:
+        results[position], download = fetch(pool, url, headers_for(url), timeout, retries, backoff)
+      finally:
+        answered.release()
+      if download is not None:
+        download()
+
+  threads = [threading.Thread(target=work) for i in range(max(1, min(workers, len(urls))))]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+  for url in urls:
+    answered.acquire()
+
+  # The connections are closed once the last body has downloaded
+  def finish():
+    for thread in threads:
+      thread.join()
+    close_pool(pool)
+  closer = threading.Thread(target=finish)
+  closer.daemon = True
+  closer.start()
+  return results
@@ -0,0 +1,119 @@
+# Density heatmaps for csv2js.py
+#
+# For subcategories with many markers, the page can show a density image at low
+# zoom levels in place of thousands of markers. For each zoom level, this counts
+# the markers visible in a year on a grid of small cells covering the map bounds.
+# It spreads each count over its neighbours with a Gaussian kernel, then colours
+# the result (transparent where there is nothing, then blue through red). A marker
+# is visible in the years the page's year index shows it (see date_span() in
+# pipeline.py). A new image is only made for the years in which a marker enters or
+# leaves the map.
+#
+# Needs NumPy; 'numpy' is None if it is not installed, and pipeline.py then leaves
+# the heatmaps out.
+
+import math
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# ./clusters.py, Web Mercator projection
+from clusters import mercator, unmercator
+
+# ./sprites.py, PNG writing
+from sprites import png_data
+
+
+# Colour ramp: (density, relative to the densest cell at that zoom in any year, [red, green, blue])
+RAMP = [(0.0, [0, 0, 255]), (0.4, [0, 0, 255]), (0.6, [0, 255, 255]), (0.7, [0, 255, 0]), (0.8, [255, 255, 0]), (1.0, [255, 0, 0])]
+
+# Densities below this (relative to the densest cell) are left transparent
+THRESHOLD = 0.02
+
+# Shades of the ramp the images are drawn in
+LEVELS = 64
+
+
+# Grid of 'cell' pixel cells covering 'bounds' ([[south, west], [north, east]]) at
+# zoom 'z': its top left corner in world pixels, its size in cells and the bounds it
+# actually covers (a little more than 'bounds', to a whole number of cells)
+def raster_grid(bounds, z, cell):
+  (south, west), (north, east) = bounds
+  size = 256.0 * 2 ** z
+  left, top = mercator(west, north)
+  right, bottom = mercator(east, south)
+  columns = int(math.ceil((right - left) * size / cell))
+  rows = int(math.ceil((bottom - top) * size / cell))
+  grid_east, grid_south = unmercator(left + columns * cell / size, top + rows * cell / size)
+  return left * size, top * size, columns, rows, [[grid_south, west], [north, grid_east]]
+
+# Gaussian kernel of standard deviation 'sigma' cells, cut off at three standard deviations
+def kernel(sigma):
+  radius = int(3 * sigma)
+  weights = numpy.exp(-numpy.arange(-radius, radius + 1) ** 2 / (2.0 * sigma ** 2))
+  return numpy.outer(weights, weights)
+
+# Palette of the heatmaps: LEVELS colours along RAMP, the first transparent
+def heat_palette():
+  palette = [[0, 0, 0, 0]]
+  for level in range(1, LEVELS):
+    relative = float(level) / (LEVELS - 1)
+    colour = [int(numpy.interp(relative, [stop for stop, colour in RAMP], [colour[channel] for stop, colour in RAMP])) for channel in range(3)]
+    palette.append(colour + [int(min(relative * 2.5, 1) * 204)])
+  return palette
+
+# PNG of a density grid, coloured with 'palette' relative to 'peak'. The image is a
+# palette one, a byte per pixel, with no scanline filters (as the PNG spec advises)
+def density_png(density, peak, palette):
+  relative = density / peak
+  levels = numpy.where(relative < THRESHOLD, 0, numpy.clip(numpy.rint(relative * (LEVELS - 1)), 1, LEVELS - 1)).astype(numpy.uint8)
+  lines = numpy.zeros((levels.shape[0], levels.shape[1] + 1), numpy.uint8)
+  lines[:, 1:] = levels
+  return png_data(density.shape[1], density.shape[0], lines.tobytes(), palette)
+
+# Density images of markers at 'points' (lon/lat pairs) visible in the year spans
+# 'spans' ((start year, end year or None if open-ended) pairs), at zoom 'z'. Each
+# marker is spread over 'radius' screen pixels, on a grid of 'cell' pixel cells.
+# Returns the bounds the images cover, and [year, PNG or None if nothing is visible]
+# for each year that differs from the one before.
+#
+# Rather than spreading every visible marker again for each year, the density of a
+# year is the one before plus the kernels of the markers that appear in it, less
+# those of the markers that disappear
+def density_images(points, spans, bounds, z, cell, radius):
+  left, top, columns, rows, grid_bounds = raster_grid(bounds, z, cell)
+  size = 256.0 * 2 ** z
+  spread = kernel(float(radius) / cell)
+  reach = spread.shape[0] // 2
+  appear, disappear = {}, {}
+  for (lon, lat), (syear, eyear) in zip(points, spans):
+    x, y = mercator(lon + 360 if lon < bounds[0][1] else lon, lat)
+    column, row = int(math.floor((x * size - left) / cell)), int(math.floor((y * size - top) / cell))
+    if column < 0 or column >= columns or row < 0 or row >= rows or (eyear is not None and eyear < syear):
+      continue
+    appear.setdefault(syear, []).append((row, column))
+    if eyear is not None:
+      disappear.setdefault(eyear + 1, []).append((row, column))
+  years = sorted(set(appear) | set(disappear))
+
+  # Yields each year with its density grid (the same array, updated), or None if no marker is visible
+  def densities():
+    grid, visible = numpy.zeros((rows, columns)), 0
+    for year in years:
+      for sign, cells in [(1, appear.get(year, [])), (-1, disappear.get(year, []))]:
+        for row, column in cells:
+          top_row, left_column = max(row - reach, 0), max(column - reach, 0)
+          bottom_row, right_column = min(row + reach + 1, rows), min(column + reach + 1, columns)
+          grid[top_row:bottom_row, left_column:right_column] += sign * spread[top_row - row + reach:bottom_row - row + reach, left_column - column + reach:right_column - column + reach]
+        visible += sign * len(cells)
+      yield year, grid if visible > 0 else None
+
+  # Every year's image is coloured against the densest cell of any year, so years compare
+  peak = max([grid.max() for year, grid in densities() if grid is not None] or [0])
+  palette = heat_palette()
+  images = []
+  for year, grid in densities():
+    images.append([int(year), density_png(grid, peak, palette) if grid is not None and peak > 0 else None])
+  return grid_bounds, images
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+# Basemap mirror for csv2js.py
+#
+# Reads the Map rows of the same sheets csv2js.py builds from, downloads every tile
+# of each row's tileset from settings.min_zoom to settings.max_zoom inside
+# settings.map_bounds, and stores them in one MBTiles (SQLite) file per basemap in
+# tiles/. Tiles are stored once per distinct image, so the many identical ocean
+# tiles take the space of one. Then it serves the tiles itself, so visitors never
+# depend on the original hosts: set settings.tile_mirror to the server's address and
+# csv2js.py points the basemaps' L.tileLayer URLs at it.
+#
+# Usage: python mirror.py fetch [sheet ...] [--workers 8] [--refresh]
+#        python mirror.py serve [--port 8000]
+#
+# The mirror's URLs and the tiles it covers are worked out in tiles.py, which
+# csv2js.py uses too; the functions here are given the settings to use.
+
+import sys
+sys.dont_write_bytecode = True
+import argparse
+import BaseHTTPServer
+import csv
+import hashlib
+import os
+import re
+import sqlite3
+import SocketServer
+
+# ./fetch.py, downloads the source sheets (and here, tiles)
+from fetch import source_url, fetch_all
+
+# ./tiles.py, Web Mercator tile maths, and the mirror's tilesets and URLs
+from tiles import basemap_name, tile_format, covering_tiles, tile_url
+
+
+# Tiles downloaded and stored at a time
+BATCH_SIZE = 256
+
+CONTENT_TYPES = {"png": "image/png", "jpg": "image/jpeg", "jpeg": "image/jpeg"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT, PRIMARY KEY (zoom_level, tile_column, tile_row));
+CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB);
+CREATE VIEW IF NOT EXISTS tiles AS SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, map.tile_row AS tile_row, images.tile_data AS tile_data FROM map JOIN images ON images.tile_id = map.tile_id;
+"""
+
+
+# Open (creating if need be) the MBTiles file at 'path' for the basemap of Map row 'row'
+def open_tileset(path, row, settings):
+  connection = sqlite3.connect(path)
+  connection.executescript(SCHEMA)
+  (south, west), (north, east) = settings.map_bounds
+  metadata = {"name": row["Title"], "type": "baselayer", "version": "1.1", "description": row["URL"], "format": tile_format(row["URL"]),
+    "minzoom": str(settings.min_zoom), "maxzoom": str(settings.max_zoom), "bounds": "{0},{1},{2},{3}".format(west, south, min(east, 180), north)}
+  connection.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)", sorted(metadata.items()))
+  connection.commit()
+  return connection
+
+# Download the Map rows of the sheets in 'sources'. Raises IOError if a sheet cannot be fetched
+def map_rows(sources, settings):
+  fetched = fetch_all([source_url(source) for source in sources], lambda url: {}, settings.fetch_workers, settings.fetch_timeout, settings.fetch_retries, settings.fetch_backoff)
+  rows = []
+  try:
+    for status in fetched:
+      if status["state"] != "ok":
+        raise IOError("Could not fetch {0}: {1}".format(status["url"], status["error"]))
+      # Reading the body raises IOError if its download breaks off part way through
+      try:
+        for row in csv.DictReader(status["body"]):
+          if row["Type"] == "Map" and row["URL"] != "" and row["Title"] != "" and row["Start Year"] != "" and row["End Year"] != "":
+            rows.append(row)
+      except IOError as e:
+        raise IOError("Could not fetch {0}: {1}".format(status["url"], e))
+  finally:
+    for status in fetched:
+      if "body" in status:
+        status["body"].close()
+  return rows
+
+# Mirror the tileset of Map row 'row' into the MBTiles file at 'path', downloading up
+# to 'workers' tiles at a time, and only tiles not already stored unless 'refresh'.
+# Returns counts of the tiles stored, missing at the origin (404) and failed
+def mirror_tileset(row, path, workers, refresh, settings):
+  connection = open_tileset(path, row, settings)
+  stored = set(connection.execute("SELECT zoom_level, tile_column, tile_row FROM map"))
+  pending = [tile for tile in covering_tiles(settings.map_bounds, settings.min_zoom, settings.max_zoom) if refresh or not tile in stored]
+  counts = {"stored": 0, "missing": 0, "failed": 0}
+  for start in range(0, len(pending), BATCH_SIZE):
+    batch = pending[start:start + BATCH_SIZE]
+    results = fetch_all([tile_url(row["URL"], *tile) for tile in batch], lambda url: {}, workers, settings.fetch_timeout, settings.fetch_retries, settings.fetch_backoff)
+    for (z, x, tile_row), status in zip(batch, results):
+      # Read each downloaded tile whole; a download that breaks off part way through
+      # raises IOError, and the tile counts as failed
+      data = None
+      if status["state"] == "ok":
+        try:
+          data = status["body"].read()
+        except IOError:
+          pass
+        status["body"].close()
+      if data is not None:
+        tile_id = hashlib.sha1(data).hexdigest()
+        connection.execute("INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)", (tile_id, sqlite3.Binary(data)))
+        connection.execute("INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)", (z, x, tile_row, tile_id))
+        counts["stored"] += 1
+      elif status["code"] == 404:
+        counts["missing"] += 1
+      else:
+        counts["failed"] += 1
+    connection.commit()
+    print "  {0}/{1} tiles".format(start + len(batch), len(pending))
+  # Images no tile refers to any more (after a refresh)
+  connection.execute("DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)")
+  connection.commit()
+  counts["images"] = connection.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+  counts["tiles"] = connection.execute("SELECT COUNT(*) FROM map").fetchone()[0]
+  connection.close()
+  return counts
+
+
+# Serves GET /<basemap>/<z>/<x>/<y>.<format> from tiles/<basemap>.mbtiles, with {y}
+# the TMS row (as the generated L.tileLayer, with 'tms: true', asks for it)
+class TileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  folder = "tiles"
+
+  def do_GET(self):
+    found = re.match(r"^/(\w+)/(\d+)/(\d+)/(\d+)(\.\w+)?$", self.path.split("?")[0])
+    path = found and os.path.join(self.folder, found.group(1) + ".mbtiles")
+    if not found or not os.path.exists(path):
+      self.send_error(404)
+      return
+    connection = sqlite3.connect(path)
+    try:
+      tile = connection.execute("SELECT images.tile_id, images.tile_data FROM map JOIN images ON images.tile_id = map.tile_id WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+        [int(number) for number in found.group(2, 3, 4)]).fetchone()
+      image_format = connection.execute("SELECT value FROM metadata WHERE name = 'format'").fetchone()
+    finally:
+      connection.close()
+    if tile is None:
+      self.send_error(404)
+      return
+    etag = '"{0}"'.format(tile[0])
+    if self.headers.getheader("If-None-Match") == etag:
+      self.send_response(304)
+      self.send_header("ETag", etag)
+      self.end_headers()
+      return
+    self.send_response(200)
+    self.send_header("Content-Type", CONTENT_TYPES.get(image_format[0] if image_format else "png", "application/octet-stream"))
+    self.send_header("Content-Length", str(len(tile[1])))
+    self.send_header("Cache-Control", "public, max-age=604800")
+    self.send_header("ETag", etag)
+    self.send_header("Access-Control-Allow-Origin", "*")
+    self.end_headers()
+    self.wfile.write(tile[1])
+
+class TileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+if __name__ == "__main__":
+  # ./settings.py, controls various script options
+  import settings
+
+  parser = argparse.ArgumentParser(description="Mirror the spreadsheet's basemaps into MBTiles files and serve them.")
+  parser.add_argument("--folder", default="tiles", help="folder the MBTiles files are kept in")
+  commands = parser.add_subparsers(dest="command")
+  fetch_command = commands.add_parser("fetch", help="download every basemap's tiles within the map bounds")
+  fetch_command.add_argument("sheet", nargs="*", help="URLs or local CSV files to read instead of settings.sources")
+  fetch_command.add_argument("--workers", type=int, default=8, help="tiles downloaded at once")
+  fetch_command.add_argument("--refresh", action="store_true", help="download tiles again even if they are already stored")
+  serve_command = commands.add_parser("serve", help="serve the mirrored tiles over HTTP")
+  serve_command.add_argument("--host", default="", help="address to listen on (all by default)")
+  serve_command.add_argument("--port", type=int, default=8000, help="port to listen on")
+  args = parser.parse_args()
+
+  if args.command == "fetch":
+    if not os.path.exists(args.folder):
+      os.mkdir(args.folder)
+    try:
+      rows = map_rows(args.sheet or settings.sources, settings)
+    except IOError as e:
+      print "\033[91m{0}\033[0m".format(e)
+      sys.exit(1)
+    for row in rows:
+      path = os.path.join(args.folder, basemap_name(row["Title"]) + ".mbtiles")
+      print "Mirroring '{0}' into {1}".format(row["Title"], path)
+      counts = mirror_tileset(row, path, args.workers, args.refresh, settings)
+      print "\033[92m{0} tiles stored ({1} distinct images), {2} missing at the origin, {3} failed\033[0m".format(counts["tiles"], counts["images"], counts["missing"], counts["failed"])
+  else:
+    TileHandler.folder = args.folder
+    server = TileServer((args.host, args.port), TileHandler)
+    print "Serving the tiles in {0} on port {1} (Ctrl-C to stop)".format(args.folder, args.port)
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
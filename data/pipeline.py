@@ -0,0 +1,1970 @@
+# Build pipeline for csv2js.py
+#
+# Turns the project spreadsheet into the page's data.js, style.js and data chunks in
+# four stages, each a function that can be called on its own, by csv2js.py (which only
+# reads the command line) or by any other script, such as a test or a benchmark that
+# keeps one process running between builds:
+#
+#   fetch_sources()  downloads or reads the source sheets: (gdoc_id, gid) tabs, URLs,
+#                    local CSV files, open files (such as sys.stdin) or rows in memory
+#   parse_sheet()    reads their rows, as one sheet, into map, marker and shape records
+#   build_model()    checks the shapes and works out the layers, data chunks, tiles and
+#                    heatmaps the page is made of
+#   emit()           writes the scripts, style and chunks to a sink: a folder
+#                    (FolderSink), paths of your choosing (FileSink) or memory (MemorySink)
+#
+# Each stage takes the settings to build with (the settings module, or any object with
+# the same names), and optionally a report to time it in (see report.py). The parsed
+# sheet and the model can be kept and built from again. run_build() puts the stages
+# together the way csv2js.py publishes a build: only when the sheet, the settings or the
+# code have changed, atomically (see publish.py) and keeping a backup (see
+# backup_store.py); run_targets() publishes to several deployments at once, fetching and
+# parsing each sheet once for all of them. To build a sheet into memory, for instance:
+#
+#   import pipeline, settings
+#   sheet = pipeline.parse_sheet(pipeline.fetch_sources(["sheet.csv"], settings))
+#   sink = pipeline.MemorySink()
+#   pipeline.emit(pipeline.build_model(sheet, settings), sink, settings)
+#   sink.files["data.js"]
+
+import base64
+import csv
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import re
+import shutil
+import StringIO
+import tempfile
+import time
+from collections import OrderedDict
+
+# ./topology.py, simplifies and quantizes shape geometry
+from topology import build_topology, topology_js
+
+# ./shapes.py, parses and checks shape GeoJSON
+from shapes import check_cells
+
+# ./fetch.py, downloads the source sheets
+from fetch import source_url, fetch_all, local_status
+
+# ./report.py, times the build's stages for --report
+from report import new_report, enter_stage, count_row, record_outputs
+
+# ./clusters.py, precomputes marker clusters for each zoom level
+from clusters import build_clusters
+
+# ./tiles.py, buckets features into a z/x/y tile pyramid (and names mirror.py's tilesets)
+from tiles import bounding_box, bucket_features, mirror_url
+
+# ./publish.py, stages the build's output and publishes it atomically
+from publish import lock_folder, new_staging, write_file, publish, prune_releases
+
+# ./artifacts.py, strips, hashes and precompresses the files the page loads
+from artifacts import prepare_artifacts, prune_artifacts, style_sprite
+
+# ./sprites.py, packs the subcategory icons into one image
+from sprites import read_png, encode_png, pack_sprite
+
+# ./backup_store.py, keeps every published build for rolling back to
+from backup_store import TIME_FORMAT, load_index, add_build, record_build, import_copies, prune, find_build, restore_build, build_size
+
+# ./search.py, builds the search index over the records' text
+from search import STOP_WORDS, build_index
+
+# ./heatmaps.py, draws density heatmaps of the busiest subcategories
+from heatmaps import numpy, density_images
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Icons of the subcategories, named after them
+IMAGES = os.path.join(HERE, "..", "images")
+
+# Modules whose code decides what a build writes
+GENERATORS = ["pipeline.py", "topology.py", "clusters.py", "tiles.py", "shapes.py", "artifacts.py", "sprites.py", "search.py", "heatmaps.py"]
+
+
+# Where emit() writes a build. A sink's open(name) returns a file to write the output
+# called 'name' ("data.js", "chunks/<chunk>.js"...) to, closed once it is written.
+#
+# FolderSink writes the outputs into 'folder' (as csv2js.py does, into its staging folder)
+class FolderSink(object):
+  def __init__(self, folder):
+    self.folder = folder
+
+  def open(self, name):
+    path = os.path.join(self.folder, name)
+    if not os.path.exists(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    return open(path, "wb")
+
+# FileSink writes the outputs named in 'paths' (name: path) to those paths, and the rest
+# into 'folder', or nowhere if there is no folder
+class FileSink(FolderSink):
+  def __init__(self, paths, folder=None):
+    FolderSink.__init__(self, folder)
+    self.paths = paths
+
+  def open(self, name):
+    if name in self.paths:
+      return open(self.paths[name], "wb")
+    if self.folder is None:
+      return open(os.devnull, "wb")
+    return FolderSink.open(self, name)
+
+# MemorySink keeps the outputs as strings in 'files', by name, as each one is closed
+class MemorySink(object):
+  def __init__(self):
+    self.files = OrderedDict()
+
+  def open(self, name):
+    return MemoryFile(self.files, name)
+
+class MemoryFile(StringIO.StringIO):
+  def __init__(self, files, name):
+    StringIO.StringIO.__init__(self)
+    self.files = files
+    self.name = name
+
+  def close(self):
+    if not self.closed:
+      self.files[self.name] = self.getvalue()
+    StringIO.StringIO.close(self)
+
+# Work out when a record is visible on the timeline, as the year index (see
+# index_feature()) shows it: "start" records stay on from their start year onwards,
+# "iso" records only appear in their start year and "range" records appear from
+# their start year through their end year (returned end year is None if open-ended)
+def date_span(record):
+  syear = int(record["syear"])
+  if record["eyear"] == "":
+    return "start", syear, None
+  eyear = int(record["eyear"])
+  if eyear == syear:
+    return "iso", syear, syear
+  return "range", syear, eyear
+
+# Why a record's years cannot be placed on the timeline, or None if they can: its start
+# year, and its end year if it has one, must be whole numbers
+def year_error(record):
+  for key, column in [("syear", "Start Year"), ("eyear", "End Year")]:
+    if record[key] != "":
+      try:
+        int(record[key])
+      except ValueError:
+        return "{0} '{1}' is not a year".format(column, record[key])
+  return None
+
+# Why a marker's position cannot be placed on the map, or None if it can: its latitude
+# and longitude must be finite numbers
+def coordinate_error(record):
+  for key, name in [("lat", "latitude"), ("lon", "longitude")]:
+    try:
+      value = float(record[key])
+    except ValueError:
+      value = None
+    if value is None or math.isnan(value) or math.isinf(value):
+      return "{0} '{1}' is not a number".format(name, record[key])
+  return None
+
+# Add 'record' to 'records', unless 'error' says why it cannot be built, in which case
+# it is skipped (as shapes with broken GeoJSON are, see build_model()). Returns whether
+# it was added
+def keep_record(records, record, kind, error):
+  if error is not None:
+    print "\033[91mSkipping {0} '{1}': {2}\033[0m".format(kind, record["title"], error)
+    return False
+  records.append(record)
+  return True
+
+# Record a feature in the year index of its subcategory: the id is listed under
+# the year it enters the map and under the year after its last visible year
+def index_feature(year_index, subcat, feature_id, record):
+  date_type, syear, eyear = date_span(record)
+  if eyear is not None and eyear < syear:
+    return
+  if not subcat in year_index:
+    year_index[subcat] = {"enter": {}, "exit": {}}
+  year_index[subcat]["enter"].setdefault(syear, []).append(feature_id)
+  if eyear is not None:
+    year_index[subcat]["exit"].setdefault(eyear + 1, []).append(feature_id)
+
+# Build the HTML pop-up displaying a marker or shape record's metadata
+def popup_text(record):
+  title = "<p><b><u>{0}</u></b>".format(record["title"])
+  if record["drange"] != "":
+    year_range = "<br/><b>Years:</b> {0}".format(record["drange"])
+  elif record["eyear"] != "":
+    year_range = "<br/><b>Years:</b> {0} - {1}".format(record["syear"], record["eyear"])
+  else:
+    year_range = "<br /><b>Year:</b> {0}".format(record["syear"])
+
+  if record["desc"] != "":
+    desc = "<br/><b>Description:</b> {0}".format(record["desc"])
+  else:
+    desc = "<br/><b>Description:</b> "
+
+  if record["hist-loc"] != "":
+    hist_loc = "<br/><b>Historic Location:</b> {0}".format(record["hist-loc"])
+  else:
+    hist_loc = "<br/><b>Historic Location:</b> "
+
+  if record["pres-loc"] != "":
+    pres_loc = "<br/><b>Present Location:</b> {0}".format(record["pres-loc"])
+  else:
+    pres_loc = "<br/><b>Present Location:</b> "
+
+  if record["src"] != "" and record["url"] != "":
+    src = "<br/><b>Source:</b> <a href='{0}'>{1}</a>".format(record["url"], record["src"])
+  elif record["src"] != "" and record["url"] == "":
+    src = "<br/><b>Source:</b> {1}".format(record["url"], record["src"])
+  else:
+    src = "<br/><Source:</b> "
+
+  return "\"" + title + year_range + desc + hist_loc + pres_loc + src + "</p>\""
+
+# Build everything in a marker's GeoJSON feature between its id and its pop-up
+def marker_fragment(record):
+  if record["eyear"] == "":
+    date_type = "start"
+    date = "[{0}]".format(record["syear"])
+  else:
+    if record["eyear"] == record["syear"]:
+      date_type = "iso"
+      date = "[{0}]".format(record["syear"])
+    else:
+      date_type = "range"
+      date = "[{0},{1}]".format(record["syear"], record["eyear"])
+
+  return "date_type:\"{0}\",date:{1},geometry:{{type:\"Point\",coordinates:[{2},{3}]}},".format(date_type, date, record["lon"], record["lat"])
+
+# Add a string to a pop-up block's table of strings, returning its position there
+def intern_string(value, strings, string_ids):
+  if not value in string_ids:
+    string_ids[value] = len(strings)
+    strings.append(value)
+  return string_ids[value]
+
+# Build the raw fields of a record's pop-up for the pop-up store, with the strings
+# that repeat across records (date ranges, locations, sources) interned in 'strings'
+def popup_row(record, strings, string_ids):
+  row = [record["title"], intern_string(record["drange"], strings, string_ids), record["syear"], record["eyear"], record["desc"]]
+  for key in ["hist-loc", "pres-loc", "src", "url"]:
+    row.append(intern_string(record[key], strings, string_ids))
+  return row
+
+# Write out a block of the pop-up store to the chunks in 'sink', to be fetched the first time one of its pop-ups opens
+def write_popup_block(sink, block, strings, rows):
+  block_output = sink.open("chunks/{0}.json".format(block))
+  json.dump({"strings": strings, "rows": rows}, block_output, separators=(",", ":"), sort_keys=True)
+  block_output.close()
+
+
+# Turn a category/subcategory name into the identifier used for its JS vars and icon
+def js_name(name):
+  return re.sub(r"\W", "", name)
+
+# Split the years the map rows cover into runs that each show one basemap (where rows
+# overlap, the later row wins), returning [first year, last year, map row] in year order
+def basemap_eras(maps):
+  bounds = sorted(set([int(m["syear"]) for m in maps] + [int(m["eyear"]) + 1 for m in maps]))
+  eras = []
+  for start, stop in zip(bounds, bounds[1:]):
+    covering = [index for index, m in enumerate(maps) if int(m["syear"]) <= start <= int(m["eyear"])]
+    if not covering:
+      continue
+    if eras and eras[-1][2] == covering[-1] and eras[-1][1] == start - 1:
+      eras[-1][1] = stop - 1
+    else:
+      eras.append([start, stop - 1, covering[-1]])
+  return eras
+
+# Pass lines through unchanged while adding each one to the running 'digest'
+def hash_lines(lines, digest):
+  for line in lines:
+    digest.update(line)
+    yield line
+
+# Pass lines through unchanged while writing a copy of each one, after the first 'skip', to 'copy'
+def tee_lines(lines, copy, skip=0):
+  for number, line in enumerate(lines):
+    if number >= skip:
+      copy.write(line)
+    yield line
+
+# Read the rows of every downloaded source in turn, as they arrive, adding each
+# source's URL and lines to the running 'digest' and, if 'copy' is given, writing the
+# lines to it (with only the first source's header row, so the copy reads as one sheet)
+def source_rows(fetched, digest, copy):
+  for position, status in enumerate(fetched):
+    digest.update(status["url"])
+    lines = hash_lines(status["body"], digest)
+    if copy is not None:
+      lines = tee_lines(lines, copy, 1 if position > 0 else 0)
+    for row in csv.DictReader(lines, delimiter=','):
+      yield row
+    print_status(status)
+
+# Say how the download of a source went
+def print_status(status):
+  if status["state"] == "ok":
+    print "Fetched {0} ({1} bytes, {2} attempt(s), {3}s)".format(status["url"], status["bytes"], status["attempts"], status["seconds"])
+  elif status["state"] == "failed":
+    print "\033[91mCould not fetch {0} after {1} attempt(s): {2}\033[0m".format(status["url"], status["attempts"], status["error"])
+
+# Bounding box of a record: its position for a marker, its GeoJSON's extent for a shape
+# (worked out when the shape was checked)
+def record_box(record, kind):
+  if kind == "markers":
+    return bounding_box([(float(record["lon"]), float(record["lat"]))])
+  return record["box"]
+
+# Write the features 'ids' of a data chunk to 'output', followed by the chunk's year
+# index and the call registering it with the page. 'popups' holds each record's pop-up
+# (by index into 'records') and 'levels' the chunk's marker clusters, if precomputed
+def write_chunk(output, subcat, name, kind, records, ids, popups, levels, settings):
+  chunk_index = {}
+  if kind == "markers" and settings.columnar_markers == True:
+    # Markers as parallel arrays: ids, quantized coordinates and start years are
+    # stored as the difference from the previous marker, date_type as 0/1/2
+    # (start/iso/range) and end years as the number of years after the start
+    scale = 10 ** settings.coord_precision
+    columns = {"id": [], "lon": [], "lat": [], "start": [], "type": [], "span": [], "pop": [popups[index] for index in ids]}
+    last = {"id": 0, "lon": 0, "lat": 0, "start": 0}
+    for index in ids:
+      marker = records[index]
+      index_feature(chunk_index, name, str(index), marker)
+      date_type, syear, eyear = date_span(marker)
+      values = {"id": index, "lon": int(round(float(marker["lon"]) * scale)), "lat": int(round(float(marker["lat"]) * scale)), "start": syear}
+      for key in last:
+        columns[key].append(str(values[key] - last[key]))
+        last[key] = values[key]
+      columns["type"].append(str(["start", "iso", "range"].index(date_type)))
+      columns["span"].append(str(eyear - syear if eyear is not None else 0))
+    output.write("var {0}=decodeColumns({{scale:{1},".format(subcat, scale))
+    output.write(",".join("{0}:[{1}]".format(key, ",".join(columns[key])) for key in ["id", "lon", "lat", "start", "type", "span", "pop"]))
+    output.write("});\n")
+  elif kind == "markers":
+    pop_key = "pop" if settings.popup_store == True else "pop_text"
+    output.write("var {0}={{type:\"FeatureCollection\",features:[".format(subcat))
+    for index in ids:
+      marker = records[index]
+      index_feature(chunk_index, name, str(index), marker)
+      output.write("{{type:\"Feature\",id:\"{0}\",".format(index) + marker_fragment(marker))
+      output.write("{0}:{1}}},".format(pop_key, popups[index]))
+    output.write("]};\n")
+  else:
+    # Shapes either carry their GeoJSON as pasted, or are drawn per zoom level from
+    # the chunk's simplified, quantized topology (see topology.py)
+    if settings.simplify_shapes == True:
+      topology = build_topology(dict(("shape{0}".format(index), json.loads(records[index]["json"])) for index in ids), settings.shape_quantization, settings.min_zoom, settings.max_zoom, settings.shape_tolerance)
+    for index in ids:
+      shape = records[index]
+      if settings.simplify_shapes == True:
+        output.write("var shape{0} = L.geoJson(null, {{ style: {1}ShapeStyle }}); ".format(index, subcat))
+      else:
+        output.write("var json{0} = {1}; ".format(index, shape["json"]))
+        output.write("var shape{0} = L.geoJson(json{1}, {{ style: {2}ShapeStyle }}); ".format(index, index, subcat))
+      if settings.popup_store == True:
+        output.write("bindStoredPopup(shape{0}, \"{1}\", {2});\n".format(index, name, popups[index]))
+      else:
+        output.write("shape{0}.bindPopup({1});\n".format(index, popups[index]))
+      index_feature(chunk_index, name, "shape{0}".format(index), shape)
+
+  # Year index for the chunk, years in ascending order
+  chunk_index.setdefault(name, {"enter": {0: []}, "exit": {}})
+  index_js = "{enter: {"
+  index_js += ",".join("{0}:[{1}]".format(year, ",".join("\"{0}\"".format(i) for i in feature_ids)) for year, feature_ids in sorted(chunk_index[name]["enter"].items()))
+  index_js += "}, exit: {"
+  index_js += ",".join("{0}:[{1}]".format(year, ",".join("\"{0}\"".format(i) for i in feature_ids)) for year, feature_ids in sorted(chunk_index[name]["exit"].items()))
+  index_js += "}}, first: {0}}}".format(min(chunk_index[name]["enter"]))
+
+  if kind == "markers" and levels is not None:
+    # Per zoom, the clusters ('c') the chunk's markers belong to, their centres and
+    # each marker's cluster (in chunk order)
+    clusters_js = []
+    for z in sorted(levels):
+      member = [levels[z]["member"][index] for index in ids]
+      used = sorted(set(member))
+      clusters_js.append("{0}:{{c:[{1}],lon:[{2}],lat:[{3}],member:[{4}]}}".format(z,
+        ",".join(str(c) for c in used),
+        ",".join(str(round(levels[z]["lon"][c], settings.coord_precision)) for c in used),
+        ",".join(str(round(levels[z]["lat"][c], settings.coord_precision)) for c in used),
+        ",".join(str(c) for c in member)))
+    output.write("registerMarkers(\"{0}\", {1}, {2}, {2}Icon, {{{3}}});\n".format(name, index_js, subcat, ",".join(clusters_js)))
+  elif kind == "markers":
+    output.write("registerMarkers(\"{0}\", {1}, {2}, {2}Icon);\n".format(name, index_js, subcat))
+  else:
+    shapes = ",".join("shape{0}: shape{0}".format(index) for index in ids)
+    if settings.simplify_shapes == True:
+      output.write("registerShapes(\"{0}\", {1}, {{{2}}}, {3});\n".format(name, index_js, shapes, topology_js(topology)))
+    else:
+      output.write("registerShapes(\"{0}\", {1}, {{{2}}});\n".format(name, index_js, shapes))
+
+
+# Fetch every source in 'sources': a (gdoc_id, gid) spreadsheet tab, a URL, a local
+# file's path, an open file (such as sys.stdin) or rows in memory (see local_status()).
+# Tabs, URLs and files are fetched at once, see fetch.py, each request made conditional
+# on the ETag and Last-Modified in 'validators' (by URL) if it has any; if some have
+# changed, those that have not are fetched again in full, as the sheet is read as a
+# whole. Returns the status record of each source, in order, once every source has
+# answered; the bodies are read, by parse_sheet(), as they download
+def fetch_sources(sources, settings, validators=None, report=None):
+  if report is None:
+    report = new_report()
+  validators = validators or {}
+
+  def request_headers(url):
+    headers = {}
+    if validators.get(url, {}).get("etag"):
+      headers["If-None-Match"] = str(validators[url]["etag"])
+    if validators.get(url, {}).get("last_modified"):
+      headers["If-Modified-Since"] = str(validators[url]["last_modified"])
+    return headers
+
+  enter_stage(report, "download")
+  remote = [source_url(source) for source in sources if isinstance(source, (tuple, basestring))]
+  downloads = fetch_all(remote, request_headers, settings.fetch_workers, settings.fetch_timeout, settings.fetch_retries, settings.fetch_backoff)
+  fetched = []
+  for position, source in enumerate(sources):
+    if isinstance(source, (tuple, basestring)):
+      fetched.append(downloads.pop(0))
+    else:
+      fetched.append(local_status(getattr(source, "name", "rows:{0}".format(position)), source))
+  report["sources"] = fetched
+  # Unchanged sources still have to be read in full when another source has changed
+  unchanged = [status["url"] for status in fetched if status["state"] == "not modified"]
+  if unchanged and len(unchanged) < len(fetched):
+    refetched = dict(zip(unchanged, fetch_all(unchanged, lambda url: {}, settings.fetch_workers, settings.fetch_timeout, settings.fetch_retries, settings.fetch_backoff)))
+    fetched = [refetched.get(status["url"], status) for status in fetched]
+    report["sources"] = fetched
+  for status in fetched:
+    if status["state"] == "failed":
+      print_status(status)
+  return fetched
+
+# Parse the rows of every fetched source in turn as one sheet, hashing the data as it
+# goes past and, if 'copy' is given, copying each line to it (csv2js.py keeps a copy in
+# 'data.csv', for auditing). Rows missing a required cell are left out, and rows whose
+# years (or, for markers, coordinates) are not numbers are skipped with a warning.
+# Returns the sheet's map, marker and shape records, and the hash of its data. Raises
+# IOError if a download breaks off part way through (see read_sheet())
+def parse_sheet(fetched, copy=None, report=None):
+  if report is None:
+    report = new_report()
+  enter_stage(report, "parse")
+  csv_digest = hashlib.sha1()
+  reader = source_rows(fetched, csv_digest, copy)
+
+  # Initialize empty arrays to hold each metadata record according to record type
+  # (each individual record will be stored as its own hash inside these arrays)
+  map_list = []
+  marker_list = []
+  shape_list = []
+
+  # Sort records by type
+  for line in reader:
+    kept = False
+
+    if line["Type"] == "Map":
+      map_obj = {}
+      map_obj["url"] = line["URL"]
+      map_obj["title"] = line["Title"]
+      map_obj["syear"] = line["Start Year"]
+      map_obj["eyear"] = line["End Year"]
+      if line["URL"] != "" and line["Title"] != "" and line["Start Year"] != "" and line["End Year"] != "":
+        kept = keep_record(map_list, map_obj, "map", year_error(map_obj))
+
+    elif line["Type"] == "Marker":
+      marker_obj = {}
+      if line["Historic Lat"] != "" and line["Historic Lon"] != "":
+        marker_obj["lat"], marker_obj["lon"] = line["Historic Lat"], line["Historic Lon"]
+      else:
+        marker_obj["lat"], marker_obj["lon"] = line["Present Lat"], line["Present Lon"]
+      marker_obj["cat"] = line["Category"]
+      marker_obj["subcat"] = line["Sub Category"]
+      marker_obj["syear"] = line["Start Year"]
+      marker_obj["eyear"] = line["End Year"]
+      marker_obj["drange"] = line["Date Range"]
+      marker_obj["title"] = line["Title"]
+      marker_obj["desc"] = line["Description"]
+      marker_obj["hist-loc"] = line["Historic Location"]
+      marker_obj["pres-loc"] = line["Present Location"]
+      marker_obj["src"] = line["Source"]
+      marker_obj["url"] = line["URL"]
+      if line["Category"] != "" and line["Sub Category"] != "" and line["Start Year"] != "" and line["Title"] != "" and line["Present Lat"] != "" and line["Present Lon"] != "":
+        kept = keep_record(marker_list, marker_obj, "marker", year_error(marker_obj) or coordinate_error(marker_obj))
+
+    elif line["Type"] == "Shape":
+      shape_obj = {}
+      shape_obj["cat"] = line["Category"]
+      shape_obj["subcat"] = line["Sub Category"]
+      shape_obj["title"] = line["Title"]
+      shape_obj["desc"] = line["Description"]
+      shape_obj["syear"] = line["Start Year"]
+      shape_obj["eyear"] = line["End Year"]
+      shape_obj["drange"] = line["Date Range"]
+      shape_obj["hist-loc"] = line["Historic Location"]
+      shape_obj["pres-loc"] = line["Present Location"]
+      shape_obj["json"] = line["GeoJSON"]
+      shape_obj["src"] = line["Source"]
+      shape_obj["url"] = line["URL"]
+      if line["Category"] != "" and line["Sub Category"] != "" and line["Start Year"] != "" and line["Title"] != "" and line["GeoJSON"] != "":
+        kept = keep_record(shape_list, shape_obj, "shape", year_error(shape_obj))
+
+    count_row(report, line["Type"], kept)
+
+  for status in fetched:
+    status["body"].close()
+  return {"maps": map_list, "markers": marker_list, "shapes": shape_list, "digest": csv_digest.hexdigest()}
+
+# parse_sheet(), or None (after saying which) if a download broke off part way through
+def read_sheet(fetched, copy=None, report=None):
+  try:
+    return parse_sheet(fetched, copy, report)
+  except IOError:
+    for status in fetched:
+      status["body"].close()
+    failed = [status for status in fetched if status["state"] == "failed"]
+    if not failed:
+      raise
+    for status in failed:
+      print_status(status)
+    return None
+
+# Hash of shapes.py, which the results of checking shapes are only reused for
+def shape_checker():
+  return hashlib.sha1(open(os.path.join(HERE, "shapes.py")).read()).hexdigest()
+
+# Parse and check the GeoJSON of every shape in 'shape_list', keeping the results in
+# 'cache' (the build cache) by the hash of the cell, for as long as shapes.py is
+# unchanged, so only new or edited cells are checked again; those are spread across
+# 'workers' processes. Returns the hash of each shape's cell, and how many were checked
+def check_shapes(shape_list, workers, cache):
+  checker_hash = shape_checker()
+  shape_cache = {}
+  if cache.get("shape_checker") == checker_hash:
+    shape_cache = cache.get("shapes", {})
+  cell_hashes = [hashlib.sha1(shape["json"]).hexdigest() for shape in shape_list]
+  pending = sorted(set(cell_hash for cell_hash in cell_hashes if not cell_hash in shape_cache))
+  cells = dict(zip(cell_hashes, [shape["json"] for shape in shape_list]))
+  shape_cache.update(zip(pending, check_cells([cells[cell_hash] for cell_hash in pending], workers)))
+  cache["shape_checker"] = checker_hash
+  cache["shapes"] = dict((cell_hash, shape_cache[cell_hash]) for cell_hash in set(cell_hashes))
+  return cell_hashes, len(pending)
+
+# Work out what the page is made of from a parsed sheet: its layers, data chunks and,
+# if the settings ask for them, tiles and heatmaps. Returns the model emit() writes out.
+# 'cache' (the build cache, see run_build()) keeps the results of checking shapes
+# between builds; the sheet itself is left as it is, so it can be built again
+def build_model(sheet, settings, cache=None, report=None):
+  if report is None:
+    report = new_report()
+  build_cache = cache if cache is not None else {}
+  map_list, marker_list, shape_list = sheet["maps"], sheet["markers"], sheet["shapes"]
+
+  # Drop shapes whose GeoJSON is broken rather than letting them break data.js
+  enter_stage(report, "check shapes")
+  cell_hashes, pending = check_shapes(shape_list, settings.shape_workers, build_cache)
+
+  checked_shapes = []
+  vertices = 0
+  for shape, cell_hash in zip(shape_list, cell_hashes):
+    result = build_cache["shapes"][cell_hash]
+    if "error" in result:
+      print "\033[91mSkipping shape '{0}': GeoJSON {1}\033[0m".format(shape["title"], result["error"])
+      continue
+    vertices += result["vertices"]
+    checked_shapes.append(dict(shape, json=str(result["json"]), box=result["box"]))
+  print "Checked {0} shapes ({1} new or changed), {2} vertices".format(len(shape_list), pending, vertices)
+  report["records"] = {"maps": len(map_list), "markers": len(marker_list), "shapes": len(checked_shapes), "shapes_skipped": len(shape_list) - len(checked_shapes)}
+  shape_list = checked_shapes
+
+  enter_stage(report, "sort records")
+  # Initialize empty hashes to store array of records by key
+  # This is to generate the list of everything that should turn on/off by layer
+  # such as categories (cat_dict), kept in the order they first appear in the sheet so
+  # the same sheet always gives the same layers, in the same order
+  cat_dict = OrderedDict()
+
+  # Sort marker and shape records by category and subcategory
+  marker_ids = {}
+  shape_ids = {}
+  for ids, record_list in [(marker_ids, marker_list), (shape_ids, shape_list)]:
+    for index, record in enumerate(record_list):
+      if not record["cat"] in cat_dict:
+        cat_dict[record["cat"]] = OrderedDict()
+      if not record["subcat"] in cat_dict[record["cat"]]:
+        cat_dict[record["cat"]][record["subcat"]] = []
+      if not js_name(record["subcat"]) in ids:
+        ids[js_name(record["subcat"])] = []
+      ids[js_name(record["subcat"])].append(index)
+
+  # Each subcategory's markers, and its shapes, go into a data chunk of their own,
+  # which is either fetched by the page when the layer is first switched on
+  # (settings.lazy_chunks) or written inline at the end of 'data.js'
+  chunk_list = []
+  for category in cat_dict:
+    for subcategory in cat_dict[category]:
+      subcat = js_name(subcategory)
+      if subcat in marker_ids:
+        chunk_list.append((subcat, subcat, "markers", marker_ids.pop(subcat)))
+      if subcat in shape_ids:
+        chunk_list.append((subcat, subcat + ".shapes", "shapes", shape_ids.pop(subcat)))
+
+  # Map bounds, [[south, west], [north, east]]
+  map_bounds = settings.map_bounds
+
+  # With settings.tile_pyramid, each data chunk is instead split into z/x/y tiles
+  # (see tiles.py), along with the span of years in which anything in the tile is
+  # visible ([first, last], last 0 if open-ended), so the page only fetches the
+  # tiles in view that have something to show in the current year
+  chunk_tiles = {}
+  if settings.tile_pyramid == True:
+    enter_stage(report, "tiles")
+    for subcat, name, kind, ids in chunk_list:
+      records = marker_list if kind == "markers" else shape_list
+      chunk_tiles[name] = []
+      tiles = bucket_features([(index, record_box(records[index], kind)) for index in ids], map_bounds, settings.min_zoom, settings.max_zoom)
+      for tile in sorted(tiles):
+        spans = [date_span(records[index]) for index in tiles[tile]]
+        last = 0 if None in [eyear for date_type, syear, eyear in spans] else max(eyear for date_type, syear, eyear in spans)
+        chunk_tiles[name].append((tile, tiles[tile], min(syear for date_type, syear, eyear in spans), last))
+
+  # With settings.heatmaps, subcategories with at least settings.heatmap_min_markers
+  # markers are shown at zoom levels up to settings.heatmap_max_zoom as a density image
+  # of the markers visible in the current year (see heatmaps.py), and as markers only
+  # when zoomed in further. Images go with the chunks; for each zoom, the manifest lists
+  # the image to show from each year on (-1 for none)
+  heat_manifest = OrderedDict()
+  heat_images = OrderedDict()
+  if settings.heatmaps == True and numpy is None:
+    print "\033[91mNumPy is not installed, so the heatmaps are left out.\033[0m"
+  elif settings.heatmaps == True and settings.heatmap_max_zoom >= settings.min_zoom:
+    enter_stage(report, "heatmaps")
+    for subcat, name, kind, ids in chunk_list:
+      if kind != "markers" or len(ids) < settings.heatmap_min_markers:
+        continue
+      heat_manifest[subcat] = OrderedDict()
+      points = [(float(marker_list[index]["lon"]), float(marker_list[index]["lat"])) for index in ids]
+      spans = [date_span(marker_list[index])[1:] for index in ids]
+      for z in range(settings.min_zoom, settings.heatmap_max_zoom + 1):
+        grid_bounds, images = density_images(points, spans, map_bounds, z, settings.heatmap_cell, settings.heatmap_radius)
+        years, image_ids = [], {}
+        for year, image in images:
+          if image is None:
+            years.append([year, -1])
+            continue
+          digest = hashlib.sha1(image).hexdigest()
+          if not digest in image_ids:
+            image_ids[digest] = len(image_ids)
+            heat_images["{0}.heat.{1}.{2}.png".format(subcat, z, image_ids[digest])] = image
+          years.append([year, image_ids[digest]])
+        heat_manifest[subcat][z] = {"bounds": grid_bounds, "years": years}
+
+  return {"digest": sheet["digest"], "maps": map_list, "markers": marker_list, "shapes": shape_list, "categories": cat_dict,
+    "chunks": chunk_list, "tiles": chunk_tiles, "heat_manifest": heat_manifest, "heat_images": heat_images}
+
+# Write data.js, which the page runs, to 'js_output', for the build of 'model' whose
+# chunks are fetched from 'chunk_url' (all of it but the chunks themselves, which
+# write_chunks() adds, if they go inline)
+def write_scripts(js_output, model, settings, release, chunk_url):
+  map_list, cat_dict, chunk_list = model["maps"], model["categories"], model["chunks"]
+  chunk_tiles, heat_manifest = model["tiles"], model["heat_manifest"]
+
+  # Map bounds, [[south, west], [north, east]]
+  map_bounds = settings.map_bounds
+
+  # Format captured data into JS vars
+  js_output.write("// Leaflet data, build " + release + "\n")
+
+  # Generate all js map vars, write to 'data.js' and store a copy in base_layer array
+  js_output.write("\n")
+  base_layer = []
+  for index, map in enumerate(map_list):
+    # Basemaps mirrored by mirror.py are loaded from the local tile server instead of their original hosts
+    url = mirror_url(settings.tile_mirror, map['title'], map['url']) if settings.tile_mirror else map['url']
+    map_var = "var map{0} = L.tileLayer('{1}', {{maxZoom: {2}, minZoom: {3}, tms: true}});\n"
+    js_output.write(map_var.format(index, url, settings.max_zoom, settings.min_zoom))
+
+    base = "'{0}': map{1},".format(map['title'], index) 
+    base_layer.append(base)
+
+  js_output.write("\n")
+  js_output.write("var currentYear = null;\n\n")
+
+  # Pop-up bindings
+  js_output.write("function onEachFeature(feature, layer, name) {\n")
+  js_output.write("\tif (feature.pop) {\n")
+  js_output.write("\t\tbindStoredPopup(layer, name, feature.pop);\n")
+  js_output.write("\t} else {\n")
+  js_output.write("\t\tvar popup = feature.pop_text;\n")
+  js_output.write("\t\tlayer.bindPopup(popup);\n")
+  js_output.write("\t}\n")
+  js_output.write("};\n\n")
+
+  # Pop-ups kept in the pop-up store are fetched a block at a time when one of them
+  # is first opened, then rendered from their raw fields by 'renderPopup'
+  if settings.popup_store == True:
+    js_output.write("var PopupStore = {};\n")
+    js_output.write("var popupWaiting = {};\n\n")
+    js_output.write("function bindStoredPopup(layer, name, pop) {\n")
+    js_output.write("\tlayer.bindPopup(\"\");\n")
+    js_output.write("\tlayer.on(\"popupopen\", function(e) {\n")
+    js_output.write("\t\tloadPopups(name + \".popups.\" + pop[0], function(store) {\n")
+    js_output.write("\t\t\te.popup.setContent(renderPopup(store, pop[1]));\n")
+    js_output.write("\t\t});\n")
+    js_output.write("\t});\n")
+    js_output.write("};\n\n")
+    js_output.write("function loadPopups(block, callback) {\n")
+    js_output.write("\tif (PopupStore[block]) { callback(PopupStore[block]); return; }\n")
+    js_output.write("\tif (popupWaiting[block]) { popupWaiting[block].push(callback); return; }\n")
+    js_output.write("\tpopupWaiting[block] = [callback];\n")
+    js_output.write("\t$.ajax({{ url: \"{0}\" + block + \".json\", dataType: \"json\", cache: true, success: function(store) {{\n".format(chunk_url))
+    js_output.write("\t\tPopupStore[block] = store;\n")
+    js_output.write("\t\tvar waiting = popupWaiting[block];\n")
+    js_output.write("\t\tdelete popupWaiting[block];\n")
+    js_output.write("\t\tfor (var i = 0; i < waiting.length; i++) { waiting[i](store); }\n")
+    js_output.write("\t}});\n")
+    js_output.write("};\n\n")
+    # Same layout as popup_text() builds at compile time
+    js_output.write("function renderPopup(store, row) {\n")
+    js_output.write("\tvar r = store.rows[row];\n")
+    js_output.write("\tvar s = store.strings;\n")
+    js_output.write("\tvar html = \"<p><b><u>\" + r[0] + \"</u></b>\";\n")
+    js_output.write("\tif (s[r[1]] != \"\") {\n")
+    js_output.write("\t\thtml += \"<br/><b>Years:</b> \" + s[r[1]];\n")
+    js_output.write("\t} else if (r[3] != \"\") {\n")
+    js_output.write("\t\thtml += \"<br/><b>Years:</b> \" + r[2] + \" - \" + r[3];\n")
+    js_output.write("\t} else {\n")
+    js_output.write("\t\thtml += \"<br /><b>Year:</b> \" + r[2];\n")
+    js_output.write("\t}\n")
+    js_output.write("\thtml += \"<br/><b>Description:</b> \" + r[4];\n")
+    js_output.write("\thtml += \"<br/><b>Historic Location:</b> \" + s[r[5]];\n")
+    js_output.write("\thtml += \"<br/><b>Present Location:</b> \" + s[r[6]];\n")
+    js_output.write("\tif (s[r[7]] != \"\" && s[r[8]] != \"\") {\n")
+    js_output.write("\t\thtml += \"<br/><b>Source:</b> <a href='\" + s[r[8]] + \"'>\" + s[r[7]] + \"</a>\";\n")
+    js_output.write("\t} else if (s[r[7]] != \"\") {\n")
+    js_output.write("\t\thtml += \"<br/><b>Source:</b> \" + s[r[7]];\n")
+    js_output.write("\t} else {\n")
+    js_output.write("\t\thtml += \"<br/><Source:</b> \";\n")
+    js_output.write("\t}\n")
+    js_output.write("\treturn html + \"</p>\";\n")
+    js_output.write("};\n\n")
+
+  # Pause timeline on marker or marker cluster click
+  js_output.write("function pauseTimeline(a) {\n")
+  js_output.write("\tclearInterval(window.animate);\n")
+  js_output.write("\tplaying = false;\n")
+  js_output.write("\t$(\"#icon-target\").attr(\"src\",\"images/play.png\");\n")
+  js_output.write("};\n\n")
+
+  # Create subcategorical marker clusters (plain layer groups when clusters are
+  # precomputed, see settings.precluster and 'drawClusters'). The markers of a
+  # subcategory with a heatmap go in a group of their own ('...Points'), which
+  # 'setHeatmaps' puts in the subcategory's layer in place of the heatmap when zoomed in
+  for category in cat_dict:
+
+    for subcategory in cat_dict[category]:
+      cluster_name = "{0}Markers".format(js_name(subcategory))
+      if js_name(subcategory) in heat_manifest:
+        cluster_name = "{0}Points".format(js_name(subcategory))
+      class_name = "{0}".format(subcategory.replace(" ", "-").lower())
+      if settings.precluster == True:
+        js_output.write("var {0} = L.featureGroup().on('click', pauseTimeline);\n".format(cluster_name))
+        js_output.write("{0}.clusterClass = \"{1}\";\n".format(cluster_name, class_name))
+      else:
+        js_output.write("var {0} = new L.MarkerClusterGroup({{ clusterClass: \"{1}".format(cluster_name, class_name))
+        js_output.write("\" }).on('click', pauseTimeline).on('clusterclick', pauseTimeline);\n")
+      if js_name(subcategory) in heat_manifest:
+        js_output.write("var {0}Markers = L.featureGroup();\n".format(js_name(subcategory)))
+      js_output.write("{0}Markers.chunk = \"{1}\";\n".format(js_name(subcategory), js_name(subcategory)))
+
+  js_output.write("\n")
+
+  # Keep every loaded chunk's year index and feature layers (built once, keyed by
+  # feature id) so setOverlays() can add and remove individual features instead of
+  # rebuilding layers, along with the year each chunk was last brought up to
+  js_output.write("var YearIndex = {};\n")
+  js_output.write("var featureLayers = {};\n")
+  js_output.write("var layerYear = {};\n")
+  js_output.write("var chunkGroups = {\n")
+  for subcat, name, kind, ids in chunk_list:
+    js_output.write("\t\"{0}\": {1}{2},\n".format(name, subcat, "Points" if kind == "markers" and subcat in heat_manifest else "Markers"))
+  js_output.write("};\n\n")
+
+  # create 'registerMarkers'/'registerShapes' functions called by each data chunk (or
+  # tile, which may repeat features another tile of the same chunk already brought in)
+  js_output.write("function registerMarkers(name, index, collection, icon, clusters) {\n")
+  js_output.write("\tvar layers = featureLayers[name] = featureLayers[name] || {};\n")
+  js_output.write("\tL.geoJson(collection, {filter: function (feature) {return !layers[feature.id]}, onEachFeature: function (feature, layer) {onEachFeature(feature, layer, name)}, pointToLayer: function (feature, latlng) {return L.marker(latlng, {icon: icon})}}).eachLayer(function (layer) { layers[layer.feature.id] = layer; });\n")
+  if settings.precluster == True:
+    js_output.write("\tindexClusters(name, collection, clusters);\n")
+  js_output.write("\tregisterChunk(name, index);\n")
+  if settings.search_index == True:
+    js_output.write("\topenPendingResult(name);\n")
+  js_output.write("};\n\n")
+
+  # Markers clustered at compile time (see clusters.py): each chunk keeps the markers
+  # visible in the current year, and how many of them fall in each cluster at the
+  # current zoom, so a year change only redraws the clusters whose counts changed.
+  # A cluster down to one visible marker shows that marker; at the highest zoom
+  # (or any zoom without clusters) every marker is shown on its own
+  if settings.precluster == True:
+    js_output.write("var ClusterIndex = {};\n\n")
+    js_output.write("function clusterZoom() {\n")
+    js_output.write("\treturn Math.max({0}, Math.min({1}, map.getZoom()));\n".format(settings.min_zoom, settings.max_zoom))
+    js_output.write("};\n\n")
+    js_output.write("function indexClusters(name, collection, clusters) {\n")
+    js_output.write("\tvar state = ClusterIndex[name] = ClusterIndex[name] || {levels: {}, visible: {}, counts: {}, shown: {}, zoom: clusterZoom()};\n")
+    js_output.write("\tfor (var z in clusters) {\n")
+    js_output.write("\t\tvar chunk = clusters[z];\n")
+    js_output.write("\t\tvar level = state.levels[z] = state.levels[z] || {of: {}, members: {}, lon: {}, lat: {}};\n")
+    js_output.write("\t\tfor (var i = 0; i < chunk.c.length; i++) {\n")
+    js_output.write("\t\t\tlevel.lon[chunk.c[i]] = chunk.lon[i];\n")
+    js_output.write("\t\t\tlevel.lat[chunk.c[i]] = chunk.lat[i];\n")
+    js_output.write("\t\t}\n")
+    js_output.write("\t\tfor (var i = 0; i < chunk.member.length; i++) {\n")
+    js_output.write("\t\t\tvar id = collection.features[i].id, c = chunk.member[i];\n")
+    js_output.write("\t\t\tif (level.of[id] !== undefined) { continue; }\n")
+    js_output.write("\t\t\tlevel.of[id] = c;\n")
+    js_output.write("\t\t\t(level.members[c] = level.members[c] || []).push(id);\n")
+    js_output.write("\t\t}\n")
+    js_output.write("\t}\n")
+    js_output.write("};\n\n")
+    js_output.write("function clusterKey(state, id) {\n")
+    js_output.write("\tvar level = state.levels[state.zoom];\n")
+    js_output.write("\treturn level ? level.of[id] : id;\n")
+    js_output.write("};\n\n")
+    js_output.write("function updateClusters(group, name, added, removed) {\n")
+    js_output.write("\tvar state = ClusterIndex[name];\n")
+    js_output.write("\tvar dirty = {};\n")
+    js_output.write("\tvar count = function(ids, sign) {\n")
+    js_output.write("\t\tfor (var i = 0; i < ids.length; i++) {\n")
+    js_output.write("\t\t\tvar key = clusterKey(state, ids[i]);\n")
+    js_output.write("\t\t\tstate.counts[key] = (state.counts[key] || 0) + sign;\n")
+    js_output.write("\t\t\tdirty[key] = true;\n")
+    js_output.write("\t\t\tif (sign > 0) { state.visible[ids[i]] = true; } else { delete state.visible[ids[i]]; }\n")
+    js_output.write("\t\t}\n")
+    js_output.write("\t};\n")
+    js_output.write("\tcount(removed, -1);\n")
+    js_output.write("\tcount(added, 1);\n")
+    js_output.write("\tfor (var key in dirty) { drawCluster(group, name, key); }\n")
+    js_output.write("};\n\n")
+    js_output.write("function drawCluster(group, name, key) {\n")
+    js_output.write("\tvar state = ClusterIndex[name];\n")
+    js_output.write("\tvar level = state.levels[state.zoom];\n")
+    js_output.write("\tvar count = state.counts[key] || 0;\n")
+    js_output.write("\tif (state.shown[key]) {\n")
+    js_output.write("\t\tgroup.removeLayer(state.shown[key]);\n")
+    js_output.write("\t\tdelete state.shown[key];\n")
+    js_output.write("\t}\n")
+    js_output.write("\tif (count <= 0) {\n")
+    js_output.write("\t\tdelete state.counts[key];\n")
+    js_output.write("\t\treturn;\n")
+    js_output.write("\t}\n")
+    js_output.write("\tvar layer;\n")
+    js_output.write("\tif (!level) {\n")
+    js_output.write("\t\tlayer = featureLayers[name][key];\n")
+    js_output.write("\t} else if (count == 1) {\n")
+    js_output.write("\t\tvar members = level.members[key];\n")
+    js_output.write("\t\tfor (var i = 0; i < members.length; i++) {\n")
+    js_output.write("\t\t\tif (state.visible[members[i]]) { layer = featureLayers[name][members[i]]; }\n")
+    js_output.write("\t\t}\n")
+    js_output.write("\t} else {\n")
+    js_output.write("\t\tlayer = clusterMarker(group, L.latLng(level.lat[key], level.lon[key]), count);\n")
+    js_output.write("\t}\n")
+    js_output.write("\tstate.shown[key] = layer;\n")
+    js_output.write("\tgroup.addLayer(layer);\n")
+    js_output.write("};\n\n")
+    # Same icon markup and classes as the cluster plugin, so the existing cluster styles apply
+    js_output.write("function clusterMarker(group, latlng, count) {\n")
+    js_output.write("\tvar size = (count < 10) ? \"small\" : (count < 100) ? \"medium\" : \"large\";\n")
+    js_output.write("\tvar icon = L.divIcon({ html: \"<div><span>\" + count + \"</span></div>\", className: \"marker-cluster marker-cluster-\" + size + \" marker-cluster-\" + group.clusterClass, iconSize: L.point(40, 40) });\n")
+    js_output.write("\treturn L.marker(latlng, {icon: icon}).on('click', function() { map.setView(latlng, map.getZoom() + 1); });\n")
+    js_output.write("};\n\n")
+    js_output.write("function drawClusters(name) {\n")
+    js_output.write("\tvar state = ClusterIndex[name];\n")
+    js_output.write("\tvar group = chunkGroups[name];\n")
+    js_output.write("\tfor (var key in state.shown) { group.removeLayer(state.shown[key]); }\n")
+    js_output.write("\tstate.shown = {};\n")
+    js_output.write("\tstate.counts = {};\n")
+    js_output.write("\tstate.zoom = clusterZoom();\n")
+    js_output.write("\tfor (var id in state.visible) {\n")
+    js_output.write("\t\tvar key = clusterKey(state, id);\n")
+    js_output.write("\t\tstate.counts[key] = (state.counts[key] || 0) + 1;\n")
+    js_output.write("\t}\n")
+    js_output.write("\tfor (var key in state.counts) { drawCluster(group, name, key); }\n")
+    js_output.write("};\n\n")
+  # create 'decodeColumns' function which rebuilds a FeatureCollection from the columnar marker encoding
+  if settings.columnar_markers == True:
+    js_output.write("function decodeColumns(columns) {\n")
+    js_output.write("\tvar features = [];\n")
+    js_output.write("\tvar types = [\"start\", \"iso\", \"range\"];\n")
+    js_output.write("\tvar id = 0, lon = 0, lat = 0, start = 0;\n")
+    js_output.write("\tfor (var i = 0; i < columns.id.length; i++) {\n")
+    js_output.write("\t\tid += columns.id[i];\n")
+    js_output.write("\t\tlon += columns.lon[i];\n")
+    js_output.write("\t\tlat += columns.lat[i];\n")
+    js_output.write("\t\tstart += columns.start[i];\n")
+    js_output.write("\t\tvar feature = {type: \"Feature\", id: String(id), date_type: types[columns.type[i]],\n")
+    js_output.write("\t\t\tdate: (columns.type[i] == 2) ? [start, start + columns.span[i]] : [start],\n")
+    js_output.write("\t\t\tgeometry: {type: \"Point\", coordinates: [lon / columns.scale, lat / columns.scale]}};\n")
+    js_output.write("\t\tfeature[(typeof columns.pop[i] == \"string\") ? \"pop_text\" : \"pop\"] = columns.pop[i];\n")
+    js_output.write("\t\tfeatures.push(feature);\n")
+    js_output.write("\t}\n")
+    js_output.write("\treturn {type: \"FeatureCollection\", features: features};\n")
+    js_output.write("};\n\n")
+
+  js_output.write("function registerShapes(name, index, shapes, topology) {\n")
+  js_output.write("\tvar layers = featureLayers[name] = featureLayers[name] || {};\n")
+  js_output.write("\tfor (var id in shapes) {\n")
+  js_output.write("\t\tif (layers[id]) { delete shapes[id]; } else { layers[id] = shapes[id]; }\n")
+  js_output.write("\t}\n")
+  if settings.simplify_shapes == True:
+    js_output.write("\tif (topology) {\n")
+    js_output.write("\t\tfor (var id in topology.objects) {\n")
+    js_output.write("\t\t\tif (!shapes[id]) { delete topology.objects[id]; }\n")
+    js_output.write("\t\t}\n")
+    js_output.write("\t\ttopology.decoded = {};\n")
+    js_output.write("\t\ttopology.chunk = name;\n")
+    js_output.write("\t\tShapeTopologies.push(topology);\n")
+    js_output.write("\t\tdrawTopology(topology);\n")
+    js_output.write("\t}\n")
+  js_output.write("\tregisterChunk(name, index);\n")
+  if settings.search_index == True:
+    js_output.write("\topenPendingResult(name);\n")
+  js_output.write("};\n\n")
+
+  # Shapes simplified at compile time are redrawn from their topology's arcs whenever
+  # the zoom level changes, keeping only the arc points needed at that zoom
+  if settings.simplify_shapes == True:
+    js_output.write("var ShapeTopologies = [];\n\n")
+    js_output.write("function decodeArcs(topology, zoom) {\n")
+    js_output.write("\tvar arcs = [];\n")
+    js_output.write("\tfor (var i = 0; i < topology.arcs.length; i++) {\n")
+    js_output.write("\t\tvar arc = topology.arcs[i], points = [], x = 0, y = 0;\n")
+    js_output.write("\t\tfor (var j = 0; j < arc.length; j += 3) {\n")
+    js_output.write("\t\t\tx += arc[j];\n")
+    js_output.write("\t\t\ty += arc[j + 1];\n")
+    js_output.write("\t\t\tif (arc[j + 2] <= zoom) { points.push(topoPosition(topology, [x, y])); }\n")
+    js_output.write("\t\t}\n")
+    js_output.write("\t\tarcs.push(points);\n")
+    js_output.write("\t}\n")
+    js_output.write("\treturn arcs;\n")
+    js_output.write("};\n\n")
+    js_output.write("function topoPosition(topology, p) {\n")
+    js_output.write("\treturn [p[0] * topology.scale[0] + topology.translate[0], p[1] * topology.scale[1] + topology.translate[1]];\n")
+    js_output.write("};\n\n")
+    js_output.write("function topoGeometry(topology, geometry, zoom) {\n")
+    js_output.write("\tif (!topology.decoded[zoom]) { topology.decoded[zoom] = decodeArcs(topology, zoom); }\n")
+    js_output.write("\tvar arcs = topology.decoded[zoom];\n")
+    js_output.write("\tvar line = function(refs) {\n")
+    js_output.write("\t\tvar coords = [];\n")
+    js_output.write("\t\tfor (var i = 0; i < refs.length; i++) {\n")
+    js_output.write("\t\t\tvar arc = (refs[i] >= 0) ? arcs[refs[i]] : arcs[~refs[i]].slice().reverse();\n")
+    js_output.write("\t\t\tcoords = coords.concat(coords.length ? arc.slice(1) : arc);\n")
+    js_output.write("\t\t}\n")
+    js_output.write("\t\treturn coords;\n")
+    js_output.write("\t};\n")
+    js_output.write("\tvar polygon = function(rings) {\n")
+    js_output.write("\t\tvar coords = [];\n")
+    js_output.write("\t\tfor (var i = 0; i < rings.length; i++) {\n")
+    js_output.write("\t\t\tvar ring = line(rings[i]);\n")
+    js_output.write("\t\t\tif (ring.length >= 4) { coords.push(ring); } else if (i == 0) { return null; }\n")
+    js_output.write("\t\t}\n")
+    js_output.write("\t\treturn coords;\n")
+    js_output.write("\t};\n")
+    js_output.write("\tvar parts = [], i;\n")
+    js_output.write("\tswitch (geometry.type) {\n")
+    js_output.write("\t\tcase \"Point\":\n")
+    js_output.write("\t\t\treturn {type: \"Point\", coordinates: topoPosition(topology, geometry.coordinates)};\n")
+    js_output.write("\t\tcase \"MultiPoint\":\n")
+    js_output.write("\t\t\tfor (i = 0; i < geometry.coordinates.length; i++) { parts.push(topoPosition(topology, geometry.coordinates[i])); }\n")
+    js_output.write("\t\t\treturn {type: \"MultiPoint\", coordinates: parts};\n")
+    js_output.write("\t\tcase \"LineString\":\n")
+    js_output.write("\t\t\treturn {type: \"LineString\", coordinates: line(geometry.arcs)};\n")
+    js_output.write("\t\tcase \"MultiLineString\":\n")
+    js_output.write("\t\t\tfor (i = 0; i < geometry.arcs.length; i++) { parts.push(line(geometry.arcs[i])); }\n")
+    js_output.write("\t\t\treturn {type: \"MultiLineString\", coordinates: parts};\n")
+    js_output.write("\t\tcase \"Polygon\":\n")
+    js_output.write("\t\t\tparts = polygon(geometry.arcs);\n")
+    js_output.write("\t\t\treturn parts ? {type: \"Polygon\", coordinates: parts} : null;\n")
+    js_output.write("\t\tcase \"MultiPolygon\":\n")
+    js_output.write("\t\t\tfor (i = 0; i < geometry.arcs.length; i++) {\n")
+    js_output.write("\t\t\t\tvar rings = polygon(geometry.arcs[i]);\n")
+    js_output.write("\t\t\t\tif (rings) { parts.push(rings); }\n")
+    js_output.write("\t\t\t}\n")
+    js_output.write("\t\t\treturn parts.length ? {type: \"MultiPolygon\", coordinates: parts} : null;\n")
+    js_output.write("\t\tcase \"GeometryCollection\":\n")
+    js_output.write("\t\t\tfor (i = 0; i < geometry.geometries.length; i++) {\n")
+    js_output.write("\t\t\t\tvar part = topoGeometry(topology, geometry.geometries[i], zoom);\n")
+    js_output.write("\t\t\t\tif (part) { parts.push(part); }\n")
+    js_output.write("\t\t\t}\n")
+    js_output.write("\t\t\treturn parts.length ? {type: \"GeometryCollection\", geometries: parts} : null;\n")
+    js_output.write("\t}\n")
+    js_output.write("};\n\n")
+    js_output.write("function drawTopology(topology) {\n")
+    js_output.write("\tvar shapes = featureLayers[topology.chunk];\n")
+    js_output.write("\tvar zoom = Math.max({0}, Math.min({1}, map.getZoom()));\n".format(settings.min_zoom, settings.max_zoom))
+    js_output.write("\tfor (var id in topology.objects) {\n")
+    js_output.write("\t\tvar geometry = topoGeometry(topology, topology.objects[id], zoom);\n")
+    js_output.write("\t\tshapes[id].clearLayers();\n")
+    js_output.write("\t\tif (geometry) { shapes[id].addData(geometry); }\n")
+    js_output.write("\t}\n")
+    js_output.write("};\n\n")
+  js_output.write("function registerChunk(name, index) {\n")
+  js_output.write("\tif (!YearIndex[name]) {\n")
+  js_output.write("\t\tYearIndex[name] = index;\n")
+  js_output.write("\t\tif (currentYear !== null) {\n")
+  js_output.write("\t\t\tupdateLayer(chunkGroups[name], name, currentYear);\n")
+  js_output.write("\t\t}\n")
+  js_output.write("\t\treturn;\n")
+  js_output.write("\t}\n")
+  # A further tile of a chunk: its features not seen before are merged into the
+  # chunk's year index and caught up to the year the chunk is showing
+  js_output.write("\tvar known = YearIndex[name];\n")
+  js_output.write("\tif (!known.ids) {\n")
+  js_output.write("\t\tknown.ids = {};\n")
+  js_output.write("\t\tfor (var y in known.enter) { for (var i = 0; i < known.enter[y].length; i++) { known.ids[known.enter[y][i]] = true; } }\n")
+  js_output.write("\t}\n")
+  js_output.write("\tvar fresh = {enter: {}, exit: {}, first: index.first};\n")
+  js_output.write("\tvar merge = function(from, to, key) {\n")
+  js_output.write("\t\tfor (var y in from[key]) {\n")
+  js_output.write("\t\t\tfor (var i = 0; i < from[key][y].length; i++) {\n")
+  js_output.write("\t\t\t\tif (known.ids[from[key][y][i]]) { continue; }\n")
+  js_output.write("\t\t\t\t(to[key][y] = to[key][y] || []).push(from[key][y][i]);\n")
+  js_output.write("\t\t\t}\n")
+  js_output.write("\t\t}\n")
+  js_output.write("\t};\n")
+  js_output.write("\tmerge(index, fresh, \"enter\");\n")
+  js_output.write("\tmerge(index, fresh, \"exit\");\n")
+  js_output.write("\tmerge(fresh, known, \"enter\");\n")
+  js_output.write("\tmerge(fresh, known, \"exit\");\n")
+  js_output.write("\tfor (var y in fresh.enter) { for (var i = 0; i < fresh.enter[y].length; i++) { known.ids[fresh.enter[y][i]] = true; } }\n")
+  js_output.write("\tknown.first = Math.min(known.first, fresh.first);\n")
+  js_output.write("\tif (layerYear[name] !== undefined && layerYear[name] >= fresh.first) {\n")
+  js_output.write("\t\tapplyChanges(chunkGroups[name], name, yearChanges(fresh, fresh.first - 1, layerYear[name]));\n")
+  js_output.write("\t}\n")
+  js_output.write("};\n\n")
+
+  # Set all category/subcategory layers to be toggleable from control panel, each
+  # labelled with its icon, drawn from the sprite if style.js made it from one
+  js_output.write("function iconLabel(icon) {\n")
+  js_output.write("\tvar sprite = icon.options.sprite;\n")
+  js_output.write("\tif (!sprite) {\n")
+  js_output.write("\t\treturn \"<img src='\" + icon.options.iconUrl + \"' class='overlay-icon' height=13 width=10>\";\n")
+  js_output.write("\t}\n")
+  js_output.write("\tvar scaleX = 10 / sprite[2], scaleY = 13 / sprite[3];\n")
+  js_output.write("\treturn \"<span class='overlay-icon' style='display: inline-block; width: 10px; height: 13px; background: url(\" + IconSprite.url + \") \" + (-sprite[0] * scaleX) + \"px \" + (-sprite[1] * scaleY) + \"px / \" + (IconSprite.width * scaleX) + \"px \" + (IconSprite.height * scaleY) + \"px no-repeat'></span>\";\n")
+  js_output.write("}\n\n")
+  js_output.write("var overlays = {\n")
+  for category in cat_dict:
+    js_output.write("\t\"{0}\": {{}},\n".format(category))
+  js_output.write("};\n")
+  for category in cat_dict:
+    for subcategory in cat_dict[category]:
+      js_output.write("overlays[\"{0}\"][iconLabel({1}Icon) + \"<span>&nbsp;{2}</span>\"] = {1}Markers;\n".format(category, js_name(subcategory), subcategory))
+
+  js_output.write("\n")
+
+  # Set all basemaps to be selectable from control panel
+  js_output.write("var baseLayers = {")
+  for base in base_layer:
+    js_output.write(base)
+  js_output.write("};\n")
+
+  # Set boundaries for map
+  js_output.write("var southWest = L.latLng({0}, {1})\n".format(*map_bounds[0]))
+  js_output.write("var northEast = L.latLng({0}, {1})\n".format(*map_bounds[1]))
+  js_output.write("var bounds = L.latLngBounds(southWest, northEast);\n")
+
+  # Initialize map and append cluster layer group
+  js_output.write("\n")
+  js_output.write("var map = L.map('map', {{ center: {0}, zoom: {1}, maxBounds: bounds }});\n".format(settings.init_center, settings.init_zoom))
+  js_output.write("L.control.groupedLayers(null, overlays).addTo(map);\n\n")
+
+  # Show each heatmap for the current year and zoom, or its subcategory's markers once zoomed in past settings.heatmap_max_zoom
+  if heat_manifest:
+    js_output.write("var HeatManifest = {0};\n".format(json.dumps(heat_manifest, separators=(",", ":"))))
+    js_output.write("var heatGroups = {\n")
+    for subcat in heat_manifest:
+      js_output.write("\t\"{0}\": [{0}Markers, {0}Points],\n".format(subcat))
+    js_output.write("};\n")
+    js_output.write("var heatShown = {};\n\n")
+    js_output.write("function heatImage(subcat, z, time) {\n")
+    js_output.write("\tvar years = HeatManifest[subcat][z].years, image = -1;\n")
+    js_output.write("\tfor (var i = 0; i < years.length && years[i][0] <= time; i++) { image = years[i][1]; }\n")
+    js_output.write("\treturn image < 0 ? null : \"{0}\" + subcat + \".heat.\" + z + \".\" + image + \".png\";\n".format(chunk_url))
+    js_output.write("};\n\n")
+    js_output.write("function setHeatmaps() {\n")
+    js_output.write("\tvar z = Math.max({0}, map.getZoom()), heat = z <= {1};\n".format(settings.min_zoom, settings.heatmap_max_zoom))
+    js_output.write("\tfor (var subcat in HeatManifest) {\n")
+    js_output.write("\t\tvar group = heatGroups[subcat][0], points = heatGroups[subcat][1];\n")
+    js_output.write("\t\tvar url = (heat && currentYear !== null) ? heatImage(subcat, z, currentYear) : null;\n")
+    js_output.write("\t\tif (heatShown[subcat] && heatShown[subcat].url != url) {\n")
+    js_output.write("\t\t\tgroup.removeLayer(heatShown[subcat].layer);\n")
+    js_output.write("\t\t\tdelete heatShown[subcat];\n")
+    js_output.write("\t\t}\n")
+    js_output.write("\t\tif (url && !heatShown[subcat]) {\n")
+    js_output.write("\t\t\theatShown[subcat] = {url: url, layer: L.imageOverlay(url, HeatManifest[subcat][z].bounds)};\n")
+    js_output.write("\t\t\tgroup.addLayer(heatShown[subcat].layer);\n")
+    js_output.write("\t\t}\n")
+    js_output.write("\t\tif (heat && group.hasLayer(points)) { group.removeLayer(points); }\n")
+    js_output.write("\t\tif (!heat && !group.hasLayer(points)) { group.addLayer(points); }\n")
+    js_output.write("\t}\n")
+    js_output.write("};\n")
+    js_output.write("setHeatmaps();\n\n")
+
+  if settings.simplify_shapes == True or settings.precluster == True or heat_manifest:
+    js_output.write("map.on('zoomend', function() {\n")
+    if heat_manifest:
+      js_output.write("\tsetHeatmaps();\n")
+    if settings.simplify_shapes == True:
+      js_output.write("\tfor (var i = 0; i < ShapeTopologies.length; i++) { drawTopology(ShapeTopologies[i]); }\n")
+    if settings.precluster == True:
+      js_output.write("\tfor (var name in ClusterIndex) { drawClusters(name); }\n")
+    js_output.write("});\n\n")
+
+  # Search box: the search index (see search.py) is fetched when the box is first
+  # used, and matches for the words typed (or the start of them) are listed, those
+  # visible in the current year first. Picking one switches its layer on, goes to it
+  # and opens its pop-up once its chunk is loaded
+  if settings.search_index == True:
+    js_output.write("var SearchIndex = null;\n")
+    js_output.write("var searchWaiting = null;\n")
+    js_output.write("var searchPending = null;\n")
+    js_output.write("var SearchStopWords = {0};\n\n".format(json.dumps(sorted(STOP_WORDS))))
+    js_output.write("function loadSearch(callback) {\n")
+    js_output.write("\tif (SearchIndex) { callback(SearchIndex); return; }\n")
+    js_output.write("\tif (searchWaiting) { searchWaiting.push(callback); return; }\n")
+    js_output.write("\tsearchWaiting = [callback];\n")
+    js_output.write("\t$.ajax({{ url: \"{0}search.json\", dataType: \"json\", cache: true, success: function(index) {{\n".format(chunk_url))
+    js_output.write("\t\tfor (var t = 0; t < index.postings.length; t++) {\n")
+    js_output.write("\t\t\tfor (var i = 1; i < index.postings[t].length; i++) { index.postings[t][i] += index.postings[t][i - 1]; }\n")
+    js_output.write("\t\t}\n")
+    js_output.write("\t\tSearchIndex = index;\n")
+    js_output.write("\t\tvar waiting = searchWaiting;\n")
+    js_output.write("\t\tsearchWaiting = null;\n")
+    js_output.write("\t\tfor (var i = 0; i < waiting.length; i++) { waiting[i](index); }\n")
+    js_output.write("\t}});\n")
+    js_output.write("};\n\n")
+    # Same terms as search.py's terms() cuts text into
+    js_output.write("function searchTerms(text) {\n")
+    js_output.write("\tif (text.normalize) { text = text.normalize(\"NFKD\").replace(/[\\u0300-\\u036f]/g, \"\"); }\n")
+    js_output.write("\treturn $.grep(text.toLowerCase().split(/[^a-z0-9]+/), function(term) { return term.length > 1 && $.inArray(term, SearchStopWords) < 0; });\n")
+    js_output.write("};\n\n")
+    js_output.write("function searchRecords(index, query, year, limit) {\n")
+    js_output.write("\tvar words = searchTerms(query), matched = null;\n")
+    js_output.write("\tfor (var w = 0; w < words.length; w++) {\n")
+    js_output.write("\t\tvar found = {}, low = 0, high = index.terms.length;\n")
+    js_output.write("\t\twhile (low < high) {\n")
+    js_output.write("\t\t\tvar middle = (low + high) >> 1;\n")
+    js_output.write("\t\t\tif (index.terms[middle] < words[w]) { low = middle + 1; } else { high = middle; }\n")
+    js_output.write("\t\t}\n")
+    js_output.write("\t\tfor (var t = low; t < index.terms.length && index.terms[t].lastIndexOf(words[w], 0) === 0; t++) {\n")
+    js_output.write("\t\t\tfor (var i = 0; i < index.postings[t].length; i++) { found[index.postings[t][i]] = true; }\n")
+    js_output.write("\t\t}\n")
+    js_output.write("\t\tif (matched === null) { matched = found; continue; }\n")
+    js_output.write("\t\tfor (var f in matched) { if (!found[f]) { delete matched[f]; } }\n")
+    js_output.write("\t}\n")
+    js_output.write("\tvar now = [], other = [];\n")
+    js_output.write("\tfor (var f in matched) {\n")
+    js_output.write("\t\tvar row = index.features[f];\n")
+    js_output.write("\t\tvar result = {chunk: index.chunks[row[0]], id: row[1], years: [row[2], row[3]], title: row[4], latlng: L.latLng(row[6], row[5])};\n")
+    js_output.write("\t\tif (year !== null && year >= row[2] && (row[3] === null || year <= row[3])) { now.push(result); } else { other.push(result); }\n")
+    js_output.write("\t}\n")
+    js_output.write("\treturn now.concat(other).slice(0, limit);\n")
+    js_output.write("};\n\n")
+    js_output.write("function showResult(result) {\n")
+    js_output.write("\tsearchPending = result;\n")
+    js_output.write("\tmap.addLayer(window[result.chunk.split(\".\")[0] + \"Markers\"]);\n")
+    js_output.write("\tmap.once(\"moveend\", function() { openPendingResult(result.chunk); });\n")
+    js_output.write("\tmap.setView(result.latlng, {0});\n".format(settings.max_zoom))
+    js_output.write("};\n\n")
+    # The pending result is dropped once its chunk is loaded, whether or not it shows in the current year
+    js_output.write("function openPendingResult(name) {\n")
+    js_output.write("\tvar result = searchPending;\n")
+    js_output.write("\tif (!result || result.chunk != name || !(featureLayers[name] || {})[result.id]) { return; }\n")
+    js_output.write("\tsearchPending = null;\n")
+    js_output.write("\tvar layer = featureLayers[name][result.id], group = chunkGroups[name];\n")
+    js_output.write("\tif (group.zoomToShowLayer && group.hasLayer(layer)) {\n")
+    js_output.write("\t\tgroup.zoomToShowLayer(layer, function() { layer.openPopup(); });\n")
+    js_output.write("\t} else if (map.hasLayer(layer)) {\n")
+    js_output.write("\t\tlayer.openPopup(result.latlng);\n")
+    js_output.write("\t}\n")
+    js_output.write("};\n\n")
+    js_output.write("var SearchControl = L.Control.extend({\n")
+    js_output.write("\toptions: { position: \"topleft\" },\n")
+    js_output.write("\tonAdd: function(map) {\n")
+    js_output.write("\t\tvar box = L.DomUtil.create(\"div\", \"search-control leaflet-bar\");\n")
+    js_output.write("\t\tvar input = $(\"<input type='text' placeholder='Search'>\").appendTo(box);\n")
+    js_output.write("\t\tvar list = $(\"<ul class='search-results'></ul>\").appendTo(box);\n")
+    js_output.write("\t\tL.DomEvent.disableClickPropagation(box);\n")
+    js_output.write("\t\tinput.one(\"focus\", function() { loadSearch(function() {}); });\n")
+    js_output.write("\t\tinput.on(\"input\", function() {\n")
+    js_output.write("\t\t\tloadSearch(function(index) {\n")
+    js_output.write("\t\t\t\tlist.empty();\n")
+    js_output.write("\t\t\t\t$.each(searchRecords(index, input.val(), currentYear, 20), function(i, result) {\n")
+    js_output.write("\t\t\t\t\tvar years = result.years[1] === null ? result.years[0] + \"-\" : result.years[0] == result.years[1] ? result.years[0] : result.years[0] + \"-\" + result.years[1];\n")
+    js_output.write("\t\t\t\t\tvar visible = currentYear !== null && currentYear >= result.years[0] && (result.years[1] === null || currentYear <= result.years[1]);\n")
+    js_output.write("\t\t\t\t\t$(\"<li>\").text(result.title + \" (\" + years + \")\").toggleClass(\"search-other-year\", !visible).click(function() { showResult(result); }).appendTo(list);\n")
+    js_output.write("\t\t\t\t});\n")
+    js_output.write("\t\t\t});\n")
+    js_output.write("\t\t});\n")
+    js_output.write("\t\treturn box;\n")
+    js_output.write("\t}\n")
+    js_output.write("});\n")
+    js_output.write("map.addControl(new SearchControl());\n\n")
+
+  # Fetch the tiles of each switched-on subcategory that cover the area in view at the
+  # current zoom and have something to show in the current year, each tile only once
+  if settings.tile_pyramid == True:
+    js_output.write("var TileManifest = {\n")
+    for category in cat_dict:
+      for subcategory in cat_dict[category]:
+        subcat = js_name(subcategory)
+        js_output.write("\t\"{0}\": {{\n".format(subcat))
+        for chunk_subcat, name, kind, ids in chunk_list:
+          if chunk_subcat != subcat:
+            continue
+          zooms = {}
+          for (z, x, y), tile_ids, first, last in chunk_tiles[name]:
+            zooms.setdefault(z, []).append("\"{0}/{1}\":[{2},{3}]".format(x, y, first, last))
+          js_output.write("\t\t\"{0}\": {{{1}}},\n".format(name, ",".join("{0}:{{{1}}}".format(z, ",".join(zooms[z])) for z in sorted(zooms))))
+        js_output.write("\t},\n")
+    js_output.write("};\n")
+    js_output.write("var activeTiles = {};\n\n")
+    js_output.write("function loadTiles() {\n")
+    js_output.write("\tif (currentYear === null) { return; }\n")
+    js_output.write("\tvar z = Math.max({0}, Math.min({1}, map.getZoom()));\n".format(settings.min_zoom, settings.max_zoom))
+    js_output.write("\tvar view = map.getBounds(), sw = view.getSouthWest(), ne = view.getNorthEast();\n")
+    js_output.write("\tvar min = tileAt(Math.max(sw.lng, {0}), Math.min(ne.lat, {1}), z);\n".format(map_bounds[0][1], map_bounds[1][0]))
+    js_output.write("\tvar max = tileAt(Math.min(ne.lng, {0}), Math.max(sw.lat, {1}), z);\n".format(map_bounds[1][1], map_bounds[0][0]))
+    js_output.write("\tfor (var subcat in activeTiles) {\n")
+    js_output.write("\t\tfor (var name in TileManifest[subcat]) {\n")
+    js_output.write("\t\t\tvar tiles = TileManifest[subcat][name][z] || {};\n")
+    js_output.write("\t\t\tfor (var x = min[0]; x <= max[0]; x++) {\n")
+    js_output.write("\t\t\t\tfor (var y = min[1]; y <= max[1]; y++) {\n")
+    js_output.write("\t\t\t\t\tvar years = tiles[x + \"/\" + y];\n")
+    js_output.write("\t\t\t\t\tif (!years || currentYear < years[0] || (years[1] && currentYear > years[1])) { continue; }\n")
+    js_output.write("\t\t\t\t\tdelete tiles[x + \"/\" + y];\n")
+    js_output.write("\t\t\t\t\t$.ajax({{ url: \"{0}\" + name + \".\" + z + \".\" + x + \".\" + y + \".js\", dataType: \"script\", cache: true }});\n".format(chunk_url))
+    js_output.write("\t\t\t\t}\n")
+    js_output.write("\t\t\t}\n")
+    js_output.write("\t\t}\n")
+    js_output.write("\t}\n")
+    js_output.write("};\n\n")
+    js_output.write("map.on('layeradd', function(e) {\n")
+    js_output.write("\tif (e.layer.chunk) {\n")
+    js_output.write("\t\tactiveTiles[e.layer.chunk] = true;\n")
+    js_output.write("\t\tloadTiles();\n")
+    js_output.write("\t}\n")
+    js_output.write("});\n")
+    js_output.write("map.on('layerremove', function(e) {\n")
+    js_output.write("\tif (e.layer.chunk) { delete activeTiles[e.layer.chunk]; }\n")
+    js_output.write("});\n")
+    js_output.write("map.on('moveend', loadTiles);\n\n")
+
+  # Fetch a subcategory's data chunks the first time its layer is added to the map
+  elif settings.lazy_chunks == True:
+    js_output.write("var ChunkManifest = {\n")
+    for category in cat_dict:
+      for subcategory in cat_dict[category]:
+        subcat = js_name(subcategory)
+        urls = ["\"{0}{1}.js\"".format(chunk_url, name) for chunk_subcat, name, kind, ids in chunk_list if chunk_subcat == subcat]
+        js_output.write("\t\"{0}\": [{1}],\n".format(subcat, ", ".join(urls)))
+    js_output.write("};\n\n")
+    js_output.write("function loadChunks(subcat) {\n")
+    js_output.write("\tvar urls = ChunkManifest[subcat];\n")
+    js_output.write("\tif (!urls) { return; }\n")
+    js_output.write("\tdelete ChunkManifest[subcat];\n")
+    js_output.write("\tfor (var i = 0; i < urls.length; i++) {\n")
+    js_output.write("\t\t$.ajax({ url: urls[i], dataType: \"script\", cache: true });\n")
+    js_output.write("\t}\n")
+    js_output.write("};\n\n")
+    js_output.write("map.on('layeradd', function(e) {\n")
+    js_output.write("\tif (e.layer.chunk) { loadChunks(e.layer.chunk); }\n")
+    js_output.write("});\n\n")
+
+  # Tile containing a point at zoom 'z', as [x, y]
+  js_output.write("function tileAt(lng, lat, z) {\n")
+  js_output.write("\tvar n = Math.pow(2, z);\n")
+  js_output.write("\tvar sin = Math.sin(Math.max(-85.0511, Math.min(85.0511, lat)) * Math.PI / 180);\n")
+  js_output.write("\tvar x = (lng / 360 + 0.5) * n, y = (0.5 - 0.25 * Math.log((1 + sin) / (1 - sin)) / Math.PI) * n;\n")
+  js_output.write("\treturn [Math.min(n - 1, Math.max(0, Math.floor(x))), Math.min(n - 1, Math.max(0, Math.floor(y)))];\n")
+  js_output.write("};\n\n")
+
+  # Basemap era table, [first year, last year, basemap] in year order (see basemap_eras()),
+  # which 'setBasemap' searches for the year shown, only swapping basemaps when the era
+  # changes; years outside every era keep the basemap they have
+  js_output.write("var BasemapEras = {0};\n".format(json.dumps(basemap_eras(map_list), separators=(",", ":"))))
+  js_output.write("var basemaps = [{0}];\n".format(", ".join("map{0}".format(index) for index in range(len(map_list)))))
+  js_output.write("var currentBasemap = null;\n\n")
+  js_output.write("function findEra(time) {\n")
+  js_output.write("\tvar low = 0, high = BasemapEras.length - 1;\n")
+  js_output.write("\twhile (low <= high) {\n")
+  js_output.write("\t\tvar middle = (low + high) >> 1;\n")
+  js_output.write("\t\tif (time < BasemapEras[middle][0]) { high = middle - 1; }\n")
+  js_output.write("\t\telse if (time > BasemapEras[middle][1]) { low = middle + 1; }\n")
+  js_output.write("\t\telse { return middle; }\n")
+  js_output.write("\t}\n")
+  js_output.write("\treturn -1;\n")
+  js_output.write("};\n\n")
+  js_output.write("function setBasemap(time) {\n")
+  js_output.write("\tvar era = findEra(time);\n")
+  js_output.write("\tif (era < 0 || BasemapEras[era][2] === currentBasemap) { return; }\n")
+  js_output.write("\tcurrentBasemap = BasemapEras[era][2];\n")
+  js_output.write("\tfor (var i = 0; i < basemaps.length; i++) {\n")
+  js_output.write("\t\tif (i !== currentBasemap) { map.removeLayer(basemaps[i]); }\n")
+  js_output.write("\t}\n")
+  js_output.write("\tmap.addLayer(basemaps[currentBasemap]);\n")
+  js_output.write("};\n\n")
+
+  # create 'prefetchBasemap' function which requests a basemap's tiles for the area in
+  # view ahead of time, so they are already cached when its era comes up (timeline.js)
+  js_output.write("var warmedViews = {};\n")
+  js_output.write("var warmTiles = [];\n")
+  js_output.write("function prefetchBasemap(index) {\n")
+  js_output.write("\tvar layer = basemaps[index];\n")
+  js_output.write("\tvar z = Math.max({0}, Math.min({1}, map.getZoom()));\n".format(settings.min_zoom, settings.max_zoom))
+  js_output.write("\tvar view = map.getBounds(), sw = view.getSouthWest(), ne = view.getNorthEast();\n")
+  js_output.write("\tvar min = tileAt(sw.lng, ne.lat, z), max = tileAt(ne.lng, sw.lat, z);\n")
+  js_output.write("\tvar key = [z, min, max].join();\n")
+  js_output.write("\tif (index === currentBasemap || warmedViews[index] === key) { return; }\n")
+  js_output.write("\twarmedViews[index] = key;\n")
+  js_output.write("\twarmTiles = [];\n")
+  js_output.write("\tvar n = Math.pow(2, z), subdomains = layer.options.subdomains || \"abc\";\n")
+  js_output.write("\tfor (var x = min[0]; x <= max[0]; x++) {\n")
+  js_output.write("\t\tfor (var y = min[1]; y <= max[1]; y++) {\n")
+  js_output.write("\t\t\tvar tile = new Image();\n")
+  js_output.write("\t\t\ttile.src = L.Util.template(layer._url, L.extend({}, layer.options, { s: subdomains[Math.abs(x + y) % subdomains.length], z: z, x: x, y: layer.options.tms ? n - y - 1 : y }));\n")
+  js_output.write("\t\t\twarmTiles.push(tile);\n")
+  js_output.write("\t\t}\n")
+  js_output.write("\t}\n")
+  js_output.write("};\n\n")
+
+  # create 'updateLayer' function which walks a chunk's year index from the year it was
+  # last shown at to the new one and only adds/removes the features whose visibility changed
+  js_output.write("function yearChanges(index, from, time) {\n")
+  js_output.write("\tvar change = {};\n")
+  js_output.write("\tvar step = function(ids, sign) {\n")
+  js_output.write("\t\tif (!ids) { return; }\n")
+  js_output.write("\t\tfor (var i = 0; i < ids.length; i++) {\n")
+  js_output.write("\t\t\tchange[ids[i]] = (change[ids[i]] || 0) + sign;\n")
+  js_output.write("\t\t}\n")
+  js_output.write("\t};\n")
+  js_output.write("\tfor (var y = from + 1; y <= time; y++) {\n")
+  js_output.write("\t\tstep(index.enter[y], 1);\n")
+  js_output.write("\t\tstep(index.exit[y], -1);\n")
+  js_output.write("\t}\n")
+  js_output.write("\tfor (var y = from; y > time; y--) {\n")
+  js_output.write("\t\tstep(index.enter[y], -1);\n")
+  js_output.write("\t\tstep(index.exit[y], 1);\n")
+  js_output.write("\t}\n")
+  js_output.write("\treturn change;\n")
+  js_output.write("};\n\n")
+  js_output.write("function updateLayer(group, name, time) {\n")
+  js_output.write("\tvar index = YearIndex[name];\n")
+  js_output.write("\tvar from = (layerYear[name] === undefined) ? index.first - 1 : layerYear[name];\n")
+  js_output.write("\tapplyChanges(group, name, yearChanges(index, from, time));\n")
+  js_output.write("\tlayerYear[name] = time;\n")
+  js_output.write("};\n\n")
+  js_output.write("function applyChanges(group, name, change) {\n")
+  js_output.write("\tvar layers = featureLayers[name];\n")
+  js_output.write("\tvar added = [];\n")
+  js_output.write("\tvar removed = [];\n")
+  js_output.write("\tfor (var id in change) {\n")
+  js_output.write("\t\tif (!layers[id]) { continue; }\n")
+  js_output.write("\t\tif (change[id] > 0) { added.push(id); }\n")
+  js_output.write("\t\tif (change[id] < 0) { removed.push(id); }\n")
+  js_output.write("\t}\n")
+  if settings.precluster == True:
+    js_output.write("\tif (ClusterIndex[name]) {\n")
+    js_output.write("\t\tupdateClusters(group, name, added, removed);\n")
+    js_output.write("\t\treturn;\n")
+    js_output.write("\t}\n")
+    js_output.write("\tfor (var i = 0; i < removed.length; i++) { group.removeLayer(layers[removed[i]]); }\n")
+    js_output.write("\tfor (var i = 0; i < added.length; i++) { group.addLayer(layers[added[i]]); }\n")
+  else:
+    js_output.write("\tif (removed.length) { group.removeLayers($.map(removed, function(id) { return layers[id]; })); }\n")
+    js_output.write("\tif (added.length) { group.addLayers($.map(added, function(id) { return layers[id]; })); }\n")
+  js_output.write("};\n\n")
+
+  # create 'setOverlays' function which refreshes every loaded chunk on timeline change
+  js_output.write("function setOverlays(time) {\n")
+  js_output.write("\tfor (var name in YearIndex) {\n")
+  js_output.write("\t\tupdateLayer(chunkGroups[name], name, time);\n")
+  js_output.write("\t}\n")
+  js_output.write("};\n\n")
+
+  # create 'setData' function which triggers all other functions at once
+  js_output.write("function setData(time) {\n")
+  js_output.write("\tsetBasemap(time);\n")
+  js_output.write("\tsetOverlays(time);\n")
+  js_output.write("\tcurrentYear = time;\n")
+  if settings.tile_pyramid == True:
+    js_output.write("\tloadTiles();\n")
+  if heat_manifest:
+    js_output.write("\tsetHeatmaps();\n")
+  js_output.write("};\n")
+
+  # Category toggle box injection: each category's group heading in the layer control
+  # becomes a button that switches all of its subcategories on or off together
+  js_output.write("function categoryBox(group, label, layers) {\n")
+  js_output.write("\tvar on = false;\n")
+  js_output.write("\t$( \"#leaflet-control-layers-group-name-\" + group ).button({ label: label }).click(function() {\n")
+  js_output.write("\t\tfor (var i = 0; i < layers.length; i++) {\n")
+  js_output.write("\t\t\tif (!on) {\n")
+  js_output.write("\t\t\t\tmap.addLayer(layers[i]);\n")
+  js_output.write("\t\t\t} else {\n")
+  js_output.write("\t\t\t\tmap.removeLayer(layers[i]);\n")
+  js_output.write("\t\t\t}\n")
+  js_output.write("\t\t}\n")
+  js_output.write("\t\ton = !on;\n")
+  js_output.write("\t});\n")
+  js_output.write("};\n")
+  js_output.write("\n")
+  js_output.write("function categoryBoxes() {\n")
+  for group, category in enumerate(cat_dict):
+    layers = ", ".join("{0}Markers".format(js_name(subcategory)) for subcategory in cat_dict[category])
+    js_output.write("\tcategoryBox({0}, \"{1}\", [{2}]);\n".format(group, category, layers))
+  js_output.write("};\n")
+  js_output.write("\n")
+  js_output.write("categoryBoxes();\n")
+
+# Write style.js (and the icon sprite) to 'sink': styling options for category/subcategory
+# icons and shapes, drawn from the icons in the folder 'images'. Icons of at most
+# settings.icon_inline_size bytes are written in as data URIs; with settings.icon_sprite
+# the rest are packed into one image (see sprites.py), which each icon is drawn from
+def write_style(sink, model, settings, images=IMAGES):
+  cat_dict = model["categories"]
+
+  # Search the images folder for filenames that match category/subcategory names
+  image_list = []
+  for image in os.listdir(images):
+    image_list.append(image.replace(".png", ""))
+
+  style_file = sink.open("style.js")
+
+  icon_images = OrderedDict()
+  for category in cat_dict:
+    for subcategory in cat_dict[category]:
+      icon_images[js_name(subcategory)] = js_name(subcategory) if js_name(subcategory) in image_list else "default-icon"
+  inlined = {}
+  sprite_images = OrderedDict()
+  for image in sorted(set(icon_images.values())):
+    if os.path.getsize(os.path.join(images, image + ".png")) <= settings.icon_inline_size:
+      inlined[image] = "data:image/png;base64," + base64.b64encode(open(os.path.join(images, image + ".png"), "rb").read())
+    elif settings.icon_sprite == True:
+      try:
+        sprite_images[image] = read_png(os.path.join(images, image + ".png"))
+      except ValueError as e:
+        print "\033[91mimages/" + image + ".png left out of the icon sprite: " + str(e) + "\033[0m"
+
+  # The sprite is named after its contents, like the scripts manifest.js loads
+  layout = {}
+  if sprite_images:
+    sprite_width, sprite_height, sprite_rows, layout = pack_sprite(sprite_images)
+    data = encode_png(sprite_width, sprite_height, sprite_rows)
+    sprite = "icons.{0}.png".format(hashlib.sha1(data).hexdigest()[:12])
+    output = sink.open(sprite)
+    output.write(data)
+    output.close()
+    style_file.write("// Icon sprite, and marker icons drawn from it: the 'width' x 'height' icon at 'x', 'y' in the sprite, shown 'size' pixels large\n")
+    style_file.write("var IconSprite = {{url: '{0}data/{1}', width: {2}, height: {3}}};\n".format(settings.app_path, sprite, sprite_width, sprite_height))
+    style_file.write("function spriteIcon(x, y, width, height, size, anchor) {\n")
+    style_file.write("\tvar scaleX = size[0] / width, scaleY = size[1] / height;\n")
+    style_file.write("\treturn L.divIcon({className: 'sprite-icon', iconSize: size, iconAnchor: anchor, sprite: [x, y, width, height], html: \"<div style='width: 100%; height: 100%; background: url(\" + IconSprite.url + \") \" + (-x * scaleX) + \"px \" + (-y * scaleY) + \"px / \" + (IconSprite.width * scaleX) + \"px \" + (IconSprite.height * scaleY) + \"px no-repeat'></div>\"});\n")
+    style_file.write("}\n\n\n")
+
+  for category in cat_dict:
+    for subcategory in cat_dict[category]:
+      shortsubcat = js_name(subcategory)
+      image = icon_images[shortsubcat]
+      style_file.write("// {0} marker icon and shape styling".format(subcategory))
+
+      if image in layout and image != "default-icon":
+        style_file.write("\nvar {0}Icon = spriteIcon({1}, {2}, {3}, {4}, [{5}], [{6}]);\n".format(shortsubcat, *(layout[image] + (settings.icon_size, settings.icon_anchor))))
+      elif image in layout:
+        # The default icon is drawn at its own size, with its top left corner on the marker's location
+        style_file.write("\nvar {0}Icon = spriteIcon({1}, {2}, {3}, {4}, [{3}, {4}], [0, 0]);\n".format(shortsubcat, *layout[image]))
+      else:
+        style_file.write("\nvar {0}Icon = L.icon({{\n".format(shortsubcat))
+        if image != "default-icon":
+          style_file.write("\ticonUrl: '{0}',\n".format(inlined.get(image, settings.app_path + "images/" + image + ".png")))
+          style_file.write("\ticonSize: [{0}], // icon height/width in pixels\n".format(settings.icon_size))
+          style_file.write("\ticonAnchor: [{0}], // point where icon corresponds to marker's location\n".format(settings.icon_anchor))
+        else:
+          style_file.write("\ticonUrl: '{0}',\n".format(inlined.get(image, settings.app_path + "images/default-icon.png")))
+          style_file.write("\t//iconSize: [0, 0], // icon height/width in pixels\n")
+          style_file.write("\t//iconAnchor: [0, 0], // point of the icon which will correspond to marker's location\n")
+        style_file.write("\t//popupAnchor: [0, 0] // point from which the popup should open relative to the iconAnchor\n")
+        style_file.write("});\n")
+      style_file.write("\nvar {0}ShapeStyle = {{\n".format(shortsubcat))
+      style_file.write("\t'color': '#0000ff',\n") 
+      style_file.write("\t'weight': 1,\n") 
+      style_file.write("\t'opacity': 1\n") 
+      style_file.write("};\n\n\n")
+  style_file.close()
+
+# Write out the data chunks of 'model' to 'sink' (or, when they go inline, to
+# 'js_output'): marker GeoJSON, one FeatureCollection per subcategory, and shape vars
+# with pop-ups bound, each feature written as soon as it is built. With
+# settings.popup_store, pop-up fields go to separate blocks of at most
+# settings.popup_block_size records, and features only carry [block, row]
+def write_chunks(js_output, sink, model, settings, report=None):
+  marker_list, shape_list = model["markers"], model["shapes"]
+  chunk_list, chunk_tiles = model["chunks"], model["tiles"]
+  for subcat, name, kind, ids in chunk_list:
+    records = marker_list if kind == "markers" else shape_list
+
+    enter_stage(report, "popups")
+    popups = {}
+    for position, index in enumerate(ids):
+      record = records[index]
+      if settings.popup_store == True:
+        block, row = divmod(position, settings.popup_block_size)
+        if row == 0:
+          strings, string_ids, rows = [""], {"": 0}, []
+        rows.append(popup_row(record, strings, string_ids))
+        if row == settings.popup_block_size - 1 or position == len(ids) - 1:
+          write_popup_block(sink, "{0}.popups.{1}".format(name, block), strings, rows)
+        popups[index] = "[{0},{1}]".format(block, row)
+      else:
+        popups[index] = popup_text(record)
+
+    # Cluster centres and the cluster each marker belongs to, per zoom
+    enter_stage(report, "clusters")
+    levels = None
+    if kind == "markers" and settings.precluster == True:
+      levels = build_clusters([(float(records[index]["lon"]), float(records[index]["lat"])) for index in ids], settings.min_zoom, settings.max_zoom, settings.cluster_radius)
+      for z in levels:
+        levels[z]["member"] = dict(zip(ids, levels[z]["member"]))
+
+    enter_stage(report, "features")
+    if settings.tile_pyramid == True:
+      for (z, x, y), tile_ids, first, last in chunk_tiles[name]:
+        tile_file = "{0}.{1}.{2}.{3}.js".format(name, z, x, y)
+        chunk_output = sink.open("chunks/" + tile_file)
+        chunk_output.write("// Leaflet data tile\n")
+        write_chunk(chunk_output, subcat, name, kind, records, tile_ids, popups, levels, settings)
+        chunk_output.close()
+    elif settings.lazy_chunks == True:
+      chunk_output = sink.open("chunks/{0}.js".format(name))
+      chunk_output.write("// Leaflet data chunk\n")
+      write_chunk(chunk_output, subcat, name, kind, records, ids, popups, levels, settings)
+      chunk_output.close()
+    else:
+      js_output.write("\n")
+      write_chunk(js_output, subcat, name, kind, records, ids, popups, levels, settings)
+
+# Hash of everything besides the sheet that decides what a build writes: the settings
+# (bar the list of targets, see run_targets()), the code of the generators and the icons
+# in the folder 'images' (which are copied into style.js's sprite)
+def generator_digest(settings, images=IMAGES):
+  generator_hash = hashlib.sha1(repr([(key, getattr(settings, key)) for key in sorted(dir(settings)) if not key.startswith("_") and key != "targets"]))
+  for module in GENERATORS:
+    generator_hash.update(open(os.path.join(HERE, module)).read())
+  # The heatmaps are only drawn when NumPy is installed
+  generator_hash.update(repr(numpy is not None))
+  for image in sorted(os.listdir(images)):
+    generator_hash.update(open(os.path.join(images, image), "rb").read())
+  return generator_hash.hexdigest()
+
+# Hash of a build: of the sheet's data (parse_sheet()'s "digest") and the generators
+def build_digest(sheet_digest, generator):
+  build_hash = hashlib.sha1(sheet_digest)
+  build_hash.update(generator)
+  return build_hash.hexdigest()
+
+# Write out the build of 'model' to 'sink': data.js, style.js (if settings.style_refresh)
+# and the data chunks, whose names start with "chunks/". The chunks are published
+# together, in a folder named after the build's 'release' (by default the start of its
+# hash), which the page fetches them from
+def emit(model, sink, settings, release=None, report=None, images=IMAGES):
+  if report is None:
+    report = new_report()
+  if release is None:
+    release = build_digest(model["digest"], generator_digest(settings, images))[:12]
+  chunk_url = "{0}data/chunks/{1}/".format(settings.app_path, release)
+
+  for name, image in model["heat_images"].items():
+    image_output = sink.open("chunks/" + name)
+    image_output.write(image)
+    image_output.close()
+
+  enter_stage(report, "style")
+  if settings.style_refresh == True:
+    write_style(sink, model, settings, images)
+
+  enter_stage(report, "scripts")
+  js_output = sink.open("data.js")
+  write_scripts(js_output, model, settings, release, chunk_url)
+  write_chunks(js_output, sink, model, settings, report)
+
+  # The search index goes with the chunks, to be fetched the first time the page is searched
+  if settings.search_index == True:
+    enter_stage(report, "search")
+    marker_list, shape_list = model["markers"], model["shapes"]
+    search_features = []
+    for subcat, name, kind, ids in model["chunks"]:
+      records = marker_list if kind == "markers" else shape_list
+      for index in ids:
+        date_type, syear, eyear = date_span(records[index])
+        if eyear is not None and eyear < syear:
+          continue
+        box = record_box(records[index], kind)
+        search_features.append((name, str(index) if kind == "markers" else "shape{0}".format(index), records[index], [(box[0] + box[2]) / 2.0, (box[1] + box[3]) / 2.0]))
+    search_output = sink.open("chunks/search.json")
+    json.dump(build_index(search_features), search_output, separators=(",", ":"))
+    search_output.close()
+
+  js_output.close()
+
+# Timestamp builds are kept in the backup store under
+def build_time():
+  t = time.localtime()
+  return '%d-%02d-%02d@%02d:%02d:%02d' % (t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec)
+
+# Build 'sources' (see fetch_sources()) and publish the build into 'folder', the way
+# csv2js.py does. Everything the build writes goes to a staging folder first, and is
+# only published once it is complete (see publish.py); one build at a time may use the
+# folder. Returns how the build ended, also kept as the report's "exit":
+#
+#   "built"            a new build was published, and kept in the backup store
+#   "not modified"     no source had changed (HTTP 304), so nothing was built
+#   "unchanged"        neither the sheet, the settings nor the code had changed
+#   "download failed"  a source could not be fetched, so the build stopped
+#   "empty sheet"      the sheet had no records, so the build stopped
+#   "locked"           another build was running in 'folder'
+def run_build(folder, sources, settings, report=None, images=IMAGES):
+  if report is None:
+    report = new_report()
+  return locked_build(folder, report, lambda staging, published, tf: publish_build(folder, staging, published, sources, settings, report, images, tf))
+
+# Take the build lock for 'folder' and a staging folder in it, then run 'build' with
+# the staging folder, the list of files published (which it adds to) and the time of
+# the build. Returns what 'build' returns, or "locked"
+def locked_build(folder, report, build):
+  tf = build_time()
+  build_lock = lock_folder(folder)
+  if build_lock is None:
+    print "\033[91mAnother build is running in " + folder + ", try again once it has finished.\033[0m"
+    report["exit"] = "locked"
+    return report["exit"]
+  staging = new_staging(folder)
+  published = ["data.js", "style.js", "data.csv", "build_cache.json"]
+  try:
+    return build(staging, published, tf)
+  finally:
+    shutil.rmtree(staging, True)
+    record_outputs(report, [os.path.join(folder, name) for name in published])
+    build_lock.close()
+
+# Load the build cache left in 'folder' by the previous run (HTTP validators, content
+# hashes and shape check results), if incremental builds are on
+def load_cache(folder, settings):
+  if settings.incremental == True and os.path.exists(os.path.join(folder, "build_cache.json")):
+    return json.load(open(os.path.join(folder, "build_cache.json")))
+  return {}
+
+# The ETag and Last-Modified of each source at the last build into 'folder', to make
+# its requests conditional on, if that was built by the same code and settings
+def cached_validators(folder, build_cache, generator):
+  if os.path.exists(os.path.join(folder, "data.js")) and build_cache.get("generator") == generator:
+    return build_cache.get("sources", {})
+  return {}
+
+# The rest of run_build(), once it has the folder to itself
+def publish_build(folder, staging, published, sources, settings, report, images, tf):
+  build_cache = load_cache(folder, settings)
+  generator = generator_digest(settings, images)
+
+  # Each request is made conditional on the source's validators, so if no source has
+  # changed the build stops here. If any source fails to download, the build stops
+  # without touching data.js
+  fetched = fetch_sources(sources, settings, cached_validators(folder, build_cache, generator), report)
+  if all(status["state"] == "not modified" for status in fetched):
+    print "\033[92mSpreadsheet unchanged (HTTP 304), data.js is up to date.\033[0m"
+    report["exit"] = "not modified"
+    return report["exit"]
+  if [status for status in fetched if status["state"] != "ok"]:
+    for status in fetched:
+      if "body" in status:
+        status["body"].close()
+    print "\033[91mBuild stopped, data.js is unchanged.\033[0m"
+    report["exit"] = "download failed"
+    return report["exit"]
+
+  # Optionally copy each line to local file 'data.csv' as it goes past, for auditing
+  csv_local = None
+  if settings.save_csv == True:
+    csv_local = open(os.path.join(staging, "data.csv"), "w")
+  sheet = read_sheet(fetched, csv_local, report)
+  if csv_local is not None:
+    csv_local.close()
+  if sheet is None:
+    print "\033[91mBuild stopped, data.js is unchanged.\033[0m"
+    report["exit"] = "download failed"
+    return report["exit"]
+  return publish_sheet(folder, staging, published, fetched, sheet, build_cache, generator, settings, report, images, tf)
+
+# Build a parsed sheet, fetched as 'fetched' says, and publish it into 'folder' from
+# 'staging', for run_build() and build_target()
+def publish_sheet(folder, staging, published, fetched, sheet, build_cache, generator, settings, report, images, tf):
+  # A sheet without a single record (an empty download, or standard input that was
+  # already read to the end) is never published in place of the current build
+  if not sheet["maps"] and not sheet["markers"] and not sheet["shapes"]:
+    print "\033[91mThe spreadsheet has no records, build stopped, data.js is unchanged.\033[0m"
+    report["exit"] = "empty sheet"
+    return report["exit"]
+
+  # Skip the rest of the build if neither the spreadsheet contents nor the settings
+  # and the code have changed since data.js was last written
+  build_hash = build_digest(sheet["digest"], generator)
+  release = build_hash[:12]
+  build_cache["sources"] = dict((status["url"], {"etag": status["etag"], "last_modified": status["last_modified"]}) for status in fetched)
+  if build_cache.get("build") == build_hash and os.path.exists(os.path.join(folder, "data.js")):
+    write_file(os.path.join(folder, "build_cache.json"), json.dumps(build_cache))
+    print "\033[92mSpreadsheet unchanged, data.js is up to date.\033[0m"
+    report["exit"] = "unchanged"
+    return report["exit"]
+
+  model = build_model(sheet, settings, build_cache, report)
+  emit(model, FolderSink(staging), settings, release, report, images)
+
+  # Publish the new build and keep it in the backup store. Builds from before the store
+  # was in use (the published data.js, and timestamped copies of old ones) go in first
+  enter_stage(report, "publish")
+  store = os.path.join(folder, "backups")
+  if not os.path.exists(store):
+    print "Backups dir missing."
+    print "Creating " + store + "/"
+    os.mkdir(store)
+  import_copies(store)
+  if not load_index(store) and os.path.exists(os.path.join(folder, "data.js")):
+    add_build(store, folder, build_cache.get("build", "")[:12] or None, time.strftime(TIME_FORMAT, time.localtime(os.path.getmtime(os.path.join(folder, "data.js")))))
+  # style.js is republished as it is when it has not been refreshed, so manifest.js can list it
+  if not os.path.exists(os.path.join(staging, "style.js")) and os.path.exists(os.path.join(folder, "style.js")):
+    shutil.copyfile(os.path.join(folder, "style.js"), os.path.join(staging, "style.js"))
+    # along with the icon sprite it loads
+    sprite = style_sprite(os.path.join(folder, "style.js"))
+    if sprite and os.path.exists(os.path.join(folder, sprite)):
+      shutil.copyfile(os.path.join(folder, sprite), os.path.join(staging, sprite))
+  artifacts = prepare_artifacts(staging, settings.app_path)
+  release_chunks = publish(staging, folder, release, ["data.csv"] + artifacts)
+  published.extend(name for name in artifacts if not name in published)
+  if release_chunks:
+    published.append(release_chunks)
+  backup = add_build(store, folder, release if release_chunks else None, tf)
+
+  # Clear out the chunks of all but the last few releases, which pages loaded before
+  # this one was published may still be fetching from, and thin out the backup store
+  enter_stage(report, "cleanup")
+  prune_releases(folder, release, settings.keep_releases)
+  prune_artifacts(folder, settings.keep_releases + 1)
+  prune(store, settings.backup_keep_last, settings.backup_keep_days, settings.backup_keep_weeks)
+
+  # Remember this build so an unchanged sheet can be skipped next time. Records are
+  # not reused one at a time: hashing a record to look up its cached pop-up and
+  # GeoJSON cost more than building them again (8x slower over 50k records), so
+  # caches from builds that kept them lose their "fragments"
+  if settings.incremental == True:
+    build_cache["build"] = build_hash
+    build_cache["generator"] = generator
+    build_cache.pop("fragments", None)
+    write_file(os.path.join(folder, "build_cache.json"), json.dumps(build_cache))
+
+  report["exit"] = "built"
+  print "\033[92mDone!\033[0m"
+  print "New data.js published, and kept in the backups as:"
+  print store + "/ \033[91m" + tf + " (" + backup[:12] + ")\033[0m"
+  return report["exit"]
+
+# List the builds in the backup store of 'folder' (see backup_store.py), with how much
+# each one added to it
+def list_builds(folder):
+  store = os.path.join(folder, "backups")
+  index = load_index(store)
+  for position, entry in enumerate(index):
+    size, added = build_size(store, entry["build"], index[:position])
+    print "{0}  {1}  {2:>10} bytes  {3:>10} new".format(entry["time"], entry["build"][:12], size, added)
+
+# Publish the build kept in the backup store of 'folder' from time 'when' (or the start
+# of it), or with a hash starting 'when', again in place of the current build. Returns
+# "restored", "restore failed" (no build matches) or "locked", as run_build() does
+def restore(folder, when, settings, report=None):
+  if report is None:
+    report = new_report()
+  store = os.path.join(folder, "backups")
+  build_lock = lock_folder(folder)
+  if build_lock is None:
+    print "\033[91mAnother build is running in " + folder + ", try again once it has finished.\033[0m"
+    report["exit"] = "locked"
+    return report["exit"]
+  staging = new_staging(folder)
+  try:
+    entry = find_build(store, when)
+    if entry is None:
+      print "\033[91mNo build in " + store + " matches '" + when + "'.\033[0m"
+      report["exit"] = "restore failed"
+      return report["exit"]
+    enter_stage(report, "restore")
+    restored = restore_build(store, entry["build"], staging)
+    publish(staging, folder, restored, prepare_artifacts(staging, settings.app_path))
+    prune_releases(folder, restored, settings.keep_releases)
+    prune_artifacts(folder, settings.keep_releases + 1)
+    record_build(store, entry["build"], build_time())
+    # The next run rebuilds from the spreadsheet only if it has changed since the last build
+    build_cache = {}
+    if settings.incremental == True and os.path.exists(os.path.join(folder, "build_cache.json")):
+      build_cache = json.load(open(os.path.join(folder, "build_cache.json")))
+    build_cache.pop("build", None)
+    write_file(os.path.join(folder, "build_cache.json"), json.dumps(build_cache))
+    report["exit"] = "restored"
+    print "\033[92mRestored the build from " + entry["time"] + " (" + entry["build"][:12] + ").\033[0m"
+    return report["exit"]
+  finally:
+    shutil.rmtree(staging, True)
+    build_lock.close()
+
+# Settings of one deployment (a target, see settings.targets): every setting of
+# 'settings', with those the target sets in its place. Unlike the settings module,
+# these can be sent to another process
+class TargetSettings(object):
+  def __init__(self, settings, target):
+    for key in dir(settings):
+      if not key.startswith("_") and key != "targets":
+        setattr(self, key, getattr(settings, key))
+    for key, value in target.items():
+      if not key in ["name", "folder"]:
+        setattr(self, key, value)
+
+# Sheets fetched and parsed for run_targets(), by the URLs of their sources. Kept here
+# rather than sent to each build_target() call, as the pool's processes inherit them
+SHEETS = {}
+
+# Build and publish the same data to several deployments at once: 'targets' is a list of
+# dicts with each one's "name", the "folder" its data is published into and any settings
+# to use in place of 'settings' (including "sources", to build another sheet; 'sources'
+# replaces every target's if given). Each distinct sheet is fetched, parsed and has its
+# shapes checked once; the targets are then built and published as run_build() does,
+# up to settings.target_workers at a time, each in a process of its own. Returns how
+# each target's build ended (see run_build(), or "failed" if it raised an error, such
+# as for a folder that does not exist), by name
+def run_targets(targets, settings, sources=None, report=None, images=IMAGES):
+  if report is None:
+    report = new_report()
+  plans = OrderedDict()
+  for target in targets:
+    profile = TargetSettings(settings, target)
+    target_sources = sources or profile.sources
+    key = tuple(source_url(source) if isinstance(source, (tuple, basestring)) else "rows:{0}".format(id(source)) for source in target_sources)
+    plans.setdefault(key, (target_sources, []))[1].append((target["name"], target.get("folder", "."), profile))
+
+  exits = OrderedDict()
+  tasks = []
+  sources_fetched = []
+  copies = []
+  try:
+    for key, (target_sources, group) in plans.items():
+      # Requests are only made conditional if every target built from the sheet had the
+      # same validators at its last build (as they do when they were built together)
+      caches = [load_cache(folder, target_settings) for name, folder, target_settings in group]
+      validators = [cached_validators(folder, build_cache, generator_digest(target_settings, images)) for (name, folder, target_settings), build_cache in zip(group, caches)]
+      fetched = fetch_sources(target_sources, group[0][2], validators[0] if all(validators) and validators.count(validators[0]) == len(validators) else {}, report)
+      sources_fetched.extend(fetched)
+      report["sources"] = sources_fetched
+      if all(status["state"] == "not modified" for status in fetched):
+        print "\033[92mSpreadsheet unchanged (HTTP 304), data.js is up to date in " + ", ".join(name for name, folder, target_settings in group) + ".\033[0m"
+        exits.update((name, "not modified") for name, folder, target_settings in group)
+        continue
+      if [status for status in fetched if status["state"] != "ok"]:
+        for status in fetched:
+          if "body" in status:
+            status["body"].close()
+        print "\033[91mBuild stopped, data.js is unchanged in " + ", ".join(name for name, folder, target_settings in group) + ".\033[0m"
+        exits.update((name, "download failed") for name, folder, target_settings in group)
+        continue
+
+      # The sheet is copied once, for the targets that keep a copy in data.csv
+      copy, copy_path = None, None
+      if any(target_settings.save_csv == True for name, folder, target_settings in group):
+        copy_handle, copy_path = tempfile.mkstemp(prefix="sheet-", suffix=".csv")
+        copies.append(copy_path)
+        copy = os.fdopen(copy_handle, "w")
+      sheet = read_sheet(fetched, copy, report)
+      if copy is not None:
+        copy.close()
+      if sheet is None:
+        print "\033[91mBuild stopped, data.js is unchanged in " + ", ".join(name for name, folder, target_settings in group) + ".\033[0m"
+        exits.update((name, "download failed") for name, folder, target_settings in group)
+        continue
+
+      # Shapes are checked here, across settings.shape_workers processes, seeded from
+      # whichever target's build cache has results from the same shapes.py
+      enter_stage(report, "check shapes")
+      shape_cache = {"shape_checker": shape_checker(), "shapes": {}}
+      for build_cache in caches:
+        if build_cache.get("shape_checker") == shape_cache["shape_checker"]:
+          shape_cache["shapes"].update(build_cache.get("shapes", {}))
+      check_shapes(sheet["shapes"], settings.shape_workers, shape_cache)
+      SHEETS[key] = (sheet, [dict((field, value) for field, value in status.items() if field != "body") for status in fetched], copy_path, shape_cache)
+      for name, folder, target_settings in group:
+        tasks.append((name, folder, target_settings, key, images))
+
+    enter_stage(report, "targets")
+    for task in tasks:
+      print "Building " + task[0] + " into " + os.path.abspath(task[1])
+    if len(tasks) < 2 or settings.target_workers == 1:
+      results = [build_target(task) for task in tasks]
+    else:
+      pool = multiprocessing.Pool(min(settings.target_workers or multiprocessing.cpu_count(), len(tasks)))
+      try:
+        results = pool.map(build_target, tasks, 1)
+      finally:
+        pool.close()
+        pool.join()
+  finally:
+    for copy_path in copies:
+      os.remove(copy_path)
+    SHEETS.clear()
+
+  for task, (target_exit, target_report) in zip(tasks, results):
+    exits[task[0]] = target_exit
+    report["outputs"].update(target_report["outputs"])
+    report["targets"].append({"name": task[0], "folder": os.path.abspath(task[1]), "exit": target_exit,
+      "records": target_report["records"], "stages": target_report["stages"]})
+  exits = OrderedDict((target["name"], exits[target["name"]]) for target in targets)
+  if exits:
+    report["exit"] = "built" if "built" in exits.values() else exits.values()[0]
+  return exits
+
+# Build and publish one target of run_targets(), in a process of the pool: 'task' is
+# its name, folder, settings, the key of its sheet in SHEETS and the icons folder.
+# Returns how its build ended, and its report. An error ends only this target's build,
+# as "failed", so the other targets still build
+def build_target(task):
+  name, folder, target_settings, key, images = task
+  sheet, fetched, copy_path, shape_cache = SHEETS[key]
+  report = new_report()
+  enter_stage(report, "setup")
+
+  def build(staging, published, tf):
+    if target_settings.save_csv == True:
+      shutil.copyfile(copy_path, os.path.join(staging, "data.csv"))
+    build_cache = load_cache(folder, target_settings)
+    build_cache.update(shape_cache)
+    return publish_sheet(folder, staging, published, fetched, sheet, build_cache, generator_digest(target_settings, images), target_settings, report, images, tf)
+
+  try:
+    target_exit = locked_build(folder, report, build)
+  except Exception as e:
+    print "\033[91mBuilding {0} failed, its data.js is unchanged: {1}: {2}\033[0m".format(name, e.__class__.__name__, e)
+    report["exit"] = target_exit = "failed"
+  enter_stage(report, None)
+  return target_exit, report
@@ -0,0 +1,87 @@
+# Atomic publication of csv2js.py's output
+#
+# The page loads data.js and style.js, and data.js fetches its data chunks from
+# chunks/. Writing those in place would let a visitor (or a crash part way through)
+# catch a missing or half-written file, so a build writes everything into a staging
+# folder beside them and only publishes it once the whole build is written:
+#
+#   1. the build's chunks are moved, as one folder, to chunks/<release>/, which only
+#      the new data.js refers to
+#   2. the new files (style.js, then data.js) are renamed over the published ones
+#
+# A rename within one filesystem is atomic, so a visitor gets either the old file or
+# the new one. Pages loaded before the swap go on fetching their own build's chunks,
+# as the last few releases are kept.
+
+import fcntl
+import os
+import shutil
+import tempfile
+
+
+STAGING_PREFIX = ".staging-"
+
+
+# Take the build lock for 'folder', so only one build writes there at a time. Returns
+# the open lock file (keep it open until the build is done), or None if another build has it
+def lock_folder(folder):
+  lock = open(os.path.join(folder, ".build.lock"), "w")
+  try:
+    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except IOError:
+    lock.close()
+    return None
+  return lock
+
+# Make a new, empty staging folder (with a chunks/ folder inside) in 'folder',
+# clearing out any left behind by builds that crashed
+def new_staging(folder):
+  for name in os.listdir(folder):
+    if name.startswith(STAGING_PREFIX):
+      shutil.rmtree(os.path.join(folder, name), ignore_errors=True)
+  staging = tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=folder)
+  os.mkdir(os.path.join(staging, "chunks"))
+  return staging
+
+# Write 'text' to 'path' by way of a temporary file renamed over it
+def write_file(path, text):
+  output = open(path + ".tmp", "w")
+  output.write(text)
+  output.close()
+  os.rename(path + ".tmp", path)
+
+# Publish a finished build from 'staging' to 'folder': its chunks (if any) move to
+# chunks/<release>/, then each of the files in 'names' the build wrote is renamed over
+# the published one, in order. Returns the release's chunk folder, or None if it has none
+def publish(staging, folder, release, names):
+  chunks = None
+  if os.listdir(os.path.join(staging, "chunks")):
+    chunks = os.path.join(folder, "chunks", release)
+    if not os.path.exists(os.path.join(folder, "chunks")):
+      os.mkdir(os.path.join(folder, "chunks"))
+    # A release that already exists was built from the same sheet and settings, so it
+    # is left as it is (pages may be reading it), and only marked as the newest
+    if os.path.exists(chunks):
+      os.utime(chunks, None)
+    else:
+      os.rename(os.path.join(staging, "chunks"), chunks)
+  for name in names:
+    if os.path.exists(os.path.join(staging, name)):
+      os.rename(os.path.join(staging, name), os.path.join(folder, name))
+  return chunks
+
+# Remove all but the 'keep' most recently published releases from 'folder'/chunks,
+# besides 'current', along with any loose chunk files left from before releases
+def prune_releases(folder, current, keep):
+  chunks = os.path.join(folder, "chunks")
+  if not os.path.exists(chunks):
+    return
+  releases = []
+  for name in os.listdir(chunks):
+    path = os.path.join(chunks, name)
+    if not os.path.isdir(path):
+      os.remove(path)
+    elif name != current:
+      releases.append((os.path.getmtime(path), name))
+  for mtime, name in sorted(releases, reverse=True)[keep:]:
+    shutil.rmtree(os.path.join(chunks, name), ignore_errors=True)
@@ -0,0 +1,84 @@
+# Build instrumentation for csv2js.py
+#
+# The build is a straight-line script, so it is timed by marking where each stage
+# starts: enter_stage() closes the stage before it, adding its wall time to that
+# stage's total (stages such as pop-up and feature generation alternate per chunk,
+# so a stage can be entered many times). The process's peak resident memory is
+# sampled as each stage closes; Python 2 has no tracemalloc, so this is the OS
+# high-water mark from getrusage(), and a stage that raised it shows a non-zero
+# 'peak_growth_bytes'.
+
+import json
+import os
+import resource
+import sys
+import time
+
+
+# Peak resident memory of this process so far, in bytes (ru_maxrss is in
+# kilobytes on Linux and bytes on OS X)
+def peak_memory():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+# Start an empty report, timing from now
+def new_report():
+  return {"started": time.time(), "stages": [], "current": None, "rows": {}, "rows_skipped": {}, "records": {}, "sources": [], "outputs": {}, "targets": [], "exit": None}
+
+# Close the running stage and start the one called 'name' (None to just close)
+def enter_stage(report, name):
+  now = time.time()
+  current = report["current"]
+  if current is not None:
+    peak = peak_memory()
+    current["seconds"] += now - current["entered"]
+    current["peak_growth_bytes"] += max(0, peak - current["peak_at_entry"])
+    current["peak_memory_bytes"] = peak
+  report["current"] = None
+  if name is None:
+    return
+  for stage in report["stages"]:
+    if stage["stage"] == name:
+      break
+  else:
+    stage = {"stage": name, "seconds": 0.0, "entries": 0, "peak_memory_bytes": 0, "peak_growth_bytes": 0}
+    report["stages"].append(stage)
+  stage["entries"] += 1
+  stage["entered"] = now
+  stage["peak_at_entry"] = peak_memory()
+  report["current"] = stage
+
+# Count a spreadsheet row of the given Type, under "rows" if it was kept and under
+# "rows_skipped" if it was left out (missing a required cell, or invalid)
+def count_row(report, kind, kept):
+  counts = report["rows"] if kept else report["rows_skipped"]
+  counts[kind] = counts.get(kind, 0) + 1
+
+# Record the size of every file in 'paths' that exists, and of the files in any
+# directory among them
+def record_outputs(report, paths):
+  for path in paths:
+    if os.path.isdir(path):
+      record_outputs(report, [os.path.join(path, name) for name in sorted(os.listdir(path))])
+    elif os.path.exists(path):
+      report["outputs"][path] = os.path.getsize(path)
+
+# The stages of a report as written out
+def stage_summaries(stages):
+  summaries = []
+  for stage in stages:
+    summaries.append({"stage": stage["stage"], "seconds": round(stage["seconds"], 4), "entries": stage["entries"],
+      "peak_memory_bytes": stage["peak_memory_bytes"], "peak_growth_bytes": stage["peak_growth_bytes"]})
+  return summaries
+
+# Close the report and write it to 'path' as JSON. With several targets (see
+# pipeline.run_targets()), the stages of each target's build, which ran in a process of
+# its own, are listed under its name ('peak_memory_bytes' is that process's)
+def write_report(report, path):
+  enter_stage(report, None)
+  output = {"seconds": round(time.time() - report["started"], 4), "peak_memory_bytes": peak_memory(), "exit": report["exit"],
+    "stages": stage_summaries(report["stages"]), "rows": report["rows"], "rows_skipped": report["rows_skipped"], "records": report["records"],
+    "sources": [dict((key, value) for key, value in status.items() if key != "body") for status in report["sources"]],
+    "outputs": report["outputs"], "output_bytes": sum(report["outputs"].values())}
+  if report["targets"]:
+    output["targets"] = [dict(target, stages=stage_summaries(target["stages"])) for target in report["targets"]]
+  json.dump(output, open(path, "w"), indent=2, sort_keys=True)
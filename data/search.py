@@ -0,0 +1,53 @@
+# Search index for csv2js.py
+#
+# Builds an inverted index over the text of the markers and shapes (title,
+# description, locations and source), so the page can find records by keyword or
+# place without looking through every pop-up. Text is cut into terms the same way
+# the page cuts up what is typed into the search box: markup dropped, accents
+# folded, lower case, runs of letters and digits. Terms are kept sorted, so the
+# page finds every term starting with a word typed (a prefix) by binary search.
+
+import re
+import unicodedata
+
+
+# Record fields searched
+FIELDS = ["title", "desc", "hist-loc", "pres-loc", "src"]
+
+# Words too common to be worth indexing
+STOP_WORDS = set(["a", "an", "and", "as", "at", "by", "for", "from", "in", "is", "of", "on", "or", "the", "to", "was", "with"])
+
+
+# Split text into search terms
+def terms(text):
+  text = re.sub(r"<[^>]*>|&#?\w+;", " ", text.decode("utf-8", "replace"))
+  text = "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c)).lower()
+  return [term for term in re.findall(r"[a-z0-9]+", text.encode("ascii", "ignore")) if len(term) > 1 and not term in STOP_WORDS]
+
+# Build the index of 'features': (chunk name, feature id, record, [lon, lat]) tuples.
+# Returns it as a dict of
+#   "chunks": the chunk names
+#   "features": [chunk position, feature id, start year, end year (None if
+#     open-ended), title, lon, lat] for each feature
+#   "terms": every term, sorted
+#   "postings": for each term, the positions of the features it appears in, each
+#     given as the difference from the one before
+def build_index(features):
+  chunks, chunk_ids, rows, postings = [], {}, [], {}
+  for chunk, feature_id, record, (lon, lat) in features:
+    if not chunk in chunk_ids:
+      chunk_ids[chunk] = len(chunks)
+      chunks.append(chunk)
+    syear = int(record["syear"])
+    eyear = int(record["eyear"]) if record["eyear"] != "" else None
+    position = len(rows)
+    rows.append([chunk_ids[chunk], feature_id, syear, eyear, record["title"], round(lon, 4), round(lat, 4)])
+    for field in FIELDS:
+      for term in terms(record[field]):
+        if not postings.get(term) or postings[term][-1] != position:
+          postings.setdefault(term, []).append(position)
+  sorted_terms = sorted(postings)
+  deltas = []
+  for term in sorted_terms:
+    deltas.append([position - previous for previous, position in zip([0] + postings[term][:-1], postings[term])])
+  return {"chunks": chunks, "features": rows, "terms": sorted_terms, "postings": deltas}
@@ -5,15 +5,114 @@ app_path = "http://www.indiana.edu/~kdglobal/worldmap-test/"
 #gdoc_id = "1QoUlncYbfQi50y9TO20LvlPaox8JjHkBNaSujl-D_EE" #Main
 gdoc_id = "17EabushNWBxGeNpWNBAJp2E97eZt08k7Z5m-G7eqQmk" #Dev
 
+# Spreadsheet tabs to build from, merged in this order: (gdoc_id, gid) pairs, URLs or local CSV files
+sources = [(gdoc_id, 0)]
+
+# Deployments to publish to in one run, each a dict with its "name", the "folder" its data is published
+# into (relative to this one) and any of these settings to use there instead, such as "app_path", the
+# zoom limits or the icon settings ("sources" to build it from another spreadsheet). Each spreadsheet is
+# downloaded and parsed once for all of them. Leave empty to publish into this folder only
+targets = []
+#targets = [
+#  {"name": "test", "folder": ".", "app_path": "http://www.indiana.edu/~kdglobal/worldmap-test/"},
+#  {"name": "dev", "folder": "../../worldmap-dev/data", "app_path": "http://www.indiana.edu/~kdglobal/worldmap-dev/"},
+#  {"name": "main", "folder": "../../worldmap/data", "app_path": "http://www.indiana.edu/~kdglobal/worldmap/", "sources": [("1QoUlncYbfQi50y9TO20LvlPaox8JjHkBNaSujl-D_EE", 0)]},
+#]
+
+# Number of targets built at once, each in a process of its own (0 for one per CPU core)
+target_workers = 0
+
+# Number of sources downloaded at once
+fetch_workers = 4
+
+# Seconds to wait on a source's server before giving up on a download attempt
+fetch_timeout = 60
+
+# Times a failed download is retried, and seconds to wait before the first retry (doubling after each)
+fetch_retries = 3
+fetch_backoff = 1
+
 # Refresh style.js? Must be True or False (capitalized)
 style_refresh = True 
 
+# Keep a copy of the downloaded spreadsheet in data.csv? Must be True or False (capitalized)
+save_csv = True
+
+# Skip rebuilding when the spreadsheet is unchanged, and reuse shape checks for unchanged cells? (True or False)
+incremental = True
+
+# Split marker/shape data into per-subcategory chunks that load when a layer is switched on? (True or False)
+lazy_chunks = True
+
+# Write markers as compact parallel arrays instead of GeoJSON objects? (True or False)
+columnar_markers = True
+
+# Decimal places kept for marker coordinates in the compact encoding
+coord_precision = 4
+
+# Keep pop-up contents out of the data chunks, loading them in blocks when first opened? (True or False)
+popup_store = True
+
+# Number of pop-ups in each block of the pop-up store
+popup_block_size = 500
+
+# Simplify and quantize shape geometry for each zoom level? (True or False)
+simplify_shapes = True
+
+# Number of processes used to parse and check shape GeoJSON (0 for one per CPU core)
+shape_workers = 0
+
+# Largest simplification error allowed for shapes, in screen pixels at each zoom level
+shape_tolerance = 1
+
+# Grid size shape coordinates are quantized to, across each chunk's bounding box
+shape_quantization = 100000
+
+# Precompute marker clusters for each zoom level instead of clustering in the browser? (True or False)
+precluster = True
+
+# Radius markers are clustered within, in screen pixels
+cluster_radius = 80
+
+# Export markers and shapes as a z/x/y tile pyramid, fetched by the page for the area in view? (True or False)
+tile_pyramid = False
+
+# Show the subcategories with the most markers as a density heatmap when zoomed out, instead of their markers? Needs NumPy (True or False)
+heatmaps = False
+
+# Subcategories with at least this many markers get a heatmap
+heatmap_min_markers = 500
+
+# Highest zoom level heatmaps are shown at (markers are shown when zoomed in further)
+heatmap_max_zoom = 3
+
+# Size of a heatmap cell, and the radius each marker is spread over, in screen pixels
+heatmap_cell = 4
+heatmap_radius = 15
+
+# Build a search index over the records' text, fetched by the page the first time it is searched? (True or False)
+search_index = True
+
+# Number of earlier builds whose chunks are kept, for pages loaded before a new build was published
+keep_releases = 3
+
+# Builds kept in backups/: the last few, then the last of each of the most recent days and weeks
+backup_keep_last = 10
+backup_keep_days = 7
+backup_keep_weeks = 8
+
 # Size of custom icons (width, height in pixels)
 icon_size = "30, 50"
 
 # Anchor point (position of icon relative to point it is marking)
 icon_anchor = "15, 0"
 
+# Pack the subcategory icons into one sprite image, loaded once for every marker? (True or False)
+icon_sprite = True
+
+# Icons of at most this many bytes are written into style.js as data URIs instead (0 for none)
+icon_inline_size = 512
+
 # initial lat/long coordinates for map center
 init_center = [20, -35]
 
@@ -25,3 +124,9 @@ max_zoom = 5
 
 #minimum zoom
 min_zoom = 2
+
+# Map bounds, [[south, west], [north, east]]
+map_bounds = [[-68.13885, -178.59385], [79.68718, 189.14063]]
+
+# Address of the local tile server (python mirror.py serve) to load basemaps from, or None to load them from their original hosts
+tile_mirror = None
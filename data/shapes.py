@@ -0,0 +1,99 @@
+# Shape GeoJSON checking for csv2js.py
+#
+# Parses and validates the GeoJSON pasted into the spreadsheet's 'GeoJSON' column,
+# so a malformed cell is caught at build time instead of breaking data.js in the
+# browser. Each cell is re-serialized with uniform number formatting, and its
+# bounding box and vertex count are worked out along the way. Cells are processed
+# independently, so check_cells() can spread them across a process pool.
+
+import json
+import math
+import multiprocessing
+
+from topology import geometries, each_position
+
+
+# Fewest cells, or bytes of GeoJSON, worth starting a process pool for: below both,
+# checking the cells takes less time than starting the pool's processes
+POOL_MIN_CELLS = 300
+POOL_MIN_BYTES = 2 * 1024 * 1024
+
+# Nesting depth of positions in each geometry type's coordinates
+DEPTHS = {"Point": 0, "MultiPoint": 1, "LineString": 1, "MultiLineString": 2, "Polygon": 2, "MultiPolygon": 3}
+
+# Raise ValueError if 'coordinates' is not positions nested 'depth' lists deep
+def check_coordinates(coordinates, depth, kind):
+  if depth == 0:
+    if not isinstance(coordinates, list) or len(coordinates) < 2:
+      raise ValueError("{0} has a position that is not a list of at least two numbers".format(kind))
+    for number in coordinates:
+      if isinstance(number, bool) or not isinstance(number, (int, long, float)) or math.isinf(number) or math.isnan(number):
+        raise ValueError("{0} has a position with a value that is not a number: {1}".format(kind, json.dumps(number)))
+    return
+  if not isinstance(coordinates, list):
+    raise ValueError("{0} coordinates are not nested {1} lists deep".format(kind, depth + 1))
+  for child in coordinates:
+    check_coordinates(child, depth - 1, kind)
+  if kind == "LineString" and depth == 1 and len(coordinates) < 2:
+    raise ValueError("LineString has fewer than two positions")
+  if kind in ["Polygon", "MultiPolygon"] and depth == 1 and len(coordinates) < 4:
+    raise ValueError("{0} has a ring with fewer than four positions".format(kind))
+
+# Raise ValueError if 'geojson' is not a valid GeoJSON object
+def check_geojson(geojson):
+  if not isinstance(geojson, dict) or not "type" in geojson:
+    raise ValueError("not a GeoJSON object")
+  kind = geojson["type"]
+  if kind == "FeatureCollection":
+    if not isinstance(geojson.get("features"), list):
+      raise ValueError("FeatureCollection has no 'features' list")
+    for feature in geojson["features"]:
+      if not isinstance(feature, dict) or feature.get("type") != "Feature":
+        raise ValueError("FeatureCollection contains something other than a Feature")
+      check_geojson(feature)
+  elif kind == "Feature":
+    if geojson.get("geometry") is not None:
+      check_geojson(geojson["geometry"])
+  elif kind == "GeometryCollection":
+    if not isinstance(geojson.get("geometries"), list):
+      raise ValueError("GeometryCollection has no 'geometries' list")
+    for geometry in geojson["geometries"]:
+      check_geojson(geometry)
+  elif kind in DEPTHS:
+    if not "coordinates" in geojson:
+      raise ValueError("{0} has no coordinates".format(kind))
+    check_coordinates(geojson["coordinates"], DEPTHS[kind], kind)
+  else:
+    raise ValueError("unknown GeoJSON type {0}".format(json.dumps(kind)))
+
+# Reject the non-standard NaN/Infinity literals Python's json module lets through
+def reject_constant(name):
+  raise ValueError("{0} is not valid JSON".format(name))
+
+# Parse and check one GeoJSON cell. Returns {"json": normalized GeoJSON, "box": [west,
+# south, east, north], "vertices": position count}, or {"error": message}
+def check_cell(cell):
+  try:
+    geojson = json.loads(cell, parse_constant=reject_constant)
+    check_geojson(geojson)
+  except ValueError as e:
+    return {"error": str(e)}
+  positions = []
+  for geometry in geometries(geojson):
+    each_position(geometry, positions.append)
+  if not positions:
+    return {"error": "no coordinates"}
+  box = [min(p[0] for p in positions), min(p[1] for p in positions), max(p[0] for p in positions), max(p[1] for p in positions)]
+  return {"json": json.dumps(geojson, separators=(",", ":")), "box": box, "vertices": len(positions)}
+
+# Check a list of cells, using a pool of 'workers' processes (0 for one per CPU core)
+# when there are enough of them to be worth it. Results are in the same order as 'cells'
+def check_cells(cells, workers):
+  if (len(cells) < POOL_MIN_CELLS and sum(len(cell) for cell in cells) < POOL_MIN_BYTES) or len(cells) < 2 or workers == 1:
+    return [check_cell(cell) for cell in cells]
+  pool = multiprocessing.Pool(workers or None)
+  try:
+    return pool.map(check_cell, cells, max(1, len(cells) // (4 * (workers or multiprocessing.cpu_count()))))
+  finally:
+    pool.close()
+    pool.join()
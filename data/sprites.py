@@ -0,0 +1,161 @@
+# Icon sprites for csv2js.py
+#
+# Packs the subcategory icons in images/ into one image, so the page loads a single
+# file for all its marker icons instead of one per subcategory. PNGs are read and
+# written with zlib and struct alone. Non-interlaced, 8-bit PNGs of every colour
+# type can be read; anything else raises ValueError, and csv2js.py keeps loading
+# that icon from its own file.
+
+import struct
+import zlib
+
+
+SIGNATURE = "\x89PNG\r\n\x1a\n"
+
+# Bytes per pixel of each PNG colour type (at 8 bits per channel)
+CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+# Transparent pixels left between icons, so scaled icons do not bleed into their neighbours
+GUTTER = 1
+
+
+# Paeth predictor of the PNG filters
+def paeth(left, up, corner):
+  estimate = left + up - corner
+  to_left, to_up, to_corner = abs(estimate - left), abs(estimate - up), abs(estimate - corner)
+  if to_left <= to_up and to_left <= to_corner:
+    return left
+  if to_up <= to_corner:
+    return up
+  return corner
+
+# Undo the filter 'kind' on the scanline 'line', given the unfiltered line above it
+def unfilter(kind, line, previous, bpp):
+  if kind == 0:
+    return line
+  for i in range(len(line)):
+    left = line[i - bpp] if i >= bpp else 0
+    corner = previous[i - bpp] if i >= bpp else 0
+    if kind == 1:
+      line[i] = (line[i] + left) & 255
+    elif kind == 2:
+      line[i] = (line[i] + previous[i]) & 255
+    elif kind == 3:
+      line[i] = (line[i] + (left + previous[i]) // 2) & 255
+    elif kind == 4:
+      line[i] = (line[i] + paeth(left, previous[i], corner)) & 255
+    else:
+      raise ValueError("unknown PNG filter {0}".format(kind))
+  return line
+
+# Read the PNG at 'path'. Returns its width, height and rows of RGBA pixels (bytearrays)
+def read_png(path):
+  try:
+    return decode_png(open(path, "rb").read())
+  except (struct.error, zlib.error, IndexError) as e:
+    raise ValueError("corrupt PNG ({0})".format(e))
+
+# Decode the contents of a PNG file, as read_png() does
+def decode_png(data):
+  if data[:8] != SIGNATURE:
+    raise ValueError("not a PNG")
+  position, idat, palette, transparency, width = 8, [], None, None, None
+  while position < len(data):
+    length, kind = struct.unpack(">I4s", data[position:position + 8])
+    body = data[position + 8:position + 8 + length]
+    position += 12 + length
+    if kind == "IHDR":
+      width, height, depth, colour, compression, filtering, interlace = struct.unpack(">IIBBBBB", body)
+    elif kind == "PLTE":
+      palette = bytearray(body)
+    elif kind == "tRNS":
+      transparency = bytearray(body)
+    elif kind == "IDAT":
+      idat.append(body)
+    elif kind == "IEND":
+      break
+  if width is None:
+    raise ValueError("no PNG header")
+  if depth != 8 or interlace != 0 or not colour in CHANNELS or (colour == 3 and palette is None):
+    raise ValueError("unsupported PNG (bit depth {0}, colour type {1}, interlace {2})".format(depth, colour, interlace))
+  bpp = CHANNELS[colour]
+  raw = bytearray(zlib.decompress("".join(idat)))
+  stride = width * bpp
+  rows, previous = [], bytearray(stride)
+  for y in range(height):
+    start = y * (stride + 1)
+    line = unfilter(raw[start], raw[start + 1:start + 1 + stride], previous, bpp)
+    previous = line
+    rgba = bytearray(width * 4)
+    for x in range(width):
+      pixel = line[x * bpp:(x + 1) * bpp]
+      if colour == 6:
+        rgba[x * 4:x * 4 + 4] = pixel
+      elif colour == 2:
+        rgba[x * 4:x * 4 + 4] = pixel + bytearray([255])
+      elif colour == 4:
+        rgba[x * 4:x * 4 + 4] = bytearray([pixel[0], pixel[0], pixel[0], pixel[1]])
+      elif colour == 0:
+        rgba[x * 4:x * 4 + 4] = bytearray([pixel[0], pixel[0], pixel[0], 255])
+      else:
+        alpha = transparency[pixel[0]] if transparency is not None and pixel[0] < len(transparency) else 255
+        rgba[x * 4:x * 4 + 4] = palette[pixel[0] * 3:pixel[0] * 3 + 3] + bytearray([alpha])
+    rows.append(rgba)
+  return width, height, rows
+
+# Filter the scanline 'line' (given the line above it) with whichever PNG filter leaves
+# the smallest sum of absolute differences, which usually compresses best
+def filter_line(line, previous):
+  best = None
+  for kind in range(5):
+    filtered = bytearray([kind])
+    for i in range(len(line)):
+      left = line[i - 4] if i >= 4 else 0
+      corner = previous[i - 4] if i >= 4 else 0
+      predicted = [0, left, previous[i], (left + previous[i]) // 2, paeth(left, previous[i], corner)][kind]
+      filtered.append((line[i] - predicted) & 255)
+    cost = sum(value if value < 128 else 256 - value for value in filtered[1:])
+    if best is None or cost < best[0]:
+      best = (cost, filtered)
+  return best[1]
+
+# Contents of a PNG, given its scanlines already filtered: RGBA pixels, or with a
+# 'palette' (a list of [red, green, blue, alpha] colours), one palette index per pixel
+def png_data(width, height, raw, palette=None):
+  def chunk(kind, body):
+    return struct.pack(">I", len(body)) + kind + body + struct.pack(">I", zlib.crc32(kind + body) & 0xffffffff)
+  data = SIGNATURE + chunk("IHDR", struct.pack(">IIBBBBB", width, height, 8, 6 if palette is None else 3, 0, 0, 0))
+  if palette is not None:
+    data += chunk("PLTE", str(bytearray(channel for colour in palette for channel in colour[:3])))
+    data += chunk("tRNS", str(bytearray(colour[3] for colour in palette)))
+  return data + chunk("IDAT", zlib.compress(str(raw), 9)) + chunk("IEND", "")
+
+# Contents of a PNG of rows of RGBA pixels
+def encode_png(width, height, rows):
+  raw, previous = bytearray(), bytearray(width * 4)
+  for row in rows:
+    raw += filter_line(row, previous)
+    previous = row
+  return png_data(width, height, raw)
+
+# Write rows of RGBA pixels to a PNG at 'path'
+def write_png(path, width, height, rows):
+  output = open(path, "wb")
+  output.write(encode_png(width, height, rows))
+  output.close()
+
+# Pack 'images' (an ordered dict of name: (width, height, rows)) side by side, in
+# order, into one sprite. Returns its width, height and rows, and the position and
+# size (x, y, width, height) of each image in it
+def pack_sprite(images):
+  width = sum(image[0] for image in images.values()) + GUTTER * (len(images) - 1)
+  height = max(image[1] for image in images.values())
+  rows = [bytearray(width * 4) for y in range(height)]
+  layout = {}
+  x = 0
+  for name, (image_width, image_height, image_rows) in images.items():
+    for y, row in enumerate(image_rows):
+      rows[y][x * 4:(x + image_width) * 4] = row
+    layout[name] = (x, 0, image_width, image_height)
+    x += image_width + GUTTER
+  return width, height, rows, layout
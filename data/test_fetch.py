@@ -0,0 +1,171 @@
+# Tests for fetch.py, against a stand-in HTTP server on localhost
+#
+# Run from this folder with:
+#
+#   python -m unittest discover -p "test_*.py"
+
+import BaseHTTPServer
+import os
+import shutil
+import SocketServer
+import tempfile
+import threading
+import time
+import unittest
+
+# ./fetch.py, spreadsheet fetching
+from fetch import new_pool, close_pool, fetch, fetch_all, source_url
+
+SHEET = "Type,Title\nmarker,One\nmarker,Two\n"
+
+# Answers GET requests the way the test asked the server to (see StandInServer): by
+# path, a list of responses to give in turn, the last one repeated. Each response is
+# a dict of "code", "headers", "body" and, optionally, "delay" (seconds to wait
+# before answering), "hold" (an Event to wait on half way through the body) or
+# "close" (to close the connection after the body)
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def do_GET(self):
+    server = self.server
+    with server.lock:
+      server.requests.append((self.path, dict(self.headers)))
+      responses = server.responses[self.path]
+      response = responses.pop(0) if len(responses) > 1 else responses[0]
+    time.sleep(response.get("delay", 0))
+    etag = response.get("headers", {}).get("ETag")
+    if etag and self.headers.get("If-None-Match") == etag:
+      response = {"code": 304, "headers": {"ETag": etag}}
+    body = response.get("body", "")
+    self.send_response(response["code"])
+    for header, value in dict({"Content-Length": str(len(body))}, **response.get("headers", {})).items():
+      self.send_header(header, value)
+    self.end_headers()
+    self.close_connection = response.get("close", False)
+    if "hold" in response:
+      self.wfile.write(body[:len(body) // 2])
+      self.wfile.flush()
+      response["hold"].wait(5)
+      body = body[len(body) // 2:]
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  def __init__(self, responses):
+    BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StandInHandler)
+    self.responses = responses
+    self.requests = []
+    self.lock = threading.Lock()
+
+  def url(self, path):
+    return "http://127.0.0.1:{0}{1}".format(self.server_address[1], path)
+
+class FetchTest(unittest.TestCase):
+  def serve(self, responses):
+    server = StandInServer(responses)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    self.addCleanup(server.server_close)
+    self.addCleanup(server.shutdown)
+    return server
+
+  def fetch(self, url, headers=None, timeout=5, retries=3, backoff=0.01):
+    pool = new_pool()
+    self.addCleanup(close_pool, pool)
+    status, download = fetch(pool, url, headers or {}, timeout, retries, backoff)
+    if download is not None:
+      threading.Thread(target=download).start()
+    return status
+
+  def test_retries_server_errors(self):
+    server = self.serve({"/sheet.csv": [{"code": 503}, {"code": 429}, {"code": 200, "body": SHEET}]})
+    status = self.fetch(server.url("/sheet.csv"))
+    self.assertEqual(status["state"], "ok")
+    self.assertEqual(status["attempts"], 3)
+    self.assertEqual(status["body"].read(), SHEET)
+
+  def test_gives_up_after_retries(self):
+    server = self.serve({"/sheet.csv": [{"code": 500}]})
+    status = self.fetch(server.url("/sheet.csv"), retries=2)
+    self.assertEqual(status["state"], "failed")
+    self.assertEqual(status["attempts"], 3)
+    self.assertEqual(status["error"], "HTTP 500")
+
+  def test_client_errors_are_not_retried(self):
+    server = self.serve({"/sheet.csv": [{"code": 404}]})
+    status = self.fetch(server.url("/sheet.csv"))
+    self.assertEqual(status["state"], "failed")
+    self.assertEqual(status["attempts"], 1)
+
+  def test_times_out(self):
+    server = self.serve({"/sheet.csv": [{"code": 200, "body": SHEET, "delay": 1}]})
+    started = time.time()
+    status = self.fetch(server.url("/sheet.csv"), timeout=0.2, retries=1)
+    self.assertEqual(status["state"], "failed")
+    self.assertEqual(status["attempts"], 2)
+    self.assertIn("timed out", status["error"])
+    self.assertLess(time.time() - started, 1)
+
+  def test_conditional_request(self):
+    server = self.serve({"/sheet.csv": [{"code": 200, "body": SHEET, "headers": {"ETag": '"v1"'}}]})
+    status = self.fetch(server.url("/sheet.csv"))
+    self.assertEqual(status["etag"], '"v1"')
+    status["body"].close()
+    status = self.fetch(server.url("/sheet.csv"), {"If-None-Match": status["etag"]})
+    self.assertEqual(status["state"], "not modified")
+    self.assertEqual(status["code"], 304)
+    self.assertNotIn("body", status)
+    self.assertEqual(server.requests[-1][1].get("if-none-match"), '"v1"')
+
+  def test_concurrent_fetches(self):
+    paths = ["/sheet{0}.csv".format(number) for number in range(4)]
+    server = self.serve(dict((path, [{"code": 200, "body": SHEET + path, "delay": 0.5}]) for path in paths))
+    started = time.time()
+    fetched = fetch_all([server.url(path) for path in paths], lambda url: {}, 4, 5, 0, 0)
+    self.assertLess(time.time() - started, 1.5)
+    self.assertEqual([status["body"].read() for status in fetched], [SHEET + path for path in paths])
+
+  def test_body_is_read_as_it_arrives(self):
+    hold = threading.Event()
+    self.addCleanup(hold.set)
+    server = self.serve({"/sheet.csv": [{"code": 200, "body": SHEET * 100, "hold": hold}]})
+    fetched = fetch_all([server.url("/sheet.csv")], lambda url: {}, 1, 5, 0, 0)
+    lines = iter(fetched[0]["body"])
+    self.assertEqual(next(lines), "Type,Title\n")
+    self.assertFalse(hold.is_set())
+    hold.set()
+    self.assertEqual("".join(lines), (SHEET * 100)[len("Type,Title\n"):])
+    self.assertEqual(fetched[0]["bytes"], len(SHEET) * 100)
+
+  def test_body_broken_off(self):
+    server = self.serve({"/sheet.csv": [{"code": 200, "body": SHEET, "headers": {"Content-Length": "1000"}, "close": True}]})
+    fetched = fetch_all([server.url("/sheet.csv")], lambda url: {}, 1, 5, 3, 0)
+    self.assertRaises(IOError, fetched[0]["body"].read)
+    self.assertEqual(fetched[0]["state"], "failed")
+    self.assertEqual(fetched[0]["attempts"], 1)
+
+  def test_local_file(self):
+    folder = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, folder)
+    path = os.path.join(folder, "sheet.csv")
+    open(path, "w").write(SHEET)
+    status = self.fetch(source_url(path))
+    self.assertEqual(status["state"], "ok")
+    self.assertEqual(status["body"].read(), SHEET)
+    status = self.fetch(source_url(path), {"If-None-Match": status["etag"]})
+    self.assertEqual(status["state"], "not modified")
+
+  def test_missing_local_file_is_not_retried(self):
+    started = time.time()
+    status = self.fetch(source_url("/nonexistent/sheet.csv"), backoff=1)
+    self.assertEqual(status["state"], "failed")
+    self.assertEqual(status["attempts"], 1)
+    self.assertLess(time.time() - started, 1)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,148 @@
+# Tests for mirror.py (and the mirror's tilesets and URLs in tiles.py), against a
+# stand-in tile origin on localhost
+#
+# Run from this folder with:
+#
+#   python -m unittest discover -p "test_*.py"
+
+import BaseHTTPServer
+import httplib
+import os
+import re
+import shutil
+import sqlite3
+import SocketServer
+import tempfile
+import threading
+import unittest
+
+# ./mirror.py, mirrors and serves the basemaps' tiles locally
+from mirror import map_rows, mirror_tileset, TileHandler, TileServer
+
+# ./tiles.py, the mirror's tilesets and URLs
+from tiles import basemap_name, mirror_url, covering_tiles, tile_url
+
+# The settings mirror.py reads: zooms 0 and 1 over a box round (0, 0), five tiles in all
+class MirrorSettings(object):
+  map_bounds = [[-10, -10], [10, 10]]
+  min_zoom = 0
+  max_zoom = 1
+  fetch_workers = 2
+  fetch_timeout = 5
+  fetch_retries = 0
+  fetch_backoff = 0
+
+SHEET = """Type,Title,URL,Start Year,End Year
+Map,Old World,{0},1800,1900
+Map,No Years,{0},,
+marker,Somewhere,,1850,1860
+"""
+
+# Serves /<z>/<x>/<y>.png: at zoom 0 a land tile, and at zoom 1 the same ocean tile,
+# except for column 1 row 0, which is missing (404), and column 1 row 1, which fails (500)
+class TileOriginHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_GET(self):
+    self.server.requests.append(self.path)
+    z, x, y = [int(number) for number in re.match(r"^/(\d+)/(\d+)/(\d+)\.png$", self.path).groups()]
+    if z == 1 and x == 1:
+      self.send_error(404 if y == 0 else 500)
+      return
+    body = "land" if z == 0 else "ocean"
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+class TileOrigin(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  def __init__(self):
+    BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), TileOriginHandler)
+    self.requests = []
+
+# The mirror's own server, quietly serving the folder a test puts in 'folder'
+class QuietTileHandler(TileHandler):
+  def log_message(self, *args):
+    pass
+
+class MirrorTest(unittest.TestCase):
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.folder)
+
+  def serve(self, server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    self.addCleanup(server.server_close)
+    self.addCleanup(server.shutdown)
+    return "http://127.0.0.1:{0}".format(server.server_address[1])
+
+  def origin_row(self):
+    self.origin = TileOrigin()
+    return {"Title": "Old World", "URL": self.serve(self.origin) + "/{z}/{x}/{y}.png"}
+
+  def test_urls(self):
+    self.assertEqual(basemap_name("Old World (1800)"), "OldWorld1800")
+    self.assertEqual(mirror_url("http://localhost:8000/", "Old World", "http://{s}.example.com/{z}/{x}/{y}.jpg"), "http://localhost:8000/OldWorld/{z}/{x}/{y}.jpg")
+    self.assertEqual(tile_url("http://{s}.example.com/{z}/{x}/{y}.png", 3, 2, 1), "http://a.example.com/3/2/1.png")
+    self.assertEqual(len(covering_tiles(MirrorSettings.map_bounds, 0, 1)), 5)
+
+  def test_map_rows(self):
+    path = os.path.join(self.folder, "sheet.csv")
+    open(path, "w").write(SHEET.format("http://example.com/{z}/{x}/{y}.png"))
+    self.assertEqual([row["Title"] for row in map_rows([path], MirrorSettings)], ["Old World"])
+
+  def test_map_rows_raises_when_a_sheet_cannot_be_fetched(self):
+    self.assertRaises(IOError, map_rows, [os.path.join(self.folder, "missing.csv")], MirrorSettings)
+
+  def test_mirror_tileset(self):
+    row = self.origin_row()
+    path = os.path.join(self.folder, "OldWorld.mbtiles")
+    counts = mirror_tileset(row, path, 2, False, MirrorSettings)
+    self.assertEqual((counts["stored"], counts["missing"], counts["failed"]), (3, 1, 1))
+    self.assertEqual((counts["tiles"], counts["images"]), (3, 2))
+    connection = sqlite3.connect(path)
+    self.addCleanup(connection.close)
+    self.assertEqual(str(connection.execute("SELECT tile_data FROM tiles WHERE zoom_level = 0").fetchone()[0]), "land")
+    self.assertEqual(dict(connection.execute("SELECT name, value FROM metadata"))["bounds"], "-10,-10,10,10")
+
+    # Tiles already stored are not downloaded again, unless refreshing
+    del self.origin.requests[:]
+    mirror_tileset(row, path, 2, False, MirrorSettings)
+    self.assertEqual(sorted(self.origin.requests), ["/1/1/0.png", "/1/1/1.png"])
+    del self.origin.requests[:]
+    mirror_tileset(row, path, 2, True, MirrorSettings)
+    self.assertEqual(len(self.origin.requests), 5)
+
+  def test_serves_tiles(self):
+    mirror_tileset(self.origin_row(), os.path.join(self.folder, "OldWorld.mbtiles"), 2, False, MirrorSettings)
+    QuietTileHandler.folder = self.folder
+    mirror = self.serve(TileServer(("127.0.0.1", 0), QuietTileHandler))
+    # The URL csv2js.py gives the basemap, for tile 1/0/0
+    tile = mirror_url(mirror, "Old World", "{z}/{x}/{y}.png").replace("{z}/{x}/{y}", "1/0/0")[len(mirror):]
+    connection = httplib.HTTPConnection(mirror[len("http://"):])
+    self.addCleanup(connection.close)
+
+    connection.request("GET", tile)
+    response = connection.getresponse()
+    self.assertEqual((response.status, response.read()), (200, "ocean"))
+    self.assertEqual(response.getheader("Content-Type"), "image/png")
+    etag = response.getheader("ETag")
+
+    connection.request("GET", tile, headers={"If-None-Match": etag})
+    response = connection.getresponse()
+    response.read()
+    self.assertEqual(response.status, 304)
+
+    for path in ["/OldWorld/1/1/0.png", "/NewWorld/0/0/0.png", "/nothing"]:
+      connection.request("GET", path)
+      response = connection.getresponse()
+      response.read()
+      self.assertEqual(response.status, 404)
+
+if __name__ == "__main__":
+  unittest.main()
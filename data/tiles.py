@@ -0,0 +1,80 @@
+# Tile pyramid export for csv2js.py
+#
+# Buckets markers and shapes into Web Mercator z/x/y tiles for every zoom level
+# the map allows, so the front end only has to fetch the tiles covering its
+# viewport. Features are placed by bounding box: a marker lands in one tile per
+# zoom, a shape in every tile its bounding box touches. Anything outside the
+# map's bounds is left out, and tile ranges stop at the bounds' edges.
+#
+# Also names the tilesets mirror.py keeps of the basemaps, and works out which tiles
+# it downloads and the URLs it serves them at.
+
+import re
+
+from clusters import mercator
+
+
+# Tile column/row containing a longitude/latitude at zoom 'z'
+def tile_at(lon, lat, z):
+  n = 2 ** z
+  x, y = mercator(lon, lat)
+  return min(n - 1, max(0, int(x * n))), min(n - 1, max(0, int(y * n)))
+
+# Bounding box [west, south, east, north] of a list of positions
+def bounding_box(positions):
+  lons = [position[0] for position in positions]
+  lats = [position[1] for position in positions]
+  return [min(lons), min(lats), max(lons), max(lats)]
+
+# Place features, given as (id, bounding box) pairs, into the tiles of every zoom
+# from min_zoom to max_zoom, clipped to 'bounds' ([[south, west], [north, east]]).
+# Returns {(z, x, y): [ids]}, ids in the order they were given
+def bucket_features(boxes, bounds, min_zoom, max_zoom):
+  (south, west), (north, east) = bounds
+  tiles = {}
+  for feature_id, box in boxes:
+    if box[0] > east or box[2] < west or box[1] > north or box[3] < south:
+      continue
+    box = [max(box[0], west), max(box[1], south), min(box[2], east), min(box[3], north)]
+    for z in range(min_zoom, max_zoom + 1):
+      # Tile rows count down from the north
+      x0, y0 = tile_at(box[0], box[3], z)
+      x1, y1 = tile_at(box[2], box[1], z)
+      for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+          tiles.setdefault((z, x, y), []).append(feature_id)
+  return tiles
+
+# Name of a basemap's tileset, from its Map row's title
+def basemap_name(title):
+  return re.sub(r"\W", "", title)
+
+# Image format of a tileset, from the extension in its URL template ('png' if there is none)
+def tile_format(url):
+  found = re.search(r"\{y\}\.(\w+)", url)
+  return found.group(1).lower() if found else "png"
+
+# URL template of a basemap on the mirror at 'server'
+def mirror_url(server, title, url):
+  return "{0}/{1}/{{z}}/{{x}}/{{y}}.{2}".format(server.rstrip("/"), basemap_name(title), tile_format(url))
+
+# Every tile (z, x, TMS row) covering 'bounds' ([[south, west], [north, east]]) from
+# min_zoom to max_zoom. Columns east of 180 degrees wrap round to the start
+def covering_tiles(bounds, min_zoom, max_zoom):
+  (south, west), (north, east) = bounds
+  spans = [(west, min(east, 180))]
+  if east > 180:
+    spans.append((-180, east - 360))
+  tiles = set()
+  for z in range(min_zoom, max_zoom + 1):
+    for span_west, span_east in spans:
+      x0, y0 = tile_at(span_west, north, z)
+      x1, y1 = tile_at(span_east, south, z)
+      for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+          tiles.add((z, x, 2 ** z - 1 - y))
+  return sorted(tiles)
+
+# URL of one tile of a tileset whose L.tileLayer has 'tms: true' (so {y} is the TMS row)
+def tile_url(url, z, x, row):
+  return url.replace("{s}", "abc"[abs(x + row) % 3]).replace("{z}", str(z)).replace("{x}", str(x)).replace("{y}", str(row))
@@ -34,6 +34,21 @@ $(document).ready(function() {
     setYear(year);
   };
 
+  // Start loading the next basemap era's tiles for the current view when playback
+  // is this many years away from it
+  var prefetchYears = 2;
+
+  function warmNextEra(year) {
+    for (var i = 0; i < BasemapEras.length; i++) {
+      if (BasemapEras[i][0] > year) {
+        if (BasemapEras[i][0] - year <= prefetchYears) {
+          prefetchBasemap(BasemapEras[i][2]);
+        }
+        return;
+      }
+    }
+  };
+
   var year = getYear();
   playing = false;
 
@@ -56,10 +71,12 @@ $(document).ready(function() {
     if (playing === false) {
       $("#icon-target").attr("src","images/pause.png");
       map.closePopup();
+      warmNextEra(getYear());
       window.animate = setInterval(function() {
         incrementYear(1);
         year = getYear();
         playing = true;
+        warmNextEra(year);
         // year based conditionals for stopping and basemap/marker layer selection
         if (year === 1867) {
           clearInterval(animate);
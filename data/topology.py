@@ -0,0 +1,227 @@
+# Shape geometry processing for csv2js.py
+#
+# Turns the GeoJSON pasted into the spreadsheet's 'GeoJSON' column into a
+# TopoJSON-style topology: coordinates are quantized to an integer grid, lines
+# and polygon rings are cut into arcs wherever they meet, and arcs shared by
+# neighbouring shapes are stored once. Every arc point is tagged with the lowest
+# zoom level at which it survives Douglas-Peucker simplification, so the front
+# end can draw each zoom level from the same arcs. Because shared arcs are
+# simplified once, neighbouring shapes keep a common border at every zoom.
+
+import json
+import math
+
+
+# Pull the geometries out of a GeoJSON object (Feature, FeatureCollection or bare geometry)
+def geometries(geojson):
+  if geojson["type"] == "FeatureCollection":
+    found = []
+    for feature in geojson["features"]:
+      found.extend(geometries(feature))
+    return found
+  if geojson["type"] == "Feature":
+    if geojson["geometry"] is None:
+      return []
+    return [geojson["geometry"]]
+  return [geojson]
+
+# Call 'visit' with every coordinate position in a geometry
+def each_position(geometry, visit):
+  if geometry["type"] == "GeometryCollection":
+    for child in geometry["geometries"]:
+      each_position(child, visit)
+    return
+  depth = {"Point": 0, "MultiPoint": 1, "LineString": 1, "MultiLineString": 2, "Polygon": 2, "MultiPolygon": 3}[geometry["type"]]
+  stack = [(geometry["coordinates"], depth)]
+  while stack:
+    coordinates, depth = stack.pop()
+    if depth == 0:
+      visit(coordinates)
+    else:
+      stack.extend((child, depth - 1) for child in coordinates)
+
+# Tolerance in degrees that keeps simplification below 'pixels' screen pixels at zoom 'z'
+def zoom_tolerance(z, pixels):
+  return pixels * 360.0 / (256 * 2 ** z)
+
+# Distance from point p to the segment a-b
+def segment_distance(p, a, b):
+  dx, dy = b[0] - a[0], b[1] - a[1]
+  if dx == 0 and dy == 0:
+    return math.hypot(p[0] - a[0], p[1] - a[1])
+  t = max(0.0, min(1.0, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / float(dx * dx + dy * dy)))
+  return math.hypot(p[0] - a[0] - t * dx, p[1] - a[1] - t * dy)
+
+# Douglas-Peucker significance of every point on a line: the point survives
+# simplification with any tolerance up to its significance. A point is never more
+# significant than the point that split its span, so for every tolerance the kept
+# points are exactly what Douglas-Peucker would keep
+def significance(points):
+  sig = [0.0] * len(points)
+  sig[0] = sig[-1] = float("inf")
+  stack = [(0, len(points) - 1, float("inf"))]
+  while stack:
+    first, last, cap = stack.pop()
+    best, best_distance = None, -1.0
+    for i in range(first + 1, last):
+      distance = segment_distance(points[i], points[first], points[last])
+      if distance > best_distance:
+        best, best_distance = i, distance
+    if best is None:
+      continue
+    sig[best] = min(best_distance, cap)
+    stack.append((first, best, sig[best]))
+    stack.append((best, last, sig[best]))
+  return sig
+
+# Drop repeated positions left behind by quantization
+def dedupe(points):
+  kept = [points[0]]
+  for point in points[1:]:
+    if point != kept[-1]:
+      kept.append(point)
+  return kept
+
+# Build the topology for a group of shapes, given as {object id: GeoJSON}. Returns a
+# dict with the quantization transform, the arcs (flattened dx, dy, min zoom triples,
+# delta-encoded on the integer grid) and one geometry per object referencing arcs by
+# index (~index for an arc used in reverse)
+def build_topology(shapes, quantization, min_zoom, max_zoom, pixels):
+  objects = {}
+  for key in sorted(shapes):
+    found = geometries(shapes[key])
+    if len(found) == 1:
+      objects[key] = found[0]
+    else:
+      objects[key] = {"type": "GeometryCollection", "geometries": found}
+
+  # Quantize every position onto a quantization x quantization grid over the bounding box
+  bounds = [float("inf"), float("inf"), float("-inf"), float("-inf")]
+  def extend(position):
+    bounds[0] = min(bounds[0], position[0])
+    bounds[1] = min(bounds[1], position[1])
+    bounds[2] = max(bounds[2], position[0])
+    bounds[3] = max(bounds[3], position[1])
+  for key in objects:
+    each_position(objects[key], extend)
+  if bounds[0] > bounds[2]:
+    bounds = [0, 0, 0, 0]
+  kx = (bounds[2] - bounds[0]) / (quantization - 1) or 1
+  ky = (bounds[3] - bounds[1]) / (quantization - 1) or 1
+  def quantize(position):
+    return (int(round((position[0] - bounds[0]) / kx)), int(round((position[1] - bounds[1]) / ky)))
+
+  # Collect every line and ring, and note each point's neighbours: a point reached
+  # from more than one pair of neighbours is a junction where arcs have to be cut.
+  # Rings left with fewer than three distinct points once quantized (tiny or degenerate
+  # ones) enclose nothing, so they get no arcs and the page leaves them out
+  lines = []
+  neighbours = {}
+  junctions = set()
+  def add_line(coordinates, ring):
+    points = dedupe([quantize(position) for position in coordinates])
+    if ring and points[0] != points[-1]:
+      points.append(points[0])
+    lines.append((points, ring))
+    if ring and len(points) < 4:
+      return len(lines) - 1
+    if ring:
+      inner = points[:-1]
+      pairs = [(inner[i - 1], inner[i], inner[(i + 1) % len(inner)]) for i in range(len(inner))]
+    else:
+      junctions.add(points[0])
+      junctions.add(points[-1])
+      pairs = [(points[i - 1], points[i], points[i + 1]) for i in range(1, len(points) - 1)]
+    for before, point, after in pairs:
+      pair = (min(before, after), max(before, after))
+      if neighbours.setdefault(point, pair) != pair:
+        junctions.add(point)
+    return len(lines) - 1
+
+  def collect(geometry):
+    kind = geometry["type"]
+    if kind == "GeometryCollection":
+      return {"type": kind, "geometries": [collect(child) for child in geometry["geometries"]]}
+    if kind == "Point":
+      return {"type": kind, "coordinates": quantize(geometry["coordinates"])}
+    if kind == "MultiPoint":
+      return {"type": kind, "coordinates": [quantize(position) for position in geometry["coordinates"]]}
+    if kind == "LineString":
+      return {"type": kind, "arcs": add_line(geometry["coordinates"], False)}
+    if kind == "MultiLineString":
+      return {"type": kind, "arcs": [add_line(line, False) for line in geometry["coordinates"]]}
+    if kind == "Polygon":
+      return {"type": kind, "arcs": [add_line(ring, True) for ring in geometry["coordinates"]]}
+    if kind == "MultiPolygon":
+      return {"type": kind, "arcs": [[add_line(ring, True) for ring in polygon] for polygon in geometry["coordinates"]]}
+    raise ValueError("unsupported geometry type {0}".format(kind))
+
+  for key in sorted(objects):
+    objects[key] = collect(objects[key])
+
+  # Cut each line at its junctions and store every distinct arc once
+  arcs = []
+  arc_ids = {}
+  def arc_ref(points):
+    points = tuple(points)
+    if points in arc_ids:
+      return arc_ids[points]
+    if points[::-1] in arc_ids:
+      return ~arc_ids[points[::-1]]
+    arc_ids[points] = len(arcs)
+    arcs.append(points)
+    return arc_ids[points]
+
+  line_arcs = []
+  for points, ring in lines:
+    if ring and len(points) < 4:
+      line_arcs.append([])
+      continue
+    if ring:
+      inner = points[:-1]
+      cuts = [i for i in range(len(inner)) if inner[i] in junctions]
+      # Rings without junctions start at their lowest point, so identical rings match
+      start = cuts[0] if cuts else inner.index(min(inner))
+      points = inner[start:] + inner[:start] + [inner[start]]
+    cuts = [i for i in range(1, len(points) - 1) if points[i] in junctions]
+    refs = []
+    first = 0
+    for cut in cuts + [len(points) - 1]:
+      refs.append(arc_ref(points[first:cut + 1]))
+      first = cut
+    line_arcs.append(refs)
+
+  def resolve(geometry):
+    kind = geometry["type"]
+    if kind == "GeometryCollection":
+      geometry["geometries"] = [resolve(child) for child in geometry["geometries"]]
+    elif kind in ["LineString", "MultiLineString", "Polygon", "MultiPolygon"]:
+      def refs(value):
+        return line_arcs[value] if isinstance(value, int) else [refs(child) for child in value]
+      geometry["arcs"] = refs(geometry["arcs"])
+    return geometry
+
+  for key in objects:
+    objects[key] = resolve(objects[key])
+
+  # Tag every arc point with the lowest zoom at which simplification keeps it,
+  # dropping points that are not needed even at the highest zoom
+  tolerances = [(z, zoom_tolerance(z, pixels)) for z in range(min_zoom, max_zoom + 1)]
+  encoded = []
+  for arc in arcs:
+    sig = significance([(x * kx, y * ky) for x, y in arc])
+    flat = []
+    last = (0, 0)
+    for point, point_sig in zip(arc, sig):
+      zooms = [z for z, tolerance in tolerances if point_sig >= tolerance]
+      if not zooms:
+        continue
+      flat.extend([point[0] - last[0], point[1] - last[1], zooms[0]])
+      last = point
+    encoded.append(flat)
+
+  return {"scale": [kx, ky], "translate": [bounds[0], bounds[1]], "arcs": encoded, "objects": objects}
+
+# Serialize a topology for the front end
+def topology_js(topology):
+  return json.dumps(topology, separators=(",", ":"), sort_keys=True)